@@ -1,37 +1,75 @@
 # app/agent.py
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional, Set
+import asyncio
 import os
+import time
 
-from .utils import log, dedupe_by, dedupe_by_domain
-from .search import search_web
-from .fetch import fetch_and_extract
+from .utils import log, dedupe_by, dedupe_by_domain, getenv_int
+from .search import search_many_async
+from .fetch import fetch_many_async
 from .chunk import (
-    chunk_text,
-    rank_chunks,
+    CHUNK_TOKENS,
+    chunk_with_spans,
+    normalize_rows,
     rerank_serp_by_embedding,
     rerank_chunks_by_embedding,
 )
 from .llm import (
-    plan_queries,
-    synthesize_answer,
-    critique_answer,
-    embed_texts,  # embeddings for semantic re-ranking
+    aplan_queries,
+    asynthesize_answer,
+    acritique_answer,
+    aembed_texts,  # embeddings for semantic re-ranking
 )
-from .synth import build_source_snippets
+from . import answers, background, trace as tracing
+from .synth import pack_context
+from .pipeline import run_pipeline_async
+from .index import shared_index, flush_shared_index
+from .dedupe import NearDupIndex
+from .documents import pdf_enabled
 
 
 def _is_pdf(url: str) -> bool:
-    """Heuristic to skip PDFs (can be heavy to fetch/parse)."""
+    """URL heuristic for PDFs; they are skipped only when PDF ingestion is off (see documents.py)."""
     u = (url or "").lower()
     return u.endswith(".pdf") or "/pdf" in u or ".pdf?" in u
 
 
-def answer(
+def _index_pages(index, dups: NearDupIndex, pages, run_urls: Set[str]):
+    """Chunk fetched pages into the shared BM25 index (CPU-bound; runs in a worker thread)."""
+    for url, page in pages:
+        title = page.get("title") or url
+        text = page.get("text") or ""
+
+        run_urls.add(url)
+        # Unchanged pages (same content hash) are not re-chunked or re-indexed
+        if index.has_page(url, page.get("content_hash")):
+            continue
+
+        # Chunk & add to the shared BM25 index
+        chunks, spans = chunk_with_spans(
+            text, chunk_size=900, overlap=120, max_tokens=CHUNK_TOKENS or None
+        )
+        index.add_page(url, title, chunks, content_hash=page.get("content_hash"), spans=spans)
+        for ch in chunks:
+            dups.add(ch, url)
+
+
+async def _embeddings(question: str, texts: List[str]):
+    """L2-normalized (question, items) embeddings from one async request."""
+    embs = await asyncio.to_thread(normalize_rows, await aembed_texts([question] + texts))
+    return embs[0], embs[1:]
+
+
+async def answer_async(
     question: str,
     max_iters: int = 2,
     topk: int = 6,
     model: str = "gpt-4o-mini",
     safe_mode: bool = None,
+    pipeline: bool = None,
+    progress: Optional[Callable[..., None]] = None,
+    cache: Optional[str] = None,
+    trace: Optional[bool] = None,
 ) -> Dict:
     """
     Main agent loop:
@@ -42,100 +80,176 @@ def answer(
       - synthesize -> critique -> possibly re-plan
     Stops when confidence >= 0.75 or max_iters reached.
 
+    Search, fetch, embeddings and chat are non-blocking (httpx / AsyncOpenAI);
+    extraction, chunking, indexing and packing run in worker threads, so many sessions
+    can share one event loop. Search engines are rate limited by gates shared with
+    every other session in the process.
+
+    progress(stage, **data), if given, is called as the run advances: "cache_hit",
+    "queries_planned", "pages_fetched", "draft_ready". An exception raised by it aborts
+    the run (used by the MCP server for cancellation).
+
+    cache ("on" | "warm" | "off", default ANSWER_CACHE env, else "off"): semantic answer
+    cache (see answers.py). "on" returns a stored result for an equivalent question as is;
+    "warm" seeds the evidence with the stored chunks and researches only the stored gaps.
+
+    trace=True (default TRACE env) returns per-stage spans with wall time, bytes, tokens,
+    cost, cache hits and skipped pages under result["trace"]; TRACE_FILE also appends
+    them as JSON lines (see trace.py).
+
     Env flags:
       SAFE_MODE=1         -> default safe_mode True (do not fetch pages, use SERP snippets)
       RERANK_SERP=1       -> re-rank SERP results with embeddings before fetching
       RERANK_CHUNKS=1     -> re-rank chunks with embeddings after BM25
+      CONTEXT_TOKENS=3000 -> token budget for source snippets in the synthesis prompt
+      PIPELINE=1          -> default pipeline True (stream search/fetch/extract/rank and stop
+                             early once evidence is strong; no SERP re-ranking, not in safe_mode;
+                             its stages run as tasks on the caller's event loop)
     """
+    if tracing.current() is None and tracing.enabled(trace):
+        # run this call as the root of a new trace (returned unless only TRACE_FILE asked for it)
+        with tracing.start("answer", question=question, model=model) as tr:
+            result = await answer_async(
+                question, max_iters=max_iters, topk=topk, model=model,
+                safe_mode=safe_mode, pipeline=pipeline, progress=progress, cache=cache,
+            )
+        log(f"[trace] {tr.headline()}")
+        if trace or (trace is None and os.getenv("TRACE", "0") == "1"):
+            result["trace"] = tr.summary()
+        return result
+
     if safe_mode is None:
         safe_mode = os.getenv("SAFE_MODE", "0") == "1"
+    if pipeline is None:
+        pipeline = os.getenv("PIPELINE", "0") == "1"
 
     use_rerank_serp = os.getenv("RERANK_SERP", "0") == "1"
     use_rerank_chunks = os.getenv("RERANK_CHUNKS", "0") == "1"
+    context_tokens = getenv_int("CONTEXT_TOKENS", 3000)
 
     log(f"Question: {question}")
-    queries = plan_queries(question, model=model)
 
-    # keep planner output bounded
-    if len(queries) > 6:
-        queries = queries[:6]
+    def emit(stage: str, **data):
+        if progress is not None:
+            progress(stage, **data)
+
+    mode = answers.cache_mode(cache)
+    profile = answers.profile(model, safe_mode, max_iters, topk)
+    q_emb = None
+    seed: List[Dict] = []  # warm start: chunks behind a cached answer
+    warm = None
+    queries = None
+    if mode != "off":
+        with tracing.span("answer_cache", mode=mode):
+            hit, q_emb = await answers.lookup(question, profile)
+        if hit:
+            info = {
+                "question": hit["question"],
+                "similarity": hit["similarity"],
+                "age_s": round(time.time() - hit.get("created", time.time())),
+            }
+            log(f"[answer-cache] hit ({info['similarity']}) from: {info['question']}")
+            emit("cache_hit", **info)
+            gaps = hit["result"].get("gaps") or []
+            if mode == "on" or not gaps:
+                return {**hit["result"], "cached": info}
+            # warm: keep the old evidence, research only what the critic said was missing
+            seed, warm = hit.get("chunks") or [], info
+            with tracing.span("plan"):
+                queries = await aplan_queries(f"{question}\nFocus on: {' | '.join(gaps)}", model=model)
+    if queries is None:
+        with tracing.span("plan"):
+            queries = await aplan_queries(question, model=model)
 
-    known_chunks: List[Dict] = []
+    known_chunks: List[Dict] = list(seed) if safe_mode else []
+    pipeline_stats = None
+    index = shared_index()   # corpus-wide BM25 over every page fetched
+    run_urls = set()         # pages fetched during this run
+    dups = NearDupIndex()    # near-duplicate chunk groups (mirrored/syndicated text)
 
     for it in range(max_iters):
         log(f"--- Iteration {it+1}/{max_iters} ---")
+        # keep planner output bounded
+        queries = queries[:6]
+        emit("queries_planned", iteration=it + 1, queries=queries)
 
-        # 1) Search (respects SEARCH_ENGINES env inside search_web)
-        results: List[Dict] = []
-        for q in queries:
-            results.extend(search_web(q, k=topk))
-
-        # 2) Deduplicate & skip PDFs; keep domain diversity
-        results = dedupe_by(results, key="url")
-        results = [r for r in results if not _is_pdf(r.get("url", ""))]
-        results = dedupe_by_domain(results, key="url")
-
-        # 3) Optional SERP re-ranking (semantic) before any fetch
-        if use_rerank_serp and results:
-            try:
-                results = rerank_serp_by_embedding(
-                    question, results, embed_fn=lambda xs: embed_texts(xs)
-                )
-            except Exception as e:
-                log(f"[rerank-serp] skipped due to error: {e}")
-
-        # 4) Build candidate evidence
-        if safe_mode:
-            # Use search snippets only (very low RAM path)
-            for r in results[:10]:
-                snippet = (r.get("snippet") or "")[:1000]
-                if not snippet:
-                    continue
-                known_chunks.append(
-                    {
-                        "chunk": snippet,
-                        "url": r["url"],
-                        "score": 1.0,  # flat score is fine for snippets
-                        "title": r.get("title") or r["url"],
-                    }
+        if pipeline and not safe_mode:
+            # 1-4) Streamed: pages are chunked and ranked as soon as they are extracted
+            with tracing.span("pipeline", iteration=it + 1):
+                chunks, pipeline_stats = await run_pipeline_async(
+                    question, queries, k=topk, max_pages=8, skip=None if pdf_enabled() else _is_pdf, index=index,
                 )
+            run_urls.update(c["url"] for c in chunks)
+            emit("pages_fetched", iteration=it + 1, pages=pipeline_stats["rank"]["items"])
         else:
-            # Fetch & parse a small subset to avoid memory spikes
-            pages_seen = 0
-            for r in results:
-                if pages_seen >= 8:  # hard cap on pages this iteration
-                    break
-                url = r["url"]
+            # 1) Search all queries x engines at once (respects SEARCH_ENGINES env)
+            with tracing.span("search", iteration=it + 1, queries=len(queries)):
+                results: List[Dict] = await search_many_async(queries, k=topk)
+
+            # 2) Deduplicate (& skip PDFs unless they can be ingested); keep domain diversity
+            results = dedupe_by(results, key="url")
+            if not pdf_enabled():
+                results = [r for r in results if not _is_pdf(r.get("url", ""))]
+            results = dedupe_by_domain(results, key="url")
+
+            # 3) Optional SERP re-ranking (semantic) before any fetch
+            if use_rerank_serp and results:
                 try:
-                    page = fetch_and_extract(url)
+                    texts = [f"{r.get('title','')} {r.get('snippet','')}" for r in results]
+                    with tracing.span("rerank_serp", items=len(texts)):
+                        q_emb, item_embs = await _embeddings(question, texts)
+                        results = rerank_serp_by_embedding(
+                            question, results, embed_fn=None, q_emb=q_emb, item_embs=item_embs
+                        )
                 except Exception as e:
-                    log(f"[fetch-error] {url} :: {e}")
-                    continue
-
-                title = page.get("title") or url
-                text = page.get("text") or ""
-                if not text:
-                    continue
-
-                # Chunk & lexical rank (BM25)
-                chunks = chunk_text(text, chunk_size=900, overlap=120)
-                scored = rank_chunks(chunks, question, topn=2)  # keep small per page
-                for chunk, score in scored:
+                    log(f"[rerank-serp] skipped due to error: {e}")
+
+            # 4) Build candidate evidence
+            if safe_mode:
+                # Use search snippets only (very low RAM path)
+                for r in results[:10]:
+                    snippet = (r.get("snippet") or "")[:1000]
+                    if not snippet:
+                        continue
                     known_chunks.append(
-                        {"chunk": chunk, "url": url, "score": float(score), "title": title}
+                        {
+                            "chunk": snippet,
+                            "url": r["url"],
+                            "score": 1.0,  # flat score is fine for snippets
+                            "title": r.get("title") or r["url"],
+                        }
                     )
-                pages_seen += 1
+            else:
+                # Fetch & parse a small subset concurrently (hard cap on pages this iteration)
+                with tracing.span("fetch", iteration=it + 1, urls=len(results)):
+                    pages = await fetch_many_async([r["url"] for r in results], limit=8)
+                with tracing.span("index", pages=len(pages)):
+                    await asyncio.to_thread(_index_pages, index, dups, pages, run_urls)
+                emit("pages_fetched", iteration=it + 1, pages=len(pages), urls=[url for url, _ in pages])
+
+        with tracing.span("rank", iteration=it + 1):
+            if not safe_mode:
+                # Lexical rank (BM25) across every page of this run; keep small per page
+                known_chunks = await asyncio.to_thread(index.query, question, topn=48, urls=run_urls, per_url=2)
+                known_chunks += seed
+
+            # Collapse near-duplicates into one representative carrying every source URL
+            known_chunks = await asyncio.to_thread(dups.collapse, known_chunks)
 
         # 5) Optional chunk re-ranking (semantic) after BM25
         if use_rerank_chunks and known_chunks:
             try:
                 bm25_texts = [kc["chunk"] for kc in known_chunks]
-                top_texts = rerank_chunks_by_embedding(
-                    question,
-                    bm25_texts,
-                    embed_fn=lambda xs: embed_texts(xs),
-                    topn=24,
-                )
+                with tracing.span("rerank_chunks", items=len(bm25_texts)):
+                    q_emb, item_embs = await _embeddings(question, bm25_texts)
+                    top_texts = rerank_chunks_by_embedding(
+                        question,
+                        bm25_texts,
+                        embed_fn=None,
+                        topn=24,
+                        q_emb=q_emb,
+                        item_embs=item_embs,
+                    )
                 keep = set(top_texts)
                 known_chunks = [kc for kc in known_chunks if kc["chunk"] in keep][:24]
             except Exception as e:
@@ -144,34 +258,52 @@ def answer(
         # Final cap (keeps behavior stable if re-rank is off)
         known_chunks = sorted(known_chunks, key=lambda x: x["score"], reverse=True)[:24]
 
-        # 6) Trim to source list (domain-diverse) for the LLM
-        raw = [
-            {"chunk": c["chunk"], "url": c["url"], "score": c["score"], "title": c["title"]}
-            for c in known_chunks
-        ]
-        sources = build_source_snippets(raw, max_sources=8)
+        # 6) Pack the best evidence per token into the synthesis budget
+        with tracing.span("pack"):
+            sources, packed = await asyncio.to_thread(
+                pack_context, known_chunks, budget_tokens=context_tokens, model=model
+            )
+        log(f"[context] {len(sources)} source(s), {packed}/{context_tokens} tokens")
 
         # 7) Synthesize & critique
-        draft = synthesize_answer(question, sources, model=model)
-        critique = critique_answer(question, draft.get("answer", ""), model=model)
+        with tracing.span("synthesize", iteration=it + 1, sources=len(sources), context_tokens=packed):
+            draft = await asynthesize_answer(question, sources, model=model, max_snippet_chars=None)
+        with tracing.span("critique", iteration=it + 1):
+            critique = await acritique_answer(question, draft.get("answer", ""), model=model)
 
         log(
             f"Critique confidence: {critique.get('confidence')} "
             f"| gaps: {len(critique.get('gaps', []))}"
         )
+        emit(
+            "draft_ready",
+            iteration=it + 1,
+            answer=draft.get("answer", ""),
+            confidence=critique.get("confidence", 0.0),
+            gaps=critique.get("gaps", []),
+        )
 
         # 8) Stop or iterate
         if critique.get("confidence", 0.0) >= 0.75 or it == max_iters - 1:
-            return {
+            result = {
                 "answer": draft.get("answer", ""),
                 "citations": draft.get("citations", []),
                 "confidence": critique.get("confidence", 0.0),
                 "gaps": critique.get("gaps", []),
             }
+            if pipeline_stats:
+                result["pipeline_stats"] = pipeline_stats  # last iteration's per-stage stats
+            if warm:
+                result["warm_start"] = warm
+            await asyncio.to_thread(flush_shared_index)
+            if mode != "off" and result["citations"]:
+                await asyncio.to_thread(answers.store, question, profile, q_emb, result, known_chunks)
+            return result
 
         # Re-plan using the critic's gaps
         gap_text = " | ".join(critique.get("gaps", [])) or "Expand on counterpoints and recency"
-        queries = plan_queries(f"{question}\nFocus on: {gap_text}", model=model)
+        with tracing.span("plan", iteration=it + 2):
+            queries = await aplan_queries(f"{question}\nFocus on: {gap_text}", model=model)
 
     # Fallback
     return {
@@ -180,3 +312,28 @@ def answer(
         "confidence": 0.5,
         "gaps": [],
     }
+
+
+def answer(
+    question: str,
+    max_iters: int = 2,
+    topk: int = 6,
+    model: str = "gpt-4o-mini",
+    safe_mode: bool = None,
+    pipeline: bool = None,
+    progress: Optional[Callable[..., None]] = None,
+    cache: Optional[str] = None,
+    trace: Optional[bool] = None,
+) -> Dict:
+    """
+    Blocking wrapper around answer_async (same arguments and result).
+
+    Every call runs on the process's background event loop (background.py), so the
+    per-loop httpx and AsyncOpenAI clients (and their keep-alive connections) are reused
+    across calls and threads. The run keeps the caller's context (trace, rate-limit
+    priority); progress is called from the loop's thread.
+    """
+    return background.run(lambda: answer_async(
+        question, max_iters=max_iters, topk=topk, model=model,
+        safe_mode=safe_mode, pipeline=pipeline, progress=progress, cache=cache, trace=trace,
+    ))
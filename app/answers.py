@@ -0,0 +1,195 @@
+# app/answers.py
+"""
+Semantic cache of finished research, keyed by the question's embedding.
+
+A new question is embedded once and compared (cosine) with every stored question asked
+with the same settings (profile(): model, safe_mode, max_iters, topk); the best match at
+or above ANSWER_CACHE_THRESHOLD is a hit. Exact repeats
+(after whitespace/case/"?" normalization) hit without an embedding call.
+
+Entries live in the shared cache store under "answer_<hash>" (TTL CACHE_TTL_ANSWER,
+default one day; byte cap CACHE_MAX_BYTES_ANSWER) and hold the result plus the ranked
+chunks it was built from, so a "warm" run can seed its evidence with them and only
+research the critic's gaps. The similarity index is an in-process matrix bounded by
+ANSWER_CACHE_MAX entries (oldest dropped first), loaded from the store on first use; it
+sees answers stored by other processes only if they were in the store at that point.
+
+Off by default: when on, every run costs one extra embedding call for the lookup, and a
+hit can be up to CACHE_TTL_ANSWER old.
+
+Env:
+  ANSWER_CACHE=off|on|warm     default mode for agent.answer
+  ANSWER_CACHE_THRESHOLD=0.95
+  ANSWER_CACHE_MAX=2000
+"""
+import asyncio
+import base64
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .cache import get_cache, ttl_for
+from .chunk import normalize_rows
+from .llm import aembed_texts
+from .utils import getenv_int, log, sha1
+
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX = getenv_int("ANSWER_CACHE_MAX", 2000)
+MODES = ("off", "on", "warm")
+
+_SPACE = re.compile(r"\s+")
+
+
+def cache_mode(mode: Optional[str] = None) -> str:
+    mode = (mode or os.getenv("ANSWER_CACHE", "off")).strip().lower()
+    return mode if mode in MODES else "off"
+
+
+def _norm(question: str) -> str:
+    return _SPACE.sub(" ", question.strip().lower()).rstrip(" ?.!")
+
+
+def profile(model: str, safe_mode: bool, max_iters: int, topk: int) -> str:
+    """The run settings an answer depends on; lookups only match entries with the same profile."""
+    return f"{model}|safe={int(bool(safe_mode))}|iters={max_iters}|topk={topk}"
+
+
+def _key(question: str, profile: str) -> str:
+    return f"answer_{sha1(profile + '|' + _norm(question))}"
+
+
+class AnswerIndex:
+    """Question embeddings of stored answers; thread-safe."""
+
+    def __init__(self, max_items: int = ANSWER_CACHE_MAX):
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._keys: List[str] = []
+        self._profiles: List[str] = []
+        self._created: List[float] = []
+        self._mat: Optional[np.ndarray] = None
+        self._loaded = False
+
+    def _load(self):
+        cache = get_cache()
+        rows = []
+        for key in cache.keys("answer_"):
+            entry = cache.get(key)
+            if entry and entry.get("emb"):
+                rows.append((entry.get("created", 0.0), key, entry.get("profile", ""), _unpack(entry["emb"])))
+        rows.sort(key=lambda r: r[0])
+        for created, key, prof, vec in rows[-self.max_items:]:
+            self._append(key, prof, created, vec)
+        if rows:
+            log(f"[answer-cache] loaded {len(self._keys)} answer(s)")
+
+    def _append(self, key: str, profile: str, created: float, vec: np.ndarray):
+        if key in self._keys:
+            self._drop(self._keys.index(key))
+        vec = normalize_rows(vec)
+        self._mat = vec if self._mat is None else np.vstack([self._mat, vec])
+        self._keys.append(key)
+        self._profiles.append(profile)
+        self._created.append(created)
+        while len(self._keys) > self.max_items:
+            get_cache().delete(self._keys[0])
+            self._drop(0)
+
+    def _drop(self, i: int):
+        del self._keys[i], self._profiles[i], self._created[i]
+        self._mat = np.delete(self._mat, i, axis=0) if len(self._keys) else None
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._loaded = True
+            try:
+                self._load()
+            except Exception as e:
+                log(f"[answer-cache] could not load index: {e}")
+
+    def best(self, q_emb: np.ndarray, profile: str) -> Tuple[Optional[str], float]:
+        """Closest live entry with this profile -> (key, cosine), or (None, 0.0)."""
+        with self._lock:
+            self._ensure_loaded()
+            if self._mat is None:
+                return None, 0.0
+            sims = self._mat @ normalize_rows(q_emb)[0]
+            ttl = ttl_for("answer")
+            now = time.time()
+            for i in np.argsort(-sims):
+                if self._profiles[i] == profile and (not ttl or now - self._created[i] < ttl):
+                    return self._keys[i], float(sims[i])
+            return None, 0.0
+
+    def add(self, key: str, profile: str, created: float, vec: np.ndarray):
+        with self._lock:
+            self._ensure_loaded()
+            self._append(key, profile, created, vec)
+
+    def discard(self, key: str):
+        with self._lock:
+            if key in self._keys:
+                self._drop(self._keys.index(key))
+
+
+def _pack(vec: np.ndarray) -> str:
+    return base64.b64encode(np.asarray(vec, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def _unpack(s: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(s), dtype=np.float32)
+
+
+_index = AnswerIndex()
+
+
+async def lookup(question: str, profile: str, threshold: Optional[float] = None) -> Tuple[Optional[Dict], Optional[np.ndarray]]:
+    """
+    Stored answer for an equivalent question asked with the same profile (see profile()).
+    -> (entry with "similarity", question embedding). entry is None on a miss; the
+    embedding is None only when it couldn't be computed (then the result can't be stored).
+    """
+    threshold = ANSWER_CACHE_THRESHOLD if threshold is None else threshold
+    cache = get_cache()
+    exact = cache.get(_key(question, profile))
+    if exact:
+        exact["similarity"] = 1.0
+        return exact, _unpack(exact["emb"])
+    try:
+        q_emb = (await aembed_texts([question]))[0]
+    except Exception as e:
+        log(f"[answer-cache] lookup skipped: {e}")
+        return None, None
+    key, sim = await asyncio.to_thread(_index.best, q_emb, profile)
+    if key is None or sim < threshold:
+        return None, q_emb
+    entry = cache.get(key)
+    if not entry:  # expired or evicted from the store
+        _index.discard(key)
+        return None, q_emb
+    entry["similarity"] = round(sim, 4)
+    return entry, q_emb
+
+
+def store(question: str, profile: str, q_emb: Optional[np.ndarray], result: Dict, chunks: List[Dict]):
+    """Save a finished result and the ranked chunks behind it (no-op without an embedding)."""
+    if q_emb is None:
+        return
+    key = _key(question, profile)
+    created = time.time()
+    get_cache().set(key, {
+        "question": question,
+        "profile": profile,
+        "created": created,
+        "emb": _pack(q_emb),
+        "result": {k: result.get(k) for k in ("answer", "citations", "confidence", "gaps")},
+        "chunks": [
+            {k: c[k] for k in ("chunk", "url", "title", "score") if k in c}
+            for c in chunks
+        ],
+    }, created=created)
+    _index.add(key, profile, created, q_emb)
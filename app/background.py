@@ -0,0 +1,72 @@
+# app/background.py
+"""
+One event loop per process for blocking callers.
+
+The async code keeps its httpx and AsyncOpenAI clients per event loop, so every sync
+entry point (agent.answer, search_web, fetch_and_extract, embed_texts, ...) runs its
+coroutine here instead of starting a loop per call: keep-alive connections are reused
+across calls and threads, and there is one implementation of each step (the async one).
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+from typing import Awaitable, Callable, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_pid = 0
+_loop_lock = threading.Lock()
+
+
+def loop() -> asyncio.AbstractEventLoop:
+    """The background loop (started on first use, runs forever)."""
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():  # a forked child needs its own thread
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name="agent-loop", daemon=True).start()
+        return _loop
+
+
+def run(make: Callable[[], Awaitable[T]]) -> T:
+    """
+    Block until make()'s coroutine finishes on the background loop and return its result.
+    It runs in a copy of the caller's context (trace, rate-limit priority). If the caller
+    is interrupted (e.g. KeyboardInterrupt) the task is cancelled.
+    """
+    lp = loop()
+    try:
+        on_loop = asyncio.get_running_loop() is lp
+    except RuntimeError:
+        on_loop = False
+    if on_loop:
+        raise RuntimeError("blocking call on the background loop; await the async version instead")
+    done: concurrent.futures.Future = concurrent.futures.Future()
+    tasks: List[asyncio.Task] = []
+
+    def start():
+        # runs in the caller's context, which the task copies
+        task = lp.create_task(make())
+        tasks.append(task)
+        task.add_done_callback(lambda t: _settle(t, done))
+
+    lp.call_soon_threadsafe(start, context=contextvars.copy_context())
+    try:
+        return done.result()
+    except BaseException:
+        if not done.done():  # the caller gave up: stop the run
+            lp.call_soon_threadsafe(lambda: [t.cancel() for t in tasks])
+        raise
+
+
+def _settle(task: asyncio.Task, done: concurrent.futures.Future):
+    if task.cancelled():
+        done.cancel()
+    elif task.exception() is not None:
+        done.set_exception(task.exception())
+    else:
+        done.set_result(task.result())
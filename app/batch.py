@@ -0,0 +1,204 @@
+# app/batch.py
+"""
+Batch research: many questions through one process and one event loop.
+
+  python -m app.batch questions.jsonl -o results.jsonl
+  cat questions.jsonl | python -m app.batch - -o results.jsonl --concurrency 8
+
+Each input line is a JSON object {"question": ..., "id": ...} (optional per-question
+"max_iters", "topk", "model", "safe_mode", "pipeline", "cache"), a JSON string, or plain
+text. Questions without an "id" are identified by a hash of the question.
+
+Runs share everything a process holds: the in-process cache layers, the corpus BM25
+index, embedding vectors, HTTP/OpenAI connection pools and rate limiters. Identical
+searches, page downloads and embeddings that are in flight at the same time are
+coalesced (see singleflight.py). Calls run at batch priority (see ratelimit.py).
+
+Each result is appended to the output (-o; "-" = stdout, logs then go to stderr) as one
+JSON line as soon as it completes:
+  {"id", "question", "status": "ok" | "error", "result" | "error", "elapsed_s", "finished_at"}
+Re-running with the same output file skips the ids already answered "ok", so a crashed
+or interrupted batch resumes where it stopped (failed questions are retried).
+
+Env:
+  BATCH_CONCURRENCY=4    questions researched at once
+  BATCH_TIMEOUT=0        per-question limit in seconds (0 = none)
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from . import httpclient, llm
+from .agent import answer_async
+from .ratelimit import BATCH, priority
+from .utils import getenv_int, log, sha1
+
+BATCH_CONCURRENCY = max(1, getenv_int("BATCH_CONCURRENCY", 4))
+BATCH_TIMEOUT = getenv_int("BATCH_TIMEOUT", 0)
+OPTIONS = ("max_iters", "topk", "model", "safe_mode", "pipeline", "cache")
+
+
+def parse_line(line: str) -> Optional[Dict]:
+    """Input line -> {"id", "question", option: value...}, or None for a blank line."""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        item = json.loads(line)
+    except ValueError:
+        if line[0] in "{[":
+            raise ValueError(f"invalid JSON: {line[:80]}")
+        item = line
+    if isinstance(item, str):
+        item = {"question": item}
+    if not isinstance(item, dict) or not str(item.get("question") or "").strip():
+        raise ValueError(f"no question in: {line[:80]}")
+    item["question"] = str(item["question"]).strip()
+    item["id"] = str(item.get("id") or sha1(item["question"])[:16])
+    return item
+
+
+def read_questions(lines: Iterable[str]) -> List[Dict]:
+    """Parse input lines; bad lines are logged and skipped, repeated ids run once."""
+    items: Dict[str, Dict] = {}
+    for n, line in enumerate(lines, 1):
+        try:
+            item = parse_line(line)
+        except ValueError as e:
+            log(f"[batch] line {n} skipped: {e}")
+            continue
+        if item is not None:
+            items.setdefault(item["id"], item)
+    return list(items.values())
+
+
+def answered(path: str) -> Set[str]:
+    """Ids with an "ok" result in an existing output file (a torn last line is ignored)."""
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(rec, dict) and rec.get("status") == "ok":
+                done.add(str(rec.get("id")))
+    return done
+
+
+class Writer:
+    """Appends result lines; each is flushed as soon as it's written."""
+
+    def __init__(self, path: str):
+        self.path = path
+        if path == "-":
+            self._f = sys.stdout
+            sys.stdout = sys.stderr  # app logging prints; keep it off the results stream
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._f = open(path, "a+", encoding="utf-8")
+        # a crash mid-line leaves a torn record: start on a fresh line
+        if self._f.tell() > 0:
+            self._f.seek(self._f.tell() - 1)
+            if self._f.read(1) != "\n":
+                self._f.write("\n")
+
+    def write(self, rec: Dict):
+        self._f.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+        self._f.flush()
+
+    def close(self):
+        if self.path == "-":
+            sys.stdout = self._f
+        else:
+            self._f.close()
+
+
+async def run_batch(
+    items: List[Dict],
+    writer: Writer,
+    concurrency: int = BATCH_CONCURRENCY,
+    timeout: float = BATCH_TIMEOUT,
+    **defaults,
+) -> Dict[str, int]:
+    """Research items concurrently (at most `concurrency` at once) -> {"ok", "error"} counts."""
+    slots = asyncio.Semaphore(max(1, concurrency))
+    counts = {"ok": 0, "error": 0}
+    total = len(items)
+
+    async def one(item: Dict):
+        async with slots:
+            opts = {**defaults, **{k: item[k] for k in OPTIONS if item.get(k) is not None}}
+            if "model" in opts:
+                opts["model"] = str(opts["model"]).split(":", 1)[-1]
+            t0 = time.perf_counter()
+            rec = {"id": item["id"], "question": item["question"]}
+            try:
+                coro = answer_async(item["question"], **opts)
+                result = await (asyncio.wait_for(coro, timeout) if timeout else coro)
+                rec.update(status="ok", result=result)
+            except asyncio.TimeoutError:
+                rec.update(status="error", error=f"Timed out after {timeout:g}s")
+            except Exception as e:
+                rec.update(status="error", error=f"{type(e).__name__}: {e}")
+            rec["elapsed_s"] = round(time.perf_counter() - t0, 2)
+            rec["finished_at"] = round(time.time(), 3)
+            counts[rec["status"]] += 1
+            writer.write(rec)
+            log(f"[batch] {counts['ok'] + counts['error']}/{total} {rec['status']} ({rec['elapsed_s']}s): {item['question'][:80]}")
+
+    try:
+        with priority(BATCH):
+            await asyncio.gather(*(one(item) for item in items))
+    finally:
+        await httpclient.aclose()
+        await llm.aclose()
+    return counts
+
+
+def cli():
+    p = argparse.ArgumentParser(description="Agentic Research Assistant (batch)")
+    p.add_argument("input", help="JSONL file of questions, or - for stdin")
+    p.add_argument("-o", "--out", required=True, help="results JSONL (appended; answered ids are skipped)")
+    p.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    p.add_argument("--timeout", type=float, default=BATCH_TIMEOUT, help="seconds per question (0 = none)")
+    p.add_argument("--max-iters", type=int, default=int(os.getenv("MAX_ITERS", "2")))
+    p.add_argument("--topk", type=int, default=int(os.getenv("TOPK", "6")))
+    p.add_argument("--model", type=str, default=os.getenv("DEFAULT_LLM", "openai:gpt-4o-mini"))
+    p.add_argument("--safe-mode", action="store_true", help="Skip fetching pages; use search snippets only")
+    args = p.parse_args()
+
+    writer = Writer(args.out)
+    try:
+        if args.input == "-":
+            items = read_questions(sys.stdin)
+        else:
+            with open(args.input, encoding="utf-8") as f:
+                items = read_questions(f)
+        done = answered(args.out) if args.out != "-" else set()
+        todo = [it for it in items if it["id"] not in done]
+        log(f"[batch] {len(items)} question(s), {len(items) - len(todo)} already answered, {len(todo)} to run")
+        counts = asyncio.run(run_batch(
+            todo, writer,
+            concurrency=args.concurrency,
+            timeout=args.timeout,
+            max_iters=args.max_iters,
+            topk=args.topk,
+            model=args.model.split(":", 1)[-1],
+            safe_mode=args.safe_mode or (os.getenv("SAFE_MODE", "0") == "1"),
+        ))
+        log(f"[batch] done: {counts['ok']} ok, {counts['error']} error(s)")
+    finally:
+        writer.close()
+    if counts["error"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
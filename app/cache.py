@@ -0,0 +1,503 @@
+# app/cache.py
+"""
+Size-bounded cache store behind utils.load_cache / utils.save_cache.
+
+Keys keep their "<namespace>_<id>" shape (page_..., search_...); the namespace picks
+the TTL and optional byte cap. Values are compact JSON, zlib-compressed.
+
+Layers:
+  - in-process LRU (bounded by items and bytes) in front of
+  - a backend: "sqlite" (default; one WAL-mode file, safe across processes)
+    or "files" (sharded directories, atomic rename-on-write).
+
+Env:
+  CACHE_BACKEND=sqlite|files
+  CACHE_MAX_BYTES=536870912      total on-disk cap (0 = unbounded)
+  CACHE_MAX_BYTES_<NS>=...       per-namespace cap, e.g. CACHE_MAX_BYTES_PAGE
+  CACHE_TTL_<NS>=seconds         per-namespace TTL, e.g. CACHE_TTL_SEARCH (0 = never expires)
+  CACHE_EVICTION=lru|lfu         eviction order once a cap is hit (files backend is always lru)
+  CACHE_TOUCH_INTERVAL=30        seconds between batched access-time writes (sqlite backend)
+  CACHE_MEM_ITEMS / CACHE_MEM_BYTES   in-process LRU bounds
+
+Migrate a legacy one-JSON-file-per-key .cache directory with:
+  python -m app.cache migrate [--src DIR] [--delete]
+"""
+import argparse
+import atexit
+import glob
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from . import trace
+from .utils import CACHE_DIR, getenv_int, getenv_str, log
+
+# Search results go stale fast; extracted pages much slower. Finished answers (answers.py) sit in
+# between; LLM responses (llm._achat) depend only on the prompt, so they keep for a week.
+DEFAULT_TTLS = {"search": 6 * 3600, "page": 14 * 86400, "answer": 86400, "llm": 7 * 86400}
+EVICT_EVERY = 64  # writes between cap checks
+TOUCH_INTERVAL = float(os.getenv("CACHE_TOUCH_INTERVAL", "30"))
+
+
+def namespace(key: str) -> str:
+    return key.split("_", 1)[0] if "_" in key else ""
+
+
+def ttl_for(ns: str) -> float:
+    return float(getenv_int(f"CACHE_TTL_{ns.upper()}", DEFAULT_TTLS.get(ns, 0))) if ns else 0.0
+
+
+def _encode(data: Any) -> bytes:
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+
+
+def _decode(blob: bytes) -> Any:
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+class LRU:
+    """Thread-safe LRU bounded by item count and total byte size (sizes are caller-supplied)."""
+
+    def __init__(self, max_items: int, max_bytes: int = 0):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._d: "OrderedDict[Any, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            hit = self._d.get(key)
+            if hit is None:
+                return default
+            self._d.move_to_end(key)
+            return hit[0]
+
+    def put(self, key, value, size: int = 1):
+        if self.max_items <= 0 or (self.max_bytes and size > self.max_bytes):
+            return
+        with self._lock:
+            old = self._d.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._d[key] = (value, size)
+            self._bytes += size
+            while self._d and (len(self._d) > self.max_items or (self.max_bytes and self._bytes > self.max_bytes)):
+                _, (_, sz) = self._d.popitem(last=False)
+                self._bytes -= sz
+
+    def pop(self, key):
+        with self._lock:
+            old = self._d.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._d)
+
+
+class SQLiteBackend:
+    """
+    All entries in one SQLite file (WAL mode: concurrent readers, serialized writers).
+    Reads don't write: access times and hit counts are kept in memory and flushed in one
+    transaction every TOUCH_INTERVAL seconds, before eviction and at exit.
+    """
+
+    def __init__(self, path: str, eviction: str = "lru"):
+        self.path = path
+        self.eviction = eviction
+        self._local = threading.local()
+        self._touched: Dict[str, list] = {}  # key -> [last access, hits since last flush]
+        self._touch_lock = threading.Lock()
+        self._flushed = time.monotonic()
+        atexit.register(self.flush)
+        with self._conn() as c:
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY, ns TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL,"
+                " created REAL NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+            )
+            c.execute("CREATE INDEX IF NOT EXISTS entries_ns_accessed ON entries(ns, accessed)")
+            c.execute("CREATE INDEX IF NOT EXISTS entries_expires ON entries(expires)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        """(blob, expires) or None; expires == 0 means never."""
+        c = self._conn()
+        row = c.execute("SELECT value, expires FROM entries WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if row[1] and row[1] < now:
+            c.execute("DELETE FROM entries WHERE key=?", (key,))
+            return None
+        self._touch(key, now)
+        return bytes(row[0]), row[1]
+
+    def _touch(self, key: str, now: float):
+        with self._touch_lock:
+            t = self._touched.get(key)
+            if t is None:
+                self._touched[key] = [now, 1]
+            else:
+                t[0] = now
+                t[1] += 1
+            due = time.monotonic() - self._flushed >= TOUCH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write the batched access times and hit counts."""
+        with self._touch_lock:
+            rows = [(at, n, key) for key, (at, n) in self._touched.items()]
+            self._touched = {}
+            self._flushed = time.monotonic()
+        if not rows:
+            return
+        c = self._conn()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                c.executemany("UPDATE entries SET accessed=MAX(accessed, ?), hits=hits+? WHERE key=?", rows)
+                c.execute("COMMIT")
+            except Exception:
+                c.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            log(f"Cache touch error: {e}")  # access times only order eviction; losing a batch is harmless
+
+    def set(self, key: str, blob: bytes, ns: str, ttl: float, created: Optional[float] = None):
+        now = time.time()
+        created = created or now
+        expires = created + ttl if ttl > 0 else 0
+        self._conn().execute(
+            "INSERT OR REPLACE INTO entries(key, ns, value, size, created, expires, accessed, hits)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+            (key, ns, sqlite3.Binary(blob), len(blob), created, expires, now),
+        )
+
+    def delete(self, key: str):
+        self._conn().execute("DELETE FROM entries WHERE key=?", (key,))
+
+    def keys(self, prefix: str = "") -> Iterator[str]:
+        like = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        for (k,) in self._conn().execute("SELECT key FROM entries WHERE key LIKE ? ESCAPE '\\'", (like,)).fetchall():
+            yield k
+
+    def usage(self) -> Dict[str, Tuple[int, int]]:
+        """ns -> (entries, bytes)"""
+        rows = self._conn().execute("SELECT ns, COUNT(*), COALESCE(SUM(size), 0) FROM entries GROUP BY ns")
+        return {ns: (n, b) for ns, n, b in rows.fetchall()}
+
+    def evict(self, max_bytes: int, ns_caps: Dict[str, int]) -> int:
+        self.flush()
+        c = self._conn()
+        removed = c.execute("DELETE FROM entries WHERE expires > 0 AND expires < ?", (time.time(),)).rowcount
+        order = "hits ASC, accessed ASC" if self.eviction == "lfu" else "accessed ASC"
+        usage = self.usage()
+        for ns, cap in ns_caps.items():
+            removed += self._trim(c, cap, usage.get(ns, (0, 0))[1], order, ns)
+        if max_bytes:
+            total = sum(b for _, b in self.usage().values())
+            removed += self._trim(c, max_bytes, total, order, None)
+        return removed
+
+    def _trim(self, c: sqlite3.Connection, cap: int, used: int, order: str, ns: Optional[str]) -> int:
+        if not cap or used <= cap:
+            return 0
+        target = used - int(cap * 0.9)  # free a little extra so we don't evict on every write
+        where, args = ("WHERE ns=?", (ns,)) if ns is not None else ("", ())
+        freed, victims = 0, []
+        for key, size in c.execute(f"SELECT key, size FROM entries {where} ORDER BY {order}", args).fetchall():
+            victims.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.executemany("DELETE FROM entries WHERE key=?", victims)
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        return len(victims)
+
+
+class FileBackend:
+    """One compressed file per key under <root>/<ns>/<2-char shard>/; writes are atomic renames."""
+
+    SUFFIX = ".jz"
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        ns = namespace(key) or "_"
+        shard = key[len(ns) + 1:][:2] or "__"
+        return os.path.join(self.root, ns, shard, key + self.SUFFIX)
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                expires = float(f.readline() or 0)
+                blob = f.read()
+        except (OSError, ValueError):
+            return None
+        if expires and expires < time.time():
+            self.delete(key)
+            return None
+        try:
+            os.utime(path)  # mtime doubles as last-access for LRU eviction
+        except OSError:
+            pass
+        return blob, expires
+
+    def set(self, key: str, blob: bytes, ns: str, ttl: float, created: Optional[float] = None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        expires = (created or time.time()) + ttl if ttl > 0 else 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(f"{expires}\n".encode("ascii"))
+                f.write(blob)
+            os.replace(tmp, path)
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _entries(self, ns: str = "*"):
+        for path in glob.glob(os.path.join(self.root, ns, "*", "*" + self.SUFFIX)):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, st.st_size, st.st_mtime
+
+    def keys(self, prefix: str = "") -> Iterator[str]:
+        ns = namespace(prefix) or "*"
+        for path, _, _ in self._entries(ns):
+            k = os.path.basename(path)[: -len(self.SUFFIX)]
+            if k.startswith(prefix):
+                yield k
+
+    def usage(self) -> Dict[str, Tuple[int, int]]:
+        out: Dict[str, Tuple[int, int]] = {}
+        for path, size, _ in self._entries():
+            ns = os.path.basename(os.path.dirname(os.path.dirname(path)))
+            n, b = out.get(ns, (0, 0))
+            out[ns] = (n + 1, b + size)
+        return out
+
+    def evict(self, max_bytes: int, ns_caps: Dict[str, int]) -> int:
+        removed = 0
+        groups = [(ns, cap) for ns, cap in ns_caps.items()] + ([("*", max_bytes)] if max_bytes else [])
+        for ns, cap in groups:
+            entries = sorted(self._entries(ns), key=lambda e: e[2])
+            used = sum(e[1] for e in entries)
+            if not cap or used <= cap:
+                continue
+            target = used - int(cap * 0.9)
+            for path, size, _ in entries:
+                if target <= 0:
+                    break
+                try:
+                    os.remove(path)
+                    removed += 1
+                    target -= size
+                except OSError:
+                    pass
+        return removed
+
+
+class Cache:
+    """In-process LRU over a persistent backend, with per-namespace TTLs, caps and hit/miss counters."""
+
+    def __init__(self, backend, max_bytes: int = 0, mem_items: int = 256, mem_bytes: int = 32 << 20):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.mem = LRU(mem_items, mem_bytes)
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, ns: str, what: str):
+        with self._lock:
+            c = self.counters.setdefault(ns, {"hits": 0, "misses": 0, "writes": 0})
+            c[what] += 1
+        if what != "writes":
+            trace.add(f"cache.{ns}.{what}")
+
+    def get(self, key: str) -> Optional[Any]:
+        ns = namespace(key)
+        hit = self.mem.get(key)
+        if hit is not None:
+            expires, blob = hit
+            if not expires or expires >= time.time():
+                self._count(ns, "hits")
+                return _decode(blob)
+            self.mem.pop(key)
+        try:
+            found = self.backend.get(key)
+        except Exception as e:
+            log(f"Cache read error: {e}")
+            found = None
+        if found is None:
+            self._count(ns, "misses")
+            return None
+        blob, expires = found
+        try:
+            data = _decode(blob)
+        except Exception:
+            self._count(ns, "misses")
+            return None
+        self.mem.put(key, (expires, blob), len(blob))
+        self._count(ns, "hits")
+        return data
+
+    def set(self, key: str, data: Any, created: Optional[float] = None):
+        ns = namespace(key)
+        ttl = ttl_for(ns)
+        blob = _encode(data)
+        self.backend.set(key, blob, ns, ttl, created=created)
+        self.mem.put(key, (((created or time.time()) + ttl) if ttl else 0, blob), len(blob))
+        self._count(ns, "writes")
+        with self._lock:
+            self._writes += 1
+            due = self._writes % EVICT_EVERY == 0
+        if due:
+            self.evict()
+
+    def delete(self, key: str):
+        self.mem.pop(key)
+        self.backend.delete(key)
+
+    def keys(self, prefix: str = "") -> Iterator[str]:
+        return self.backend.keys(prefix)
+
+    def evict(self) -> int:
+        caps = {}
+        for ns in set(DEFAULT_TTLS) | set(self.backend.usage()):
+            cap = getenv_int(f"CACHE_MAX_BYTES_{ns.upper()}", 0) if ns else 0
+            if cap:
+                caps[ns] = cap
+        try:
+            removed = self.backend.evict(self.max_bytes, caps)
+        except Exception as e:
+            log(f"Cache evict error: {e}")
+            return 0
+        if removed:
+            self.mem.clear()
+            log(f"[cache] evicted {removed} entries")
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = {ns: dict(c) for ns, c in self.counters.items()}
+        usage = self.backend.usage()
+        return {
+            "namespaces": {
+                ns: {"entries": usage.get(ns, (0, 0))[0], "bytes": usage.get(ns, (0, 0))[1], **counters.get(ns, {})}
+                for ns in set(usage) | set(counters)
+            },
+            "memory_items": len(self.mem),
+        }
+
+
+_cache: Optional[Cache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Cache:
+    """Process-wide cache configured from env (created on first use)."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                kind = getenv_str("CACHE_BACKEND", "sqlite").lower()
+                if kind == "files":
+                    backend = FileBackend(os.path.join(CACHE_DIR, "store"))
+                else:
+                    path = getenv_str("CACHE_PATH", os.path.join(CACHE_DIR, "cache.sqlite3"))
+                    backend = SQLiteBackend(path, eviction=getenv_str("CACHE_EVICTION", "lru").lower())
+                _cache = Cache(
+                    backend,
+                    max_bytes=getenv_int("CACHE_MAX_BYTES", 512 << 20),
+                    mem_items=getenv_int("CACHE_MEM_ITEMS", 256),
+                    mem_bytes=getenv_int("CACHE_MEM_BYTES", 32 << 20),
+                )
+    return _cache
+
+
+def migrate_legacy(src: str = CACHE_DIR, delete: bool = False) -> int:
+    """Import legacy <key>.json files into the configured store (file mtime becomes created time)."""
+    cache = get_cache()
+    moved = 0
+    for path in glob.glob(os.path.join(src, "*.json")):
+        key = os.path.basename(path)[:-len(".json")]
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            cache.set(key, data, created=os.path.getmtime(path))
+        except Exception as e:
+            log(f"[cache-migrate] skipped {path}: {e}")
+            continue
+        moved += 1
+        if delete:
+            os.remove(path)
+    cache.evict()
+    return moved
+
+
+def main():
+    p = argparse.ArgumentParser(description="Research agent cache maintenance")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    m = sub.add_parser("migrate", help="import a legacy per-key JSON .cache directory")
+    m.add_argument("--src", default=CACHE_DIR)
+    m.add_argument("--delete", action="store_true", help="remove legacy files once imported")
+    sub.add_parser("stats", help="entries/bytes per namespace")
+    sub.add_parser("evict", help="drop expired entries and enforce size caps now")
+    args = p.parse_args()
+
+    if args.cmd == "migrate":
+        n = migrate_legacy(args.src, delete=args.delete)
+        print(f"migrated {n} entries")
+    elif args.cmd == "stats":
+        print(json.dumps(get_cache().stats(), indent=2))
+    elif args.cmd == "evict":
+        print(f"evicted {get_cache().evict()} entries")
+
+
+if __name__ == "__main__":
+    main()
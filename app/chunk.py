@@ -1,66 +1,191 @@
 import re
-from typing import List, Tuple
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional, Tuple
 from rank_bm25 import BM25Okapi
-from typing import Dict, List
-from math import sqrt
+import numpy as np
+from .index import tokenize
+from .tokens import token_offsets
+from .utils import getenv_int
 
-def normalize(text: str) -> str:
+Span = Tuple[int, int]
+
+CHUNK_TOKENS = getenv_int("CHUNK_TOKENS", 0)  # >0: token-budgeted chunks instead of 900 chars
+
+# sentence ends (". ", "! ", "? ", incl. closing quotes/brackets) and paragraph breaks
+_BOUNDARY = re.compile(r"[.!?][\"')\]]*(?=\s)|(?=\n\n)")
+
+def normalize(text: str, keep_paragraphs: bool = False) -> str:
     text = text.replace("\xa0", " ")
+    if keep_paragraphs:
+        text = re.sub(r"[ \t\r\f\v]+", " ", text)
+        text = re.sub(r" ?\n[\s]*", lambda m: "\n\n" if m.group(0).count("\n") > 1 else " ", text)
+        return text.strip()
     text = re.sub(r"\s+", " ", text).strip()
     return text
 
+def _boundaries(text: str) -> List[int]:
+    """Positions where a chunk may end (just after a sentence end / before a paragraph break)."""
+    return [m.end() for m in _BOUNDARY.finditer(text)]
+
+def _snap_end(bounds: List[int], start: int, end: int, min_len: int) -> int:
+    """Move end back to the last boundary in (start+min_len, end], if any."""
+    i = bisect_right(bounds, end) - 1
+    if i >= 0 and bounds[i] > start + min_len:
+        return bounds[i]
+    return end
+
+def _snap_start(text: str, bounds: List[int], start: int, limit: int) -> int:
+    """Move start forward to the sentence after the next boundary in [start, limit), if any."""
+    i = bisect_left(bounds, start)
+    if i < len(bounds) and bounds[i] < limit:
+        start = bounds[i]
+        while start < limit and text[start].isspace():
+            start += 1
+    return start
+
+def chunk_spans(
+    text: str,
+    chunk_size: int = 900,
+    overlap: int = 120,
+    max_tokens: Optional[int] = None,
+    token_overlap: int = 0,
+    model: str = "gpt-4o-mini",
+    snap: bool = True,
+) -> List[Span]:
+    """
+    (start, end) spans over an already-normalized buffer; slice text[start:end] only when needed.
+    Sizes are characters (chunk_size/overlap) or, with max_tokens, tokens (token_overlap).
+    With snap, chunks end on a sentence/paragraph boundary when one falls in the back half
+    of the window, and the overlap starts on one when possible.
+    """
+    n = len(text)
+    if not n:
+        return []
+    bounds = _boundaries(text) if snap else []
+    offs = token_offsets(text, model) if max_tokens else None
+
+    spans: List[Span] = []
+    start = 0
+    while start < n:
+        if offs is not None:
+            t0 = bisect_right(offs, start) - 1
+            t_end = t0 + max_tokens
+            end = offs[t_end] if t_end < len(offs) else n
+        else:
+            end = start + chunk_size
+        end = min(n, max(end, start + 1))
+        if end < n and snap:
+            end = _snap_end(bounds, start, end, (end - start) // 2)
+        spans.append((start, end))
+        if end >= n:
+            break
+        if offs is not None:
+            t_e = bisect_right(offs, end) - 1
+            nxt = offs[max(0, t_e - token_overlap)] if token_overlap else end
+        else:
+            nxt = end - overlap
+        nxt = max(nxt, start + 1)  # always make progress
+        start = _snap_start(text, bounds, nxt, end) if snap else nxt
+    return spans
+
+def chunk_with_spans(
+    text: str,
+    chunk_size: int = 900,
+    overlap: int = 120,
+    max_tokens: Optional[int] = None,
+) -> Tuple[List[str], List[Span]]:
+    """
+    Normalize once, split into sentence-snapped spans; returns (chunk strings, spans).
+    The strings are copies sliced from the one normalized buffer (the BM25 index keeps
+    them); spans locate each chunk in that buffer.
+    """
+    buf = normalize(text, keep_paragraphs=True)
+    spans = chunk_spans(buf, chunk_size, overlap, max_tokens=max_tokens, token_overlap=max_tokens // 8 if max_tokens else 0)
+    return [buf[s:e] for s, e in spans], spans
+
 def chunk_text(text: str, chunk_size: int = 900, overlap: int = 120) -> List[str]:
     text = normalize(text)
     if not text:
         return []
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = min(len(text), start + chunk_size)
-        chunks.append(text[start:end])
-        start = end - overlap
-        if start < 0:
-            start = 0
-    return chunks
+    return [text[s:e] for s, e in chunk_spans(text, chunk_size, overlap)]
 
 def rank_chunks(chunks: List[str], query: str, topn: int = 6) -> List[Tuple[str, float]]:
     if not chunks:
         return []
-    corpus = [c.split() for c in chunks]
+    corpus = [tokenize(c) or [""] for c in chunks]
     bm25 = BM25Okapi(corpus)
-    scores = bm25.get_scores(query.split())
+    scores = bm25.get_scores(tokenize(query))
     scored = list(zip(chunks, scores))
     scored.sort(key=lambda x: x[1], reverse=True)
     return scored[:topn]
 
 def _cos(a, b):
-    num = sum(x*y for x, y in zip(a, b))
-    da = sqrt(sum(x*x for x in a))
-    db = sqrt(sum(y*y for y in b))
-    return 0.0 if (da == 0 or db == 0) else num / (da * db)
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    da, db = np.linalg.norm(a), np.linalg.norm(b)
+    return 0.0 if (da == 0 or db == 0) else float(a @ b / (da * db))
 
-def rerank_serp_by_embedding(question: str, serp_items: List[Dict], embed_fn) -> List[Dict]:
+def normalize_rows(embs) -> np.ndarray:
+    """L2-normalize an (n, d) embedding matrix (zero rows stay zero)."""
+    m = np.asarray(embs, dtype=np.float32)
+    if m.ndim == 1:
+        m = m[None, :]
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return m / norms
+
+def _topk(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first (argpartition, then sort only those k)."""
+    n = scores.shape[0]
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k >= n:
+        return np.argsort(-scores, kind="stable")
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+def _similarities(question: str, texts: List[str], embed_fn, q_emb, item_embs) -> np.ndarray:
+    """Cosine similarity of each item to the question. Precomputed embeddings must be L2-normalized."""
+    if q_emb is None and item_embs is None:
+        embs = normalize_rows(embed_fn([question] + texts))  # one request for question + items
+        q_emb, item_embs = embs[0], embs[1:]
+    elif q_emb is None:
+        q_emb = normalize_rows(embed_fn([question]))[0]
+    elif item_embs is None:
+        item_embs = normalize_rows(embed_fn(texts))
+    return np.asarray(item_embs, dtype=np.float32) @ np.asarray(q_emb, dtype=np.float32).reshape(-1)
+
+def rerank_serp_by_embedding(
+    question: str,
+    serp_items: List[Dict],
+    embed_fn,
+    q_emb: Optional[np.ndarray] = None,
+    item_embs: Optional[np.ndarray] = None,
+) -> List[Dict]:
     """
     Reorder SERP items by cosine similarity between (title+snippet) and the question.
     embed_fn: callable that takes list[str] -> list[list[float]] (embeddings)
+    q_emb / item_embs: optional precomputed, L2-normalized embeddings (skip embed_fn).
     """
     if not serp_items:
         return serp_items
-    q_emb = embed_fn([question])[0]
     texts = [f"{it.get('title','')} {it.get('snippet','')}" for it in serp_items]
-    embs = embed_fn(texts)
-    scored = [(it, _cos(q_emb, e)) for it, e in zip(serp_items, embs)]
-    scored.sort(key=lambda x: x[1], reverse=True)
-    return [it for it, _ in scored]
+    sims = _similarities(question, texts, embed_fn, q_emb, item_embs)
+    return [serp_items[i] for i in _topk(sims, len(serp_items))]
 
-def rerank_chunks_by_embedding(question: str, chunks: List[str], embed_fn, topn: int = 24) -> List[str]:
+def rerank_chunks_by_embedding(
+    question: str,
+    chunks: List[str],
+    embed_fn,
+    topn: int = 24,
+    q_emb: Optional[np.ndarray] = None,
+    item_embs: Optional[np.ndarray] = None,
+) -> List[str]:
     """
     Reorder chunk texts by cosine similarity to question; return topn chunk strings.
+    q_emb / item_embs: optional precomputed, L2-normalized embeddings (skip embed_fn).
     """
     if not chunks:
         return []
-    q_emb = embed_fn([question])[0]
-    embs = embed_fn(chunks)
-    scored = list(zip(chunks, (_cos(q_emb, e) for e in embs)))
-    scored.sort(key=lambda x: x[1], reverse=True)
-    return [c for c, _ in scored[:topn]]
+    sims = _similarities(question, list(chunks), embed_fn, q_emb, item_embs)
+    return [chunks[i] for i in _topk(sims, topn)]
@@ -0,0 +1,112 @@
+# app/dedupe.py
+"""
+Near-duplicate text detection with MinHash signatures + LSH banding.
+
+Syndicated/mirrored pages repeat the same paragraphs under different domains. Texts are
+shingled into word 5-grams, signed with `num_perm` MinHash values and bucketed by band;
+a new text joins an existing group when its estimated Jaccard similarity to the group's
+representative reaches `threshold`. Each group remembers every URL it was seen at.
+"""
+import threading
+import zlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .utils import sha1
+
+_P = np.uint64((1 << 61) - 1)
+_MASK32 = 0xFFFFFFFF
+
+
+def _shingle_hashes(text: str, n: int) -> np.ndarray:
+    words = text.lower().split()
+    if not words:
+        return np.zeros(1, dtype=np.uint64)
+    grams = {" ".join(words[i:i + n]) for i in range(max(1, len(words) - n + 1))}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) & _MASK32 for g in grams), dtype=np.uint64, count=len(grams))
+
+
+class NearDupIndex:
+    """Incremental near-duplicate grouping; thread-safe."""
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, bands: int = 16, shingle: int = 5, seed: int = 7):
+        assert num_perm % bands == 0, "num_perm must be a multiple of bands"
+        self.threshold = threshold
+        self.bands, self.rows = bands, num_perm // bands
+        self.shingle = shingle
+        rng = np.random.default_rng(seed)
+        # a, b < 2^32 and hashes < 2^32 keep a*h + b inside uint64
+        self._a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self._sigs: List[np.ndarray] = []
+        self._urls: List[List[str]] = []
+        self._by_text: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def signature(self, text: str) -> np.ndarray:
+        h = _shingle_hashes(text, self.shingle)
+        return ((self._a[:, None] * h[None, :] + self._b[:, None]) % _P).min(axis=1)
+
+    def _match(self, sig: np.ndarray) -> Optional[int]:
+        best, best_sim = None, self.threshold
+        seen = set()
+        for band in range(self.bands):
+            key = sig[band * self.rows:(band + 1) * self.rows].tobytes()
+            for gid in self._buckets[band].get(key, ()):
+                if gid in seen:
+                    continue
+                seen.add(gid)
+                sim = float(np.mean(self._sigs[gid] == sig))
+                if sim >= best_sim:
+                    best, best_sim = gid, sim
+        return best
+
+    def add(self, text: str, url: str = "") -> int:
+        """Record text (seen at url); returns its group id. Exact repeats skip hashing."""
+        tkey = sha1(text)
+        with self._lock:
+            gid = self._by_text.get(tkey)
+        if gid is None:
+            sig = self.signature(text)
+            with self._lock:
+                gid = self._by_text.get(tkey)
+                if gid is None:
+                    gid = self._match(sig)
+                    if gid is None:
+                        gid = len(self._sigs)
+                        self._sigs.append(sig)
+                        self._urls.append([])
+                        for band in range(self.bands):
+                            key = sig[band * self.rows:(band + 1) * self.rows].tobytes()
+                            self._buckets[band].setdefault(key, []).append(gid)
+                    self._by_text[tkey] = gid
+        if url:
+            with self._lock:
+                if url not in self._urls[gid]:
+                    self._urls[gid].append(url)
+        return gid
+
+    def urls(self, gid: int) -> List[str]:
+        with self._lock:
+            return list(self._urls[gid])
+
+    def collapse(self, items: List[Dict], key: str = "chunk") -> List[Dict]:
+        """
+        Keep the first item of each near-duplicate group (pass items best-first). Kept items
+        are copies with "urls": every URL the group was seen at, the item's own URL first.
+        """
+        # add everything first, so a kept item also lists duplicates ranked below it
+        gids = [self.add(it[key], it.get("url", "")) for it in items]
+        out, kept = [], set()
+        for it, gid in zip(items, gids):
+            if gid in kept:
+                continue
+            kept.add(gid)
+            rep = dict(it)
+            urls = self.urls(gid)
+            own = it.get("url")
+            rep["urls"] = ([own] if own else []) + [u for u in urls if u != own]
+            out.append(rep)
+        return out
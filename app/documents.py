@@ -0,0 +1,100 @@
+# app/documents.py
+"""
+Text extraction for non-HTML sources: PDF (via pypdf, optional) and plain text / Markdown.
+
+fetch.py streams documents into the same spooled Body as HTML pages; PDFs are then parsed
+in the extraction pool (extract.py), so a pathological file costs one recycled worker and
+its CPU budget, not the agent. Reading is lazy: pages are extracted one at a time and
+stop at DOC_MAX_PAGES pages or DOC_MAX_CHARS characters, whichever comes first.
+
+Env:
+  FETCH_DOCUMENTS=1        0 = skip PDFs / plain text as before
+  MAX_DOC_BYTES=20000000   download cap for PDFs (HTML and text keep MAX_HTML_BYTES)
+  DOC_MAX_PAGES=30
+  DOC_MAX_CHARS=200000
+  DOC_CPU_SECONDS=30       CPU budget per PDF in the extraction worker
+"""
+import io
+import os
+import re
+from typing import Dict, List, Optional
+
+from .utils import getenv_int, log
+
+MAX_DOC_BYTES = getenv_int("MAX_DOC_BYTES", 20_000_000)
+DOC_MAX_PAGES = getenv_int("DOC_MAX_PAGES", 30)
+DOC_MAX_CHARS = getenv_int("DOC_MAX_CHARS", 200_000)
+DOC_CPU_SECONDS = getenv_int("DOC_CPU_SECONDS", 30)
+
+_HYPHEN_BREAK = re.compile(r"(\w)-\n(\w)")
+_pypdf_ok: Optional[bool] = None
+
+
+def documents_enabled() -> bool:
+    return os.getenv("FETCH_DOCUMENTS", "1") == "1"
+
+
+def pdf_enabled() -> bool:
+    """PDFs are fetched only when FETCH_DOCUMENTS=1 and pypdf is installed."""
+    global _pypdf_ok
+    if not documents_enabled():
+        return False
+    if _pypdf_ok is None:
+        try:
+            import pypdf  # noqa: F401
+            _pypdf_ok = True
+        except ImportError:
+            log("[documents] pypdf not installed; PDFs will be skipped")
+            _pypdf_ok = False
+    return _pypdf_ok
+
+
+def _first_line(text: str, limit: int = 200) -> Optional[str]:
+    for line in text.splitlines():
+        line = line.strip().lstrip("#").strip()
+        if line:
+            return line if len(line) <= limit else None
+    return None
+
+
+def pdf_text(url: str, data: bytes) -> Dict:
+    """PDF bytes -> {"url", "title", "text", "pages"}; reads pages lazily up to the budgets."""
+    from pypdf import PdfReader
+
+    reader = PdfReader(io.BytesIO(data))
+    if reader.is_encrypted:
+        try:
+            reader.decrypt("")  # many "protected" PDFs only restrict printing/copying
+        except Exception:
+            return {"url": url, "title": url, "text": "", "pages": 0}
+
+    parts: List[str] = []
+    chars = 0
+    pages = 0
+    for page in reader.pages:
+        if pages >= DOC_MAX_PAGES or chars >= DOC_MAX_CHARS:
+            break
+        pages += 1
+        try:
+            text = page.extract_text() or ""
+        except Exception:
+            continue  # one broken content stream shouldn't lose the whole document
+        text = _HYPHEN_BREAK.sub(r"\1\2", text).strip()
+        if text:
+            parts.append(text[: DOC_MAX_CHARS - chars])
+            chars += len(parts[-1])
+
+    text = "\n\n".join(parts)
+    title = None
+    try:
+        title = (reader.metadata or {}).get("/Title")
+    except Exception:
+        pass
+    title = str(title).strip() if title else None
+    return {"url": url, "title": title or _first_line(text) or url, "text": text, "pages": pages}
+
+
+def plain_text(url: str, text: str) -> Dict:
+    """Plain text / Markdown -> {"url", "title", "text"}, capped at DOC_MAX_CHARS."""
+    text = (text or "")[:DOC_MAX_CHARS]
+    return {"url": url, "title": _first_line(text) or url, "text": text}
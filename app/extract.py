@@ -0,0 +1,314 @@
+# app/extract.py
+"""
+HTML -> text extraction (trafilatura), run in a process pool off the request threads.
+
+- HTML is handed to workers through shared memory instead of being pickled into the task.
+- Workers are recycled after EXTRACT_TASKS_PER_CHILD documents (lxml/trafilatura leak on
+  pathological pages) and each document gets EXTRACT_CPU_SECONDS of CPU time. The limit
+  raises ExtractionTimeout, a BaseException so trafilatura's `except Exception` fallbacks
+  can't swallow it; a worker that keeps running EXTRACT_CPU_GRACE seconds past it exits.
+  A hard RLIMIT_CPU (the worker's whole lifetime budget) stays set as the kernel backstop
+  for time spent in C code, where the signal handler can't run.
+- A document still unfinished at the parent's wall-clock timeout gets its worker killed:
+  the pool is swapped for a fresh one and the old one is terminated once its other
+  documents are done.
+- At most EXTRACT_QUEUE_BYTES of HTML is queued or in flight; callers block beyond that.
+- The HTML is parsed once; the fallback extractor reuses the parsed tree.
+- PDFs (documents.pdf_text) run in the same pool with DOC_CPU_SECONDS; plain text is
+  cheap and handled inline.
+
+Env:
+  EXTRACT_WORKERS=2            0 = extract inline in the calling thread
+  EXTRACT_TASKS_PER_CHILD=50
+  EXTRACT_CPU_SECONDS=10
+  EXTRACT_CPU_GRACE=2
+  EXTRACT_QUEUE_BYTES=16000000
+"""
+import atexit
+import copy
+import multiprocessing as mp
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Dict, Optional, Set
+
+import trafilatura
+
+from .documents import DOC_CPU_SECONDS, pdf_text, plain_text
+from .utils import getenv_int, log
+
+try:
+    import resource
+except ImportError:  # not available on Windows: no per-document CPU limit there
+    resource = None
+
+EXTRACT_WORKERS = getenv_int("EXTRACT_WORKERS", 2)
+EXTRACT_TASKS_PER_CHILD = getenv_int("EXTRACT_TASKS_PER_CHILD", 50)
+EXTRACT_CPU_SECONDS = getenv_int("EXTRACT_CPU_SECONDS", 10)
+EXTRACT_CPU_GRACE = getenv_int("EXTRACT_CPU_GRACE", 2)
+EXTRACT_QUEUE_BYTES = getenv_int("EXTRACT_QUEUE_BYTES", 16_000_000)
+
+
+class ExtractionTimeout(BaseException):
+    """CPU budget exhausted (worker side; not an Exception, so catch-alls let it through)."""
+
+
+def _as_dict(doc) -> Optional[Dict]:
+    # trafilatura < 2 returns a dict, >= 2 a Document
+    if doc is None:
+        return None
+    return doc.as_dict() if hasattr(doc, "as_dict") else doc
+
+
+def _bare_extraction(tree, url: str):
+    kwargs = dict(url=url, include_comments=False, favor_recall=True)
+    try:
+        # trafilatura >= 2 skips metadata (title) unless asked
+        return trafilatura.bare_extraction(tree, with_metadata=True, **kwargs)
+    except TypeError:
+        return trafilatura.bare_extraction(tree, **kwargs)
+
+
+def extract_text(url: str, html) -> Dict:
+    """Run trafilatura over HTML (str or bytes) -> {"url", "title", "text"}."""
+    data = None
+    try:
+        tree = trafilatura.load_html(html)
+    except Exception:
+        tree = None
+    if tree is None:
+        return {"url": url, "title": url, "text": ""}
+
+    try:
+        # bare_extraction prunes the tree it is given; keep the original for the fallback
+        meta = _as_dict(_bare_extraction(copy.deepcopy(tree), url))
+        if meta:
+            data = {
+                "url": url,
+                "title": (meta.get("title") or url),
+                "text": (meta.get("text") or "")
+            }
+    except Exception:
+        data = None
+
+    if not data or not data.get("text"):
+        try:
+            text = trafilatura.extract(tree, include_comments=False) or ""
+        except Exception:
+            text = ""
+        data = {"url": url, "title": (data or {}).get("title") or url, "text": text}
+    return data
+
+
+# ---- worker side ----
+
+_task = {"seconds": 0, "overruns": 0}  # current document's budget, SIGXCPUs received for it
+
+
+def _on_cpu_limit(signum, frame):
+    _task["overruns"] += 1
+    if _task["overruns"] > 1:
+        # the timeout was swallowed and the document kept going: give up this worker
+        os._exit(70)
+    _cpu_budget(EXTRACT_CPU_GRACE)  # SIGXCPU again if it's still running after the grace
+    raise ExtractionTimeout(f"extraction exceeded {_task['seconds']}s CPU")
+
+
+def _cpu_used() -> float:
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return ru.ru_utime + ru.ru_stime
+
+
+def _worker_init():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent handles Ctrl-C
+    if resource is not None:
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+        # hard limit = every document's budget plus grace; the kernel kills the worker past it
+        per_doc = max(EXTRACT_CPU_SECONDS, DOC_CPU_SECONDS) + EXTRACT_CPU_GRACE + 1
+        hard = int(_cpu_used()) + 1 + max(1, EXTRACT_TASKS_PER_CHILD) * per_doc
+        _, cur = resource.getrlimit(resource.RLIMIT_CPU)
+        if cur != resource.RLIM_INFINITY:
+            hard = min(hard, cur)
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+
+def _cpu_budget(seconds: Optional[int]):
+    """Set the soft RLIMIT_CPU to `seconds` from now (None = up to the hard limit); the hard limit is untouched."""
+    if resource is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if seconds is None:
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+        return
+    soft = int(_cpu_used()) + 1 + seconds
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _cpu_seconds(kind: str) -> int:
+    return DOC_CPU_SECONDS if kind == "pdf" else EXTRACT_CPU_SECONDS
+
+
+def _run_shared(shm_name: str, size: int, url: str, kind: str = "html") -> Dict:
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    _task["seconds"], _task["overruns"] = _cpu_seconds(kind), 0
+    _cpu_budget(_task["seconds"])
+    try:
+        if kind == "pdf":
+            return pdf_text(url, data)
+        # HTML is always UTF-8 here (see extract); decode so a stale <meta charset> can't mislead lxml
+        return extract_text(url, data.decode("utf-8", errors="ignore"))
+    except ExtractionTimeout as e:
+        raise TimeoutError(str(e)) from None  # an ordinary exception for the parent
+    finally:
+        _cpu_budget(None)
+
+
+# ---- parent side ----
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_budget = threading.Condition()
+_in_flight = 0
+_running: Dict[ProcessPoolExecutor, Set] = {}  # pool -> its unfinished futures
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            methods = mp.get_all_start_methods()
+            ctx = mp.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pool = ProcessPoolExecutor(
+                max_workers=EXTRACT_WORKERS,
+                mp_context=ctx,
+                initializer=_worker_init,
+                max_tasks_per_child=EXTRACT_TASKS_PER_CHILD,
+            )
+        return _pool
+
+
+def _reset_pool(broken: ProcessPoolExecutor):
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+        _running.pop(broken, None)
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit(pool: ProcessPoolExecutor, *args):
+    fut = pool.submit(_run_shared, *args)
+    with _pool_lock:
+        _running.setdefault(pool, set()).add(fut)
+
+    def done(f):
+        with _pool_lock:
+            _running.get(pool, set()).discard(f)
+
+    fut.add_done_callback(done)
+    return fut
+
+
+def _retire(pool: ProcessPoolExecutor, stuck, wait_s: float):
+    """
+    Replace pool and kill its workers, the stuck one included, once the other documents
+    it is running have finished (or wait_s has passed).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+        others = [f for f in _running.get(pool, ()) if f is not stuck]
+
+    def reap():
+        wait(others, timeout=wait_s)
+        # no public API stops a busy worker: kill the processes, then drop the pool
+        for proc in list((getattr(pool, "_processes", None) or {}).values()):
+            proc.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+        with _pool_lock:
+            _running.pop(pool, None)
+
+    threading.Thread(target=reap, name="extract-reaper", daemon=True).start()
+
+
+@atexit.register
+def _shutdown():
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _reserve(n: int):
+    global _in_flight
+    with _budget:
+        # an oversized document may still go alone once nothing else is queued
+        while _in_flight and _in_flight + n > EXTRACT_QUEUE_BYTES:
+            _budget.wait()
+        _in_flight += n
+
+
+def _release(n: int):
+    global _in_flight
+    with _budget:
+        _in_flight -= n
+        _budget.notify_all()
+
+
+def extract(url: str, html, kind: str = "html") -> Dict:
+    """
+    Extract in the process pool (inline when EXTRACT_WORKERS=0). html may be str, bytes or a
+    readinto()-capable body (fetch.Body) holding UTF-8 bytes, which is copied straight
+    into shared memory. kind is "html", "pdf" (raw PDF bytes) or "text".
+    """
+    if kind == "text":
+        data = html.read() if hasattr(html, "readinto") else html
+        return plain_text(url, data.decode("utf-8", errors="ignore") if isinstance(data, bytes) else data)
+    if hasattr(html, "readinto"):
+        size = len(html)
+        if EXTRACT_WORKERS <= 0:
+            if kind == "pdf":
+                return pdf_text(url, html.read())
+            return extract_text(url, html.read().decode("utf-8", errors="ignore"))
+    else:
+        if EXTRACT_WORKERS <= 0:
+            return pdf_text(url, html) if kind == "pdf" else extract_text(url, html)
+        html = html.encode("utf-8") if isinstance(html, str) else html
+        size = len(html)
+    if not size:
+        return {"url": url, "title": url, "text": ""}
+
+    _reserve(size)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        if hasattr(html, "readinto"):
+            html.readinto(shm.buf)
+        else:
+            shm.buf[:size] = html
+        pool = _get_pool()
+        limit = _cpu_seconds(kind) * 3 + 30
+        try:
+            fut = _submit(pool, shm.name, size, url, kind)
+            return fut.result(timeout=limit)
+        except FutureTimeout:
+            if fut.done():  # the worker's own TimeoutError (CPU limit), not ours
+                raise
+            log(f"[extract] {url} still running after {limit}s; killing its worker")
+            _retire(pool, fut, limit)
+            raise TimeoutError(f"extraction of {url} timed out after {limit}s") from None
+        except BrokenProcessPool:
+            log(f"[extract] worker died on {url}; restarting pool")
+            _reset_pool(pool)
+            raise
+    finally:
+        shm.close()
+        shm.unlink()
+        _release(size)
@@ -1,13 +1,56 @@
+import asyncio
+import codecs
+import hashlib
 import os
-import requests, trafilatura
-from typing import Dict
-from .utils import log, sha1, load_cache, save_cache
+import re
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from .utils import log, sha1, load_cache, save_cache, getenv_int, domain
+from . import background, httpclient, singleflight, trace
+from .extract import extract
+from .documents import MAX_DOC_BYTES, documents_enabled, pdf_enabled
+from .ratelimit import Gate
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (compatible; ResearchAgent/1.0; +https://example.org/bot)"
 }
 
 MAX_HTML_BYTES = int(os.getenv("MAX_HTML_BYTES", "1500000"))  # ~1.5 MB cap
+FETCH_WORKERS = getenv_int("FETCH_WORKERS", 6)            # concurrent downloads per call
+FETCH_PER_HOST = getenv_int("FETCH_PER_HOST", 2)          # concurrent downloads per domain
+FETCH_DEADLINE = float(os.getenv("FETCH_DEADLINE", "60")) # seconds per fetch stage
+FETCH_SPOOL_BYTES = getenv_int("FETCH_SPOOL_BYTES", 262144)  # page bytes kept in RAM before spilling to disk
+SNIFF_BYTES = 4096                                           # bytes inspected for charset / body type
+# How long a cached page is served without asking the site again (seconds).
+# PAGE_FRESHNESS_DOMAINS overrides per domain, e.g. "reuters.com=3600,wikipedia.org=604800".
+PAGE_FRESHNESS = getenv_int("PAGE_FRESHNESS", 86400)
+
+def _freshness_overrides() -> Dict[str, int]:
+    out = {}
+    for part in os.getenv("PAGE_FRESHNESS_DOMAINS", "").split(","):
+        name, _, secs = part.strip().partition("=")
+        try:
+            out[name.strip().lower()] = int(secs)
+        except ValueError:
+            continue
+    return out
+
+_FRESHNESS_DOMAINS = _freshness_overrides()
+
+def freshness_for(url: str) -> int:
+    d = domain(url).lower().split(":")[0]
+    for name, secs in _FRESHNESS_DOMAINS.items():
+        if d == name or d.endswith("." + name):
+            return secs
+    return PAGE_FRESHNESS
+
+def _is_fresh(page: Dict) -> bool:
+    fetched_at = page.get("fetched_at")
+    if fetched_at is None:
+        return True  # legacy entry without HTTP metadata: kept until the cache TTL drops it
+    return time.time() - fetched_at < freshness_for(page.get("url", ""))
 
 def _is_html(content_type: str) -> bool:
     if not content_type:
@@ -15,63 +58,382 @@ def _is_html(content_type: str) -> bool:
     ct = content_type.lower()
     return ("text/html" in ct) or ("application/xhtml+xml" in ct)
 
-def _download_capped(url: str) -> str:
-    with requests.get(url, headers=HEADERS, timeout=45, stream=True) as r:
-        r.raise_for_status()
-        if not _is_html(r.headers.get("Content-Type", "")):
-            raise ValueError(f"Non-HTML content-type: {r.headers.get('Content-Type','')}")
-        clen = r.headers.get("Content-Length")
-        if clen:
+def _kind_for(content_type: str, url: str) -> Optional[str]:
+    """"html", "pdf" or "text" for a response, or None when it should be skipped."""
+    if _is_html(content_type):
+        return "html"
+    ct = content_type.lower()
+    path = url.lower().split("?", 1)[0]
+    if "application/pdf" in ct or ("application/octet-stream" in ct and path.endswith(".pdf")):
+        return "pdf" if pdf_enabled() else None
+    if ("text/plain" in ct or "text/markdown" in ct) and documents_enabled():
+        return "text"
+    return None
+
+class Body:
+    """
+    Downloaded page in a spooled temp file: held in memory up to FETCH_SPOOL_BYTES, on disk
+    beyond that. HTML and text are stored as UTF-8 (`sha1` is the hash of the decoded text);
+    PDFs (kind "pdf") are stored as raw bytes.
+    """
+
+    def __init__(self, kind: str = "html"):
+        self._f = tempfile.SpooledTemporaryFile(max_size=FETCH_SPOOL_BYTES)
+        self._h = hashlib.sha1()
+        self.size = 0
+        self.kind = kind
+
+    def write(self, data: bytes):
+        if data:
+            self._f.write(data)
+            self._h.update(data)
+            self.size += len(data)
+
+    @property
+    def sha1(self) -> str:
+        return self._h.hexdigest()
+
+    def __len__(self):
+        return self.size
+
+    def readinto(self, buf) -> int:
+        """Copy the body straight into a writable buffer (e.g. shared memory)."""
+        self._f.seek(0)
+        view = memoryview(buf)[: self.size]
+        got = 0
+        while got < self.size:
+            n = self._f.readinto(view[got:])
+            if not n:
+                break
+            got += n
+        return got
+
+    def read(self) -> bytes:
+        self._f.seek(0)
+        return self._f.read()
+
+    def text(self) -> str:
+        return self.read().decode("utf-8")
+
+    def close(self):
+        self._f.close()
+
+_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF32_LE, "utf-32"),  # before UTF-16 LE, whose BOM is its prefix
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+_META_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([A-Za-z0-9._:-]+)""", re.I)
+_CT_CHARSET = re.compile(r"charset\s*=\s*[\"']?([A-Za-z0-9._:-]+)", re.I)
+# bodies that are clearly not HTML whatever the Content-Type says
+_BINARY_MAGIC = (b"%PDF", b"PK\x03\x04", b"\x89PNG", b"GIF8", b"\xff\xd8\xff", b"\x1f\x8b", b"RIFF", b"OggS", b"ID3", b"\x00\x00")
+
+def _sniff_charset(content_type: str, head: bytes) -> str:
+    """
+    BOM, then the Content-Type charset, then <meta charset> in the first bytes, then UTF-8
+    (the WHATWG order: a stale <meta> doesn't override the header).
+    """
+    for bom, enc in _BOMS:
+        if head.startswith(bom):
+            return enc
+    for m, from_meta in ((_CT_CHARSET.search(content_type or ""), False), (_META_CHARSET.search(head), True)):
+        if m:
+            name = m.group(1).decode("ascii", "ignore") if isinstance(m.group(1), bytes) else m.group(1)
             try:
-                if int(clen) > MAX_HTML_BYTES:
-                    raise ValueError(f"Content too large: {clen} bytes")
-            except Exception:
-                pass
-        buf = bytearray()
-        for chunk in r.iter_content(chunk_size=65536):
-            if not chunk:
+                enc = codecs.lookup(name).name
+            except LookupError:
                 continue
-            buf.extend(chunk)
-            if len(buf) > MAX_HTML_BYTES:
-                raise ValueError(f"Content exceeded cap ({MAX_HTML_BYTES} bytes)")
-        enc = r.encoding or "utf-8"
+            # bytes we could read the <meta> from as ASCII can't be UTF-16
+            return "utf-8" if from_meta and enc.startswith("utf-16") else enc
+    return "utf-8"
+
+def _wide_encoding(content_type: str, head: bytes) -> bool:
+    """True for text in UTF-16/32 (by BOM or Content-Type charset), where NUL bytes are normal."""
+    return _sniff_charset(content_type, head).startswith(("utf-16", "utf-32"))
+
+def _check_body(head: bytes, content_type: str, kind: str) -> str:
+    """Check the first bytes against the expected kind; returns the kind to use (mislabelled PDFs)."""
+    if kind != "pdf" and _wide_encoding(content_type, head):
+        return kind  # the binary sniff below reads bytes as ASCII; UTF-16/32 text would fail it
+    stripped = head.lstrip()
+    if stripped.startswith(b"%PDF") and kind != "pdf" and pdf_enabled():
+        return "pdf"
+    if kind == "pdf":
+        if not stripped.startswith(b"%PDF"):
+            raise ValueError(f"Body is not a PDF (content-type {content_type or '(none)'})")
+        return kind
+    if stripped.startswith(_BINARY_MAGIC) or b"\x00" in head[:1024]:
+        raise ValueError(f"Non-HTML body behind content-type {content_type or '(none)'}")
+    if kind == "html" and head and b"<" not in head:
+        raise ValueError(f"No markup in first {len(head)} bytes (content-type {content_type or '(none)'})")
+    return kind
+
+def _transcoder(kind: str, content_type: str, head: bytes):
+    """bytes -> UTF-8 bytes, decoding incrementally with the sniffed charset; PDFs pass through."""
+    if kind == "pdf":
+        return lambda data, final=False: data
+    decoder = codecs.getincrementaldecoder(_sniff_charset(content_type, head))(errors="ignore")
+    return lambda data, final=False: decoder.decode(data, final).encode("utf-8")
+
+def _request_headers(validators: Optional[Dict]) -> Dict:
+    headers = dict(HEADERS)
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+class _BodyReader:
+    """
+    Feeds a response into a Body chunk by chunk: enforces the size cap, sniffs kind and
+    charset from the first SNIFF_BYTES and transcodes the rest (shared by sync and async).
+    """
+
+    def __init__(self, url: str, status: int, headers):
+        self.meta = {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+        self.ctype = headers.get("Content-Type", "")
+        self.kind = None
+        if status == 304:
+            return
+        self.kind = _kind_for(self.ctype, url)
+        if self.kind is None:
+            raise ValueError(f"Unsupported content-type: {self.ctype}")
+        self.cap = MAX_DOC_BYTES if self.kind == "pdf" else MAX_HTML_BYTES
+        clen = headers.get("Content-Length")
+        if clen and clen.isdigit() and int(clen) > self.cap:
+            raise ValueError(f"Content too large: {clen} bytes")
+        self.body = Body(self.kind)
+        self.head = b""
+        self.transcode = None
+        self.received = 0
+
+    def feed(self, chunk: bytes):
+        if not chunk:
+            return
+        self.received += len(chunk)
+        trace.add("bytes", len(chunk))
+        if self.received > self.cap:
+            raise ValueError(f"Content exceeded cap ({self.cap} bytes)")
+        if self.transcode is None:
+            self.head += chunk
+            if len(self.head) < SNIFF_BYTES:
+                return
+            chunk, self.head = self.head, b""
+            self._start(chunk)
+        self.body.write(self.transcode(chunk))
+
+    def _start(self, head: bytes):
+        self.body.kind = _check_body(head, self.ctype, self.kind)
+        if self.body.kind == "pdf":
+            self.cap = MAX_DOC_BYTES
+        self.transcode = _transcoder(self.body.kind, self.ctype, head)
+
+    def finish(self) -> Body:
+        if self.transcode is None:  # short body: everything is still in head
+            self._start(self.head)
+        self.body.write(self.transcode(self.head, final=True))
+        return self.body
+
+async def _download_capped_async(url: str, validators: Optional[Dict] = None) -> Tuple[Optional[Body], Dict]:
+    """
+    Stream HTML or plain text (capped at MAX_HTML_BYTES) into a Body, decoding incrementally
+    with a charset sniffed from the first SNIFF_BYTES; PDFs (capped at MAX_DOC_BYTES) are
+    kept as raw bytes. Bodies that don't match their content type abort early.
+    With validators ({"etag", "last_modified"}) the request is conditional; a 304 returns
+    (None, meta). meta holds the response's validators.
+    """
+    headers = _request_headers(validators)
+    async with httpclient.astream("GET", url, headers=headers, timeout=httpclient.async_timeout(45)) as r:
+        if r.status_code != 304:
+            r.raise_for_status()
+        reader = _BodyReader(url, r.status_code, r.headers)
+        if reader.kind is None:
+            return None, reader.meta
         try:
-            return buf.decode(enc, errors="ignore")
-        except Exception:
-            return buf.decode("utf-8", errors="ignore")
+            async for chunk in r.aiter_bytes(65536):
+                reader.feed(chunk)
+            return reader.finish(), reader.meta
+        except BaseException:
+            reader.body.close()
+            raise
 
-def fetch_and_extract(url: str) -> Dict:
-    key = f"page_{sha1(url)}"
-    cached = load_cache(key)
-    if cached:
-        return cached
+def _page_key(url: str) -> str:
+    return f"page_{sha1(url)}"
 
-    log(f"[fetch] {url}")
-    html = _download_capped(url)
+def load_page(url: str) -> Optional[Dict]:
+    """Cached extraction for url, if any."""
+    return load_cache(_page_key(url))
 
-    data = None
+def extract_page(url: str, body) -> Dict:
+    """
+    Extract a downloaded page (HTML str or Body of any kind) -> {"url", "title", "text"},
+    in the extraction pool. A Body is closed afterwards.
+    """
+    kind = getattr(body, "kind", "html")
     try:
-        meta = trafilatura.bare_extraction(
-            html,
-            url=url,
-            include_comments=False,
-            favor_recall=True
-        )
-        if meta:
-            data = {
-                "url": url,
-                "title": (meta.get("title") or url),
-                "text": (meta.get("text") or "")
-            }
-    except Exception:
-        data = None
-
-    if not data or not data.get("text"):
-        try:
-            text = trafilatura.extract(html, include_comments=False) or ""
-        except Exception:
-            text = ""
-        data = {"url": url, "title": url, "text": text}
+        with trace.span("extract", url=url, kind=kind):
+            return extract(url, body, kind=kind)
+    finally:
+        if isinstance(body, Body):
+            body.close()
 
-    save_cache(key, data)
+def save_page(url: str, data: Dict):
+    save_cache(_page_key(url), data)
+
+def _after_download(url: str, cached: Optional[Dict], body: Optional[Body], meta: Dict):
+    now = time.time()
+    if body is None and not cached:
+        raise ValueError("304 Not Modified without a cached copy")
+    if body is None or (cached and cached.get("content_hash") == body.sha1):
+        # 304 / same bytes: skip download (or extraction) and just refresh the metadata
+        if body is not None:
+            body.close()
+        cached.update({k: v for k, v in meta.items() if v})
+        cached["fetched_at"] = now
+        save_page(url, cached)
+        return cached, None
+    meta["fetched_at"] = now
+    meta["content_hash"] = body.sha1
+    meta["kind"] = body.kind
+    return None, (body, meta)
+
+async def download_page_async(url: str) -> Tuple[Optional[Dict], Optional[Tuple[Body, Dict]]]:
+    """
+    Network half of fetch_and_extract, honouring the freshness policy.
+    Returns (page, None) when the cached page is still usable: fresh, revalidated with a
+    304, or re-downloaded with an unchanged content hash. Otherwise returns
+    (None, (body, meta)) for extract_page + store_page.
+    """
+    cached = load_page(url)
+    if cached and _is_fresh(cached):
+        return cached, None
+    log(f"[fetch] {url}" + (" (revalidate)" if cached else ""))
+    body, meta = await _download_capped_async(url, validators=cached)
+    return _after_download(url, cached, body, meta)
+
+def store_page(url: str, data: Dict, meta: Dict) -> Dict:
+    """Attach HTTP metadata (validators, fetch time, content hash) and cache the extraction."""
+    data.update(meta)
+    save_page(url, data)
     return data
+
+# concurrent fetches of one URL (threads, coroutines, and with SINGLEFLIGHT_DIR processes) share one download
+_inflight = singleflight.Group("fetch", processes=True)
+
+def fetch_and_extract(url: str) -> Dict:
+    """Blocking fetch_and_extract_async (runs on the background loop, see background.py)."""
+    return background.run(lambda: fetch_and_extract_async(url))
+
+async def fetch_and_extract_async(url: str) -> Dict:
+    """Download (on the event loop) and extract (in a thread) one page; concurrent calls for a URL share the work."""
+    return await _inflight.do(url, lambda: _fetch_and_extract_async(url))
+
+async def _fetch_and_extract_async(url: str) -> Dict:
+    with trace.span("fetch.page", url=url):
+        page, pending = await download_page_async(url)
+        if page is not None:
+            return page
+        body, meta = pending
+        return await asyncio.to_thread(lambda: store_page(url, extract_page(url, body), meta))
+
+def skip_reason(e: BaseException) -> str:
+    """Short label for why a page was dropped (trace counter skipped.<reason>)."""
+    msg = str(e)
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status:
+        return f"http_{status}"
+    if isinstance(e, ValueError):
+        if msg.startswith("Unsupported content-type"):
+            return "content_type"
+        if msg.startswith(("Content too large", "Content exceeded")):
+            return "too_large"
+        return "bad_body"
+    if isinstance(e, TimeoutError) or "timeout" in type(e).__name__.lower():
+        return "timeout"
+    return "error"
+
+class HostLimiter:
+    """Caps concurrent work per domain (one Gate per netloc, created lazily; threads or coroutines)."""
+
+    def __init__(self, per_host: int):
+        self.per_host = max(1, per_host)
+        self._gates: Dict[str, Gate] = {}
+        self._lock = threading.Lock()
+
+    def slot(self, url: str) -> Gate:
+        d = domain(url)
+        with self._lock:
+            gate = self._gates.get(d)
+            if gate is None:
+                gate = self._gates[d] = Gate(self.per_host)
+        return gate
+
+async def fetch_many_async(
+    urls: List[str],
+    limit: int = 8,
+    workers: Optional[int] = None,
+    per_host: Optional[int] = None,
+    deadline: Optional[float] = None,
+) -> List[Tuple[str, Dict]]:
+    """
+    Fetch & extract URLs concurrently; returns (url, page) for pages with text, in input (rank) order.
+    At most `workers` downloads are in flight (`per_host` per domain). Once `limit` pages are in
+    hand it waits only for downloads ranked above the worst of them, so the result is the
+    `limit` best-ranked pages with text. If `deadline` seconds pass first, the result is the
+    best-ranked of the pages that had finished by then, which depends on download speed;
+    remaining downloads are cancelled either way.
+    """
+    workers = max(1, workers or FETCH_WORKERS)
+    limiter = HostLimiter(per_host or FETCH_PER_HOST)
+    deadline_at = time.monotonic() + (FETCH_DEADLINE if deadline is None else deadline)
+
+    async def task(url: str) -> Dict:
+        async with limiter.slot(url):
+            return await fetch_and_extract_async(url)
+
+    todo = iter(enumerate(urls))
+    pending = {}
+    got: Dict[int, Tuple[str, Dict]] = {}
+    try:
+        while True:
+            if len(got) >= limit:
+                worst = sorted(got)[limit - 1]
+                for fut, (i, _) in list(pending.items()):
+                    if i > worst:  # can't make the cut any more
+                        fut.cancel()
+                        del pending[fut]
+            else:
+                while len(pending) < workers:
+                    nxt = next(todo, None)
+                    if nxt is None:
+                        break
+                    i, url = nxt
+                    pending[asyncio.ensure_future(task(url))] = (i, url)
+            if not pending:
+                break
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                log(f"[fetch] deadline reached; abandoning {len(pending)} in-flight page(s)")
+                trace.skip("deadline", len(pending))
+                break
+            finished, _ = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for fut in finished:
+                i, url = pending.pop(fut)
+                try:
+                    page = fut.result()
+                except Exception as e:
+                    log(f"[fetch-error] {url} :: {e}")
+                    trace.skip(skip_reason(e))
+                    continue
+                if page.get("text"):
+                    got[i] = (url, page)
+                else:
+                    trace.skip("no_text")
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+    return [got[i] for i in sorted(got)][:limit]
@@ -0,0 +1,161 @@
+# app/httpclient.py
+"""
+Process-wide HTTP client for every outbound call in app/.
+
+Each event loop gets one httpx.AsyncClient (async_client(); httpx pools are bound to the
+loop that created them), reached through arequest / astream. Its pool keeps keep-alive
+connections per host, so repeat calls to serpapi.com / api.tavily.com / the same site skip
+TCP+TLS setup. No cookies are kept. gzip/deflate are always accepted, brotli when the
+`brotli` package is installed; HTTP/2 is used when the `h2` package is installed. The
+OpenAI SDK gets its own AsyncClient per loop (httpx_async_client()) with the same limits.
+Blocking callers reach all of this through background.py's loop.
+
+Every client follows its requests through httpcore's trace events and counts, per host,
+requests, new connections and requests sent on a kept-alive connection (stats()); the
+last two also go to the current trace span as http.connections / http.reused.
+
+With RECORD / REPLAY set, every client here goes through replay.py's hooks.
+
+Env:
+  HTTP_POOL_HOSTS=32       hosts with a live connection pool
+  HTTP_POOL_PER_HOST=8     keep-alive connections per host
+  HTTP_CONNECT_TIMEOUT=5   seconds
+  HTTP_READ_TIMEOUT=30     seconds (default; callers may pass their own)
+  OPENAI_TIMEOUT=600       seconds per OpenAI call
+"""
+import asyncio
+import os
+import threading
+import weakref
+from http.cookiejar import DefaultCookiePolicy
+from typing import Dict, Optional
+
+from . import replay, trace
+from .utils import domain, getenv_int
+
+HTTP_POOL_HOSTS = getenv_int("HTTP_POOL_HOSTS", 32)
+HTTP_POOL_PER_HOST = getenv_int("HTTP_POOL_PER_HOST", 8)
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+
+
+def _has(module: str) -> bool:
+    try:
+        __import__(module)
+        return True
+    except Exception:
+        return False
+
+
+ACCEPT_ENCODING = "gzip, deflate" + (", br" if (_has("brotli") or _has("brotlicffi")) else "")
+
+_lock = threading.Lock()
+_hosts: Dict[str, Dict[str, int]] = {}
+_async_clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _bump(host: str, counter: str):
+    with _lock:
+        h = _hosts.get(host)
+        if h is None:
+            h = _hosts[host] = {"requests": 0, "connections": 0, "reused": 0}
+        h[counter] += 1
+
+
+async def _on_request(request):
+    """httpx request hook (every hop): count it and watch which connection it goes out on."""
+    host = domain(str(request.url))
+    _bump(host, "requests")
+    opened = False
+
+    async def events(name: str, info: Dict):
+        nonlocal opened
+        if name == "connection.connect_tcp.complete":
+            opened = True
+            _bump(host, "connections")
+            trace.add("http.connections")
+        elif name.endswith(".send_request_headers.started") and not opened:
+            _bump(host, "reused")
+            trace.add("http.reused")
+
+    request.extensions["trace"] = events
+
+
+def stats() -> Dict:
+    """
+    Since start, over every client here: {"requests", "connections" (new TCP connections),
+    "reused" (requests sent on a kept-alive connection), "per_host": {host: same keys}}.
+    Replayed requests open no connection and count as neither.
+    """
+    with _lock:
+        per_host = {host: dict(h) for host, h in _hosts.items()}
+    totals = {k: sum(h[k] for h in per_host.values()) for k in ("requests", "connections", "reused")}
+    return {**totals, "per_host": per_host}
+
+
+def _httpx_limits():
+    import httpx
+    return httpx.Limits(max_connections=HTTP_POOL_HOSTS * HTTP_POOL_PER_HOST, max_keepalive_connections=HTTP_POOL_PER_HOST * 4)
+
+
+def _httpx_transport() -> Dict:
+    """transport= kwargs for an httpx client: the replay hook when recording or replaying."""
+    if not replay.active():
+        return {}
+    import httpx
+    return {"transport": replay.AsyncTransport(httpx.AsyncHTTPTransport(http2=_has("h2"), limits=_httpx_limits()))}
+
+
+def async_client():
+    """Shared httpx.AsyncClient for the running event loop (no cookies, same pool limits)."""
+    import httpx
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            http2=_has("h2"),
+            headers={"Accept-Encoding": ACCEPT_ENCODING},
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=_httpx_limits(),
+            follow_redirects=True,
+            event_hooks={"request": [_on_request]},
+            **_httpx_transport(),
+        )
+        client.cookies.jar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        _async_clients[loop] = client
+    return client
+
+
+def async_timeout(read: Optional[float] = None):
+    import httpx
+    return httpx.Timeout(HTTP_READ_TIMEOUT if read is None else read, connect=HTTP_CONNECT_TIMEOUT)
+
+
+async def arequest(method: str, url: str, **kwargs):
+    kwargs.setdefault("timeout", async_timeout())
+    return await async_client().request(method, url, **kwargs)
+
+
+def astream(method: str, url: str, **kwargs):
+    """`async with astream("GET", url) as r:` streaming counterpart of arequest."""
+    kwargs.setdefault("timeout", async_timeout())
+    return async_client().stream(method, url, **kwargs)
+
+
+async def aclose():
+    """Close the running loop's AsyncClient (call before the loop ends)."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def httpx_async_client():
+    """Fresh httpx.AsyncClient for AsyncOpenAI (one per event loop, see llm._aclient)."""
+    import httpx
+    return httpx.AsyncClient(
+        http2=_has("h2"),
+        timeout=httpx.Timeout(float(os.getenv("OPENAI_TIMEOUT", "600")), connect=HTTP_CONNECT_TIMEOUT),
+        limits=_httpx_limits(),
+        event_hooks={"request": [_on_request]},
+        **_httpx_transport(),
+    )
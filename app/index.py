@@ -0,0 +1,341 @@
+# app/index.py
+"""
+Incremental BM25 index shared by every page fetched in a run (and, optionally, across runs).
+
+Chunks from all pages land in one inverted index, so IDF comes from the whole corpus and
+scores are comparable across pages. Pages are keyed by URL + content hash: re-adding an
+unchanged page is a no-op, a changed page replaces its old chunks.
+
+With BM25_PERSIST=1 the shared index is written back when it has changed, at most every
+BM25_FLUSH_INTERVAL seconds and once more at exit. Processes sharing the file take turns
+under a lock file, and each save merges in the pages other processes have saved since.
+
+Env:
+  BM25_STEM=1              light suffix stemming in the tokenizer
+  BM25_PERSIST=0           1 = load/save the shared index at .cache/bm25_index.jz
+  BM25_MAX_DOCS=50000      oldest pages are dropped once the index holds more chunks
+  BM25_FLUSH_INTERVAL=60   seconds between saves of the shared index
+"""
+import atexit
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .utils import CACHE_DIR, getenv_int, log, sha1
+
+try:
+    import fcntl
+except ImportError:  # Windows: saves are atomic but not serialized between processes
+    fcntl = None
+
+_TOKEN = re.compile(r"[^\W_]+", re.UNICODE)
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were "
+    "what which who will with how why when".split()
+)
+
+
+def _stem(tok: str) -> str:
+    """Tiny suffix stripper (plural/-ing/-ed); enough to match 'emissions' with 'emission'."""
+    if len(tok) <= 4 or tok.isdigit():
+        return tok
+    for suf, rep in (("ies", "y"), ("sses", "ss"), ("ing", ""), ("ed", ""), ("es", ""), ("s", "")):
+        if tok.endswith(suf) and len(tok) - len(suf) >= 3:
+            if suf == "s" and tok.endswith("ss"):
+                return tok
+            return tok[: -len(suf)] + rep
+    return tok
+
+
+def tokenize(text: str, stem: Optional[bool] = None) -> List[str]:
+    """Lowercase, strip punctuation, drop stopwords, optionally stem."""
+    if stem is None:
+        stem = os.getenv("BM25_STEM", "1") == "1"
+    toks = [t for t in _TOKEN.findall((text or "").lower()) if t not in _STOPWORDS]
+    return [_stem(t) for t in toks] if stem else toks
+
+
+class BM25Index:
+    """Okapi BM25 over an inverted index that grows one page at a time."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, max_docs: int = 0):
+        self.k1, self.b = k1, b
+        self.max_docs = max_docs
+        self.docs: Dict[int, Dict] = {}                 # doc id -> {"chunk", "url", "title", "len", "terms"}
+        self.postings: Dict[str, Dict[int, int]] = {}   # term -> {doc id: tf}
+        self.pages: "OrderedDict[str, Tuple[str, List[int]]]" = OrderedDict()  # url -> (hash, doc ids)
+        self.total_len = 0
+        self.version = 0  # bumped by every change; lets callers skip saving an unchanged index
+        self._next_id = 0
+        self._disk = None  # (mtime_ns, size) of the file last loaded or saved
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def has_page(self, url: str, content_hash: Optional[str] = None) -> bool:
+        with self._lock:
+            entry = self.pages.get(url)
+            return entry is not None and (content_hash is None or entry[0] == content_hash)
+
+    def add_page(
+        self,
+        url: str,
+        title: str,
+        chunks: Iterable[str],
+        content_hash: Optional[str] = None,
+        spans: Optional[List[Tuple[int, int]]] = None,
+    ) -> List[int]:
+        """
+        Index a page's chunks; unchanged pages (same hash) are skipped. Returns the page's doc ids.
+        spans: optional (start, end) offsets of each chunk in the page's normalized text.
+        """
+        chunks = list(chunks)
+        content_hash = content_hash or sha1("\n".join(chunks))
+        with self._lock:
+            entry = self.pages.get(url)
+            if entry is not None:
+                if entry[0] == content_hash:
+                    self.pages.move_to_end(url)
+                    return list(entry[1])
+                self.remove_page(url)
+            ids = []
+            for i, chunk in enumerate(chunks):
+                tf = Counter(tokenize(chunk))
+                doc_id = self._next_id
+                self._next_id += 1
+                n = sum(tf.values())
+                self.docs[doc_id] = {"chunk": chunk, "url": url, "title": title, "len": n, "terms": list(tf)}
+                if spans is not None:
+                    self.docs[doc_id]["span"] = tuple(spans[i])
+                self.total_len += n
+                for term, cnt in tf.items():
+                    self.postings.setdefault(term, {})[doc_id] = cnt
+                ids.append(doc_id)
+            self.pages[url] = (content_hash, ids)
+            self.version += 1
+            while self.max_docs and len(self.docs) > self.max_docs and len(self.pages) > 1:
+                self.remove_page(next(iter(self.pages)))
+            return ids
+
+    def remove_page(self, url: str):
+        with self._lock:
+            entry = self.pages.pop(url, None)
+            if entry is None:
+                return
+            self.version += 1
+            for doc_id in entry[1]:
+                doc = self.docs.pop(doc_id, None)
+                if doc is None:
+                    continue
+                self.total_len -= doc["len"]
+                for term in doc["terms"]:
+                    plist = self.postings.get(term)
+                    if plist is not None:
+                        plist.pop(doc_id, None)
+                        if not plist:
+                            del self.postings[term]
+
+    def _idf(self, term: str) -> float:
+        n = len(self.postings.get(term, ()))
+        N = len(self.docs)
+        return math.log(1.0 + (N - n + 0.5) / (n + 0.5))  # Lucene-style, never negative
+
+    def query(
+        self,
+        query: str,
+        topn: int = 24,
+        urls: Optional[Set[str]] = None,
+        per_url: Optional[int] = None,
+    ) -> List[Dict]:
+        """
+        Top chunks for `query` as {"chunk", "url", "title", "score"} (+ "start"/"end" when the
+        page was indexed with spans), best first.
+        urls restricts candidates to those pages; per_url caps chunks per page.
+        """
+        with self._lock:
+            if not self.docs:
+                return []
+            avgdl = self.total_len / max(1, len(self.docs))
+            scores: Dict[int, float] = {}
+            for term in set(tokenize(query)):
+                plist = self.postings.get(term)
+                if not plist:
+                    continue
+                idf = self._idf(term)
+                for doc_id, tf in plist.items():
+                    doc = self.docs[doc_id]
+                    if urls is not None and doc["url"] not in urls:
+                        continue
+                    denom = tf + self.k1 * (1 - self.b + self.b * doc["len"] / avgdl)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / denom
+
+            ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+            out, per = [], Counter()
+            for doc_id, score in ranked:
+                doc = self.docs[doc_id]
+                if per_url and per[doc["url"]] >= per_url:
+                    continue
+                per[doc["url"]] += 1
+                hit = {"chunk": doc["chunk"], "url": doc["url"], "title": doc["title"], "score": float(score)}
+                if "span" in doc:
+                    hit["start"], hit["end"] = doc["span"]
+                out.append(hit)
+                if len(out) >= topn:
+                    break
+            return out
+
+    def save(self, path: str):
+        """
+        Write the index to path atomically. Under path + ".lock", pages another process saved
+        there since this index last read or wrote the file are merged in first (while there's
+        room under max_docs), so concurrent writers don't drop each other's pages.
+        """
+        with _file_lock(path + ".lock"):
+            self._merge_from(path)
+            with self._lock:
+                state = {
+                    "k1": self.k1,
+                    "b": self.b,
+                    "pages": [
+                        [url, h, [[self.docs[i]["chunk"], self.docs[i]["title"], self.docs[i].get("span")] for i in ids]]
+                        for url, (h, ids) in self.pages.items()
+                    ],
+                }
+            data = zlib.compress(json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+            # a unique temp file per writer in the same directory, so os.replace stays atomic
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + ".", suffix=".tmp"
+            )
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+                raise
+            self._disk = _stat(path)
+
+    def _merge_from(self, path: str):
+        """Add the pages saved at path that this index lacks (if the file changed since we saw it)."""
+        disk = _stat(path)
+        if disk is None or disk == self._disk:
+            return
+        try:
+            other = _read_state(path)
+        except Exception as e:
+            log(f"[bm25] not merging unreadable index {path}: {e}")
+            return
+        for url, h, docs in other.get("pages", []):
+            if self.has_page(url) or (self.max_docs and len(self.docs) + len(docs) > self.max_docs):
+                continue
+            self._add_saved(url, h, docs)
+
+    def _add_saved(self, url: str, h: str, docs: list):
+        title = docs[0][1] if docs else url
+        spans = [d[2] for d in docs] if docs and all(len(d) > 2 and d[2] for d in docs) else None
+        self.add_page(url, title, [d[0] for d in docs], content_hash=h, spans=spans)
+
+    @classmethod
+    def load(cls, path: str, max_docs: int = 0) -> "BM25Index":
+        disk = _stat(path)
+        state = _read_state(path)
+        idx = cls(k1=state.get("k1", 1.5), b=state.get("b", 0.75), max_docs=max_docs)
+        for url, h, docs in state.get("pages", []):
+            idx._add_saved(url, h, docs)
+        idx._disk = disk
+        return idx
+
+
+def _read_state(path: str) -> Dict:
+    with open(path, "rb") as f:
+        return json.loads(zlib.decompress(f.read()).decode("utf-8"))
+
+
+def _stat(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Exclusive lock file held for the with-block (no-op without fcntl)."""
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # releases the lock
+
+
+INDEX_PATH = os.path.join(CACHE_DIR, "bm25_index.jz")
+_shared: Optional[BM25Index] = None
+_shared_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_flushed = 0        # _shared.version at the last save (or load)
+_flushed_at = 0.0   # monotonic time of the last save
+
+
+def _persist() -> bool:
+    return os.getenv("BM25_PERSIST", "0") == "1"
+
+
+def shared_index() -> BM25Index:
+    """Process-wide index (loaded from disk when BM25_PERSIST=1)."""
+    global _shared, _flushed
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                max_docs = getenv_int("BM25_MAX_DOCS", 50000)
+                idx = None
+                if _persist() and os.path.exists(INDEX_PATH):
+                    try:
+                        idx = BM25Index.load(INDEX_PATH, max_docs=max_docs)
+                        log(f"[bm25] loaded {len(idx.pages)} page(s), {len(idx)} chunk(s)")
+                    except Exception as e:
+                        log(f"[bm25] could not load index: {e}")
+                _shared = idx or BM25Index(max_docs=max_docs)
+                _flushed = _shared.version
+    return _shared
+
+
+def flush_shared_index(force: bool = False):
+    """
+    Write the shared index to disk if persistence is on and it changed since the last save,
+    at most every BM25_FLUSH_INTERVAL seconds (force=True skips the wait; used at exit).
+    """
+    global _flushed, _flushed_at
+    if not (_persist() and _shared is not None):
+        return
+    with _flush_lock:
+        version = _shared.version
+        if version == _flushed:
+            return
+        if not force and time.monotonic() - _flushed_at < getenv_int("BM25_FLUSH_INTERVAL", 60):
+            return
+        try:
+            _shared.save(INDEX_PATH)
+        except Exception as e:
+            log(f"[bm25] could not save index: {e}")
+            return
+        _flushed, _flushed_at = version, time.monotonic()
+
+
+atexit.register(flush_shared_index, force=True)
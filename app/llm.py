@@ -1,45 +1,213 @@
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
+import asyncio
+import base64
 import json
-from .utils import getenv_str, log
-from openai import OpenAI
+import os
+import weakref
+import numpy as np
+from .utils import getenv_int, log, sha1, load_cache, save_cache
+from .cache import LRU
+from .ratelimit import acall, limiter
+from .tokens import count_tokens
+from .synth import format_sources
+from . import background, httpclient, replay, singleflight, trace
+from openai import AsyncOpenAI
 
-def _client():
-    api_key = getenv_str("OPENAI_API_KEY")
+EMBED_BATCH = getenv_int("EMBED_BATCH", 256)              # max inputs per embeddings request
+EMBED_BATCH_CHARS = getenv_int("EMBED_BATCH_CHARS", 400000)  # ~100k tokens per request
+
+_emb_mem = LRU(getenv_int("EMBED_MEM_ITEMS", 8192))
+_aclients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_emb_inflight = singleflight.Group("embed")
+CHAT_OUTPUT_TOKENS = getenv_int("CHAT_OUTPUT_TOKENS", 600)  # completion tokens reserved per chat call
+
+def _api_key() -> str:
+    api_key = replay.api_key("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY not set")
-    return OpenAI(api_key=api_key)
+    return api_key
+
+def _aclient() -> AsyncOpenAI:
+    """AsyncOpenAI client for the running event loop (its connection pool is loop-bound)."""
+    loop = asyncio.get_running_loop()
+    client = _aclients.get(loop)
+    if client is None:
+        # retries are done by ratelimit.acall, which also shares Retry-After across callers
+        client = _aclients[loop] = AsyncOpenAI(
+            api_key=_api_key(), http_client=httpclient.httpx_async_client(), max_retries=0
+        )
+    return client
+
+async def aclose():
+    """Close the running loop's AsyncOpenAI client (call before the loop ends)."""
+    client = _aclients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+def _emb_key(model: str, text: str) -> str:
+    return f"emb_{sha1(model + '|' + text)}"
 
-def embed_texts(texts: list[str], model: str = "text-embedding-3-small") -> list[list[float]]:
+def _load_embedding(key: str):
+    vec = _emb_mem.get(key)
+    if vec is not None:
+        return vec
+    cached = load_cache(key)
+    if not cached:
+        return None
+    vec = np.frombuffer(base64.b64decode(cached["v"]), dtype=np.float32)
+    _emb_mem.put(key, vec)
+    return vec
+
+def _store_embedding(key: str, vec: np.ndarray):
+    vec.setflags(write=False)  # shared between callers via the LRU
+    _emb_mem.put(key, vec)
+    save_cache(key, {"v": base64.b64encode(vec.tobytes()).decode("ascii")})
+
+def _batches(texts: List[str]):
+    batch, chars = [], 0
+    for t in texts:
+        if batch and (len(batch) >= EMBED_BATCH or chars + len(t) > EMBED_BATCH_CHARS):
+            yield batch
+            batch, chars = [], 0
+        batch.append(t)
+        chars += len(t)
+    if batch:
+        yield batch
+
+async def aembed_texts(texts: List[str], model: str = "text-embedding-3-small") -> np.ndarray:
     """
-    Returns a list of embedding vectors (one per text).
+    Returns a float32 matrix with one embedding row per text.
     Uses OpenAI's text-embedding-3-small for low cost.
+    Vectors are cached by (model, text hash) in memory and in the cache store, so only
+    texts never seen before are sent, de-duplicated and split into provider-sized batches.
+    Texts another thread or coroutine is already embedding are waited for, not re-sent;
+    the remaining batches are requested concurrently.
     """
-    client = _client()
-    resp = client.embeddings.create(model=model, input=texts)
-    return [d.embedding for d in resp.data]
-
-
-def _chat(model: str, system: str, user: str, response_format: str = "json_object", temperature: float = 0.2) -> str:
-    client = _client()
-    resp = client.chat.completions.create(
-        model=model,
-        temperature=temperature,
-        response_format={"type": response_format},
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ]
-    )
-    return resp.choices[0].message.content
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    with trace.span("llm.embed", model=model, texts=len(texts)):
+        keys, found, missing = _embed_lookup(texts, model)
+        while missing:
+            flights, claims = _emb_inflight.partition(missing, lambda t: _emb_key(model, t), _batches)
+            if claims:
+                client = _aclient()
+                lim = limiter("openai", model)
+                for b, flight in claims:
+                    flights.append(_emb_inflight.start(flight, lambda b=b: _aembed_batch(client, lim, b, model)))
+            for out in await asyncio.gather(*(f.wait() for f in flights), return_exceptions=True):
+                if isinstance(out, singleflight.Abandoned):
+                    continue
+                if isinstance(out, BaseException):
+                    raise out
+                found.update(out)
+            missing = [t for t in missing if found.get(_emb_key(model, t)) is None]
+        return np.vstack([found[k] for k in keys])
 
-def plan_queries(question: str, model: str) -> List[str]:
+def embed_texts(texts: List[str], model: str = "text-embedding-3-small") -> np.ndarray:
+    """Blocking aembed_texts (runs on the background loop, see background.py)."""
+    return background.run(lambda: aembed_texts(texts, model))
+
+async def _aembed_batch(client, lim, batch: List[str], model: str) -> Dict:
+    """One embeddings request -> {key: vector} (stored in the caches)."""
+    resp = await acall(lim, lambda: client.embeddings.create(model=model, input=batch),
+                       tokens=_batch_tokens(batch), what=f"embeddings:{model}")
+    trace.usage(model, resp)
+    vecs: Dict = {}
+    _embed_store(batch, resp, model, vecs)
+    return vecs
+
+def _batch_tokens(batch: List[str]) -> int:
+    return sum(len(t) for t in batch) // 4  # estimate; exact counts aren't worth tokenizing 100k tokens
+
+def _embed_lookup(texts: List[str], model: str) -> Tuple[List[str], Dict, List[str]]:
+    """-> (key per text, {key: cached vector or None}, unique texts still to embed)"""
+    keys = [_emb_key(model, t) for t in texts]
+    found = {k: _load_embedding(k) for k in set(keys)}
+    missing = list(dict.fromkeys(t for t, k in zip(texts, keys) if found[k] is None))
+    return keys, found, missing
+
+def _embed_store(batch: List[str], resp, model: str, found: Dict):
+    for t, d in zip(batch, resp.data):
+        vec = np.asarray(d.embedding, dtype=np.float32)
+        k = _emb_key(model, t)
+        _store_embedding(k, vec)
+        found[k] = vec
+
+
+def _messages(system: str, user: str) -> List[Dict]:
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
+
+def _chat_tokens(model: str, system: str, user: str) -> int:
+    """Tokens reserved against the model's TPM budget: prompt (tiktoken) + expected completion."""
+    return count_tokens(system, model) + count_tokens(user, model) + CHAT_OUTPUT_TOKENS
+
+# Chat responses are cached by the exact request under "llm_<hash>" (namespace "llm": TTL
+# CACHE_TTL_LLM, byte cap CACHE_MAX_BYTES_LLM, hit/miss counters in get_cache().stats()).
+# Sampling with temperature > 0 is not deterministic, so those calls bypass the cache unless
+# LLM_CACHE_NONZERO=1 (useful for reruns and evaluations). LLM_CACHE=0 turns it off.
+
+def _chat_key(model: str, system: str, user: str, response_format: str, temperature: float) -> Optional[str]:
+    """Cache key for a chat request, or None when it must not be cached."""
+    if os.getenv("LLM_CACHE", "1") != "1":
+        return None
+    if temperature > 0 and os.getenv("LLM_CACHE_NONZERO", "0") != "1":
+        return None
+    raw = json.dumps([model, system, user, response_format, temperature], ensure_ascii=False)
+    return f"llm_{sha1(raw)}"
+
+def _chat_cached(key: Optional[str]) -> Optional[str]:
+    hit = load_cache(key) if key else None
+    return hit.get("content") if hit else None
+
+def _chat_store(key: Optional[str], response_format: str, content: Optional[str]):
+    if not key or not content:
+        return
+    if response_format == "json_object":
+        try:
+            json.loads(content)
+        except Exception:
+            return  # don't pin a malformed reply; the next call gets a fresh try
+    save_cache(key, {"content": content})
+
+async def _achat(model: str, system: str, user: str, response_format: str = "json_object", temperature: float = 0.2) -> str:
+    with trace.span("llm.chat", model=model, temperature=temperature):
+        key = _chat_key(model, system, user, response_format, temperature)
+        cached = _chat_cached(key)
+        if cached is not None:
+            return cached
+        client = _aclient()
+        resp = await acall(
+            limiter("openai", model),
+            lambda: client.chat.completions.create(
+                model=model,
+                temperature=temperature,
+                response_format={"type": response_format},
+                messages=_messages(system, user),
+            ),
+            tokens=_chat_tokens(model, system, user),
+            what=f"chat:{model}",
+        )
+        trace.usage(model, resp)
+        content = resp.choices[0].message.content
+        _chat_store(key, response_format, content)
+        return content
+
+# Each LLM step is a prompt builder + a parser around one _achat call; the sync names
+# (plan_queries, ...) run the async one on the background loop.
+
+def _plan_prompt(question: str) -> Tuple[str, str]:
     system = "You create diverse, high-coverage web search queries in English."
     user = f"""User question:
 {question}
 
 Produce 4-8 diverse search queries covering subtopics, synonyms, and contrasting views.
 Return JSON: {{"queries": ["...", "..."]}}"""
-    out = _chat(model, system, user, "json_object", temperature=0.2)
+    return system, user
+
+def _parse_plan(out: str, question: str) -> List[str]:
     try:
         data = json.loads(out)
         queries = data.get("queries", [])
@@ -48,13 +216,17 @@ Return JSON: {{"queries": ["...", "..."]}}"""
         log(f"[plan_queries] parse error: {e}; raw: {out}")
         return [question]
 
-def synthesize_answer(question: str, sources: List[dict], model: str) -> Dict[str, Any]:
+async def aplan_queries(question: str, model: str) -> List[str]:
+    out = await _achat(model, *_plan_prompt(question), "json_object", temperature=0.2)
+    return _parse_plan(out, question)
+
+def plan_queries(question: str, model: str) -> List[str]:
+    """Blocking aplan_queries (runs on the background loop)."""
+    return background.run(lambda: aplan_queries(question, model))
+
+def _synth_prompt(question: str, sources: List[dict], max_snippet_chars: Optional[int]) -> Tuple[str, str]:
     system = "You write concise, neutral, well-cited syntheses using only provided sources."
-    src_lines = []
-    for s in sources:
-        sid = s.get("id"); url = s.get("url"); snip = s.get("snippet","")[:1200]
-        src_lines.append(f"[{sid}] {url}\n{snip}")
-    src_block = "\n\n".join(src_lines)
+    src_block = format_sources(sources, max_snippet_chars)
 
     user = f"""Question: {question}
 
@@ -65,7 +237,9 @@ SOURCES:
 
 Return JSON:
 {{"answer":"...", "citations":[{{"id":"S1","url":"...","title":"..."}}, ...]}}"""
-    out = _chat(model, system, user, "json_object", temperature=0.4)
+    return system, user
+
+def _parse_synth(out: str) -> Dict[str, Any]:
     try:
         data = json.loads(out)
         return data
@@ -73,7 +247,16 @@ Return JSON:
         log(f"[synthesize_answer] parse error: {e}; raw: {out}")
         return {"answer": "Failed to synthesize.", "citations": []}
 
-def critique_answer(question: str, answer: str, model: str) -> Dict[str, Any]:
+async def asynthesize_answer(question: str, sources: List[dict], model: str, max_snippet_chars: Optional[int] = 1200) -> Dict[str, Any]:
+    """max_snippet_chars=None keeps snippets whole (use with synth.pack_context, which budgets tokens)."""
+    out = await _achat(model, *_synth_prompt(question, sources, max_snippet_chars), "json_object", temperature=0.4)
+    return _parse_synth(out)
+
+def synthesize_answer(question: str, sources: List[dict], model: str, max_snippet_chars: Optional[int] = 1200) -> Dict[str, Any]:
+    """Blocking asynthesize_answer (runs on the background loop)."""
+    return background.run(lambda: asynthesize_answer(question, sources, model, max_snippet_chars))
+
+def _critique_prompt(question: str, answer: str) -> Tuple[str, str]:
     system = "You critically review answers for coverage, sourcing, contradictions."
     user = f"""Question: {question}
 Answer:
@@ -83,8 +266,18 @@ Answer:
 
 Provide a confidence (0–1), and list gaps (missing subtopics, weak sourcing, contradictions).
 Return JSON: {{"confidence": 0.0, "gaps": ["...", "..."]}}"""
-    out = _chat(model, system, user, "json_object", temperature=0.0)
+    return system, user
+
+def _parse_critique(out: str) -> Dict[str, Any]:
     try:
         return json.loads(out)
     except Exception:
         return {"confidence": 0.5, "gaps": ["Could not parse critique."]}
+
+async def acritique_answer(question: str, answer: str, model: str) -> Dict[str, Any]:
+    out = await _achat(model, *_critique_prompt(question, answer), "json_object", temperature=0.0)
+    return _parse_critique(out)
+
+def critique_answer(question: str, answer: str, model: str) -> Dict[str, Any]:
+    """Blocking acritique_answer (runs on the background loop)."""
+    return background.run(lambda: acritique_answer(question, answer, model))
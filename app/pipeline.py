@@ -0,0 +1,219 @@
+# app/pipeline.py
+"""
+Streaming evidence pipeline: search -> fetch (download + extract) -> rank.
+
+Each stage runs as its own task(s) on the event loop and hands work to the next through a
+bounded asyncio.Queue, so the first page is being extracted while later searches are still
+in flight. Full queues suspend the producer (backpressure). The rank stage stops
+everything once enough high-scoring evidence is in hand; the other stages are cancelled.
+"""
+import asyncio
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .utils import log, domain, getenv_int
+from . import background, trace
+from .search import search_many_async
+from .fetch import (
+    HostLimiter,
+    FETCH_PER_HOST,
+    FETCH_WORKERS,
+    fetch_and_extract_async,
+    skip_reason,
+)
+from .chunk import chunk_with_spans, CHUNK_TOKENS
+from .index import BM25Index, shared_index
+
+PIPELINE_QUEUE = getenv_int("PIPELINE_QUEUE", 8)              # max items waiting per stage
+PIPELINE_MIN_EVIDENCE = getenv_int("PIPELINE_MIN_EVIDENCE", 8)  # strong chunks before early stop
+PIPELINE_MIN_SCORE = float(os.getenv("PIPELINE_MIN_SCORE", "5.0"))  # BM25 score counted as strong
+
+_DONE = object()
+
+
+class StageStats:
+    """Counters for one stage; `busy` is time spent working, `max_depth` the input queue high-water mark."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.max_depth = 0
+
+    def record(self, seconds: float, error: bool = False):
+        self.items += 1
+        self.busy += seconds
+        if error:
+            self.errors += 1
+
+    def depth(self, n: int):
+        self.max_depth = max(self.max_depth, n)
+
+    def as_dict(self) -> Dict:
+        return {
+            "items": self.items,
+            "errors": self.errors,
+            "busy_s": round(self.busy, 3),
+            "max_queue_depth": self.max_depth,
+        }
+
+
+async def _put(q: asyncio.Queue, item, stats: StageStats):
+    await q.put(item)
+    stats.depth(q.qsize())
+
+
+def _rank_page(index: BM25Index, question: str, page: Dict) -> List[Dict]:
+    """Chunk + index a page (unless unchanged) and return its best chunks (CPU-bound)."""
+    url = page.get("url", "")
+    title = page.get("title") or url
+    if not index.has_page(url, page.get("content_hash")):
+        chunks, spans = chunk_with_spans(page["text"], chunk_size=900, overlap=120, max_tokens=CHUNK_TOKENS or None)
+        index.add_page(url, title, chunks, content_hash=page.get("content_hash"), spans=spans)
+    return index.query(question, topn=2, urls={url})
+
+
+def run_pipeline(question: str, queries: List[str], **kwargs) -> Tuple[List[Dict], Dict]:
+    """Blocking run_pipeline_async (runs on the background loop, see background.py)."""
+    return background.run(lambda: run_pipeline_async(question, queries, **kwargs))
+
+
+async def run_pipeline_async(
+    question: str,
+    queries: List[str],
+    k: int = 6,
+    max_pages: int = 8,
+    skip: Optional[Callable[[str], bool]] = None,
+    fetch_workers: Optional[int] = None,
+    deadline: Optional[float] = None,
+    index: Optional[BM25Index] = None,
+) -> Tuple[List[Dict], Dict]:
+    """
+    Stream queries through search/fetch/rank; returns (chunks, stats).
+    chunks use the agent's evidence shape ({"chunk", "url", "score", "title"}).
+    Stops at `max_pages` ranked pages, PIPELINE_MIN_EVIDENCE chunks scoring
+    >= PIPELINE_MIN_SCORE, or `deadline` seconds, whichever comes first.
+    `skip(url)` drops URLs before they are fetched (e.g. PDFs).
+    Ranked pages are added to `index` (default: the shared BM25 index).
+    Pages go through fetch_and_extract_async, so a page another session is already
+    downloading is shared, not fetched twice.
+    """
+    index = index if index is not None else shared_index()
+    fetch_workers = max(1, fetch_workers or FETCH_WORKERS)
+    deadline_at = time.monotonic() + (deadline if deadline is not None else 90.0)
+
+    fetch_q: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE)
+    rank_q: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE)
+    stats = {n: StageStats(n) for n in ("search", "fetch", "rank")}
+    limiter = HostLimiter(FETCH_PER_HOST)
+    left = {"fetch": fetch_workers}
+
+    async def search_one(q: str) -> List[Dict]:
+        t0 = time.monotonic()
+        try:
+            items = await search_many_async([q], k)
+        except Exception as e:
+            stats["search"].record(time.monotonic() - t0, error=True)
+            log(f"[pipeline:search] {e}")
+            return []
+        stats["search"].record(time.monotonic() - t0)
+        return items
+
+    async def search_stage():
+        seen_urls, seen_domains = set(), set()
+        searches = [asyncio.create_task(search_one(q)) for q in queries]
+        try:
+            for next_done in asyncio.as_completed(searches):
+                for it in await next_done:
+                    url = it.get("url") or ""
+                    d = domain(url)
+                    if not url or url in seen_urls or not d or d in seen_domains:
+                        continue
+                    if skip and skip(url):
+                        trace.skip("filtered")
+                        continue
+                    seen_urls.add(url)
+                    seen_domains.add(d)
+                    await _put(fetch_q, it, stats["fetch"])
+        finally:
+            for t in searches:  # after an early stop, outstanding searches are dropped
+                t.cancel()
+        for _ in range(fetch_workers):
+            await _put(fetch_q, _DONE, stats["fetch"])
+
+    async def fetch_stage():
+        while True:
+            it = await fetch_q.get()
+            if it is _DONE:
+                break
+            url = it["url"]
+            t0 = time.monotonic()
+            try:
+                async with limiter.slot(url):
+                    page = await fetch_and_extract_async(url)
+                stats["fetch"].record(time.monotonic() - t0)
+            except Exception as e:
+                stats["fetch"].record(time.monotonic() - t0, error=True)
+                log(f"[fetch-error] {url} :: {e}")
+                trace.skip(skip_reason(e))
+                continue
+            await _put(rank_q, page, stats["rank"])
+        # the last fetch worker ends the rank stage
+        left["fetch"] -= 1
+        if left["fetch"] == 0:
+            await _put(rank_q, _DONE, stats["rank"])
+
+    t_start = time.monotonic()
+    tasks = [asyncio.create_task(search_stage())]
+    tasks += [asyncio.create_task(fetch_stage()) for _ in range(fetch_workers)]
+
+    chunks_out: List[Dict] = []
+    pages, strong = 0, 0
+    reason = "exhausted"
+    try:
+        while True:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                reason = "deadline"
+                break
+            try:
+                page = await asyncio.wait_for(rank_q.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                continue
+            if page is _DONE:
+                break
+            if not page.get("text"):
+                trace.skip("no_text")
+                continue
+            t0 = time.monotonic()
+            for hit in await asyncio.to_thread(_rank_page, index, question, page):
+                chunks_out.append(hit)
+                if hit["score"] >= PIPELINE_MIN_SCORE:
+                    strong += 1
+            stats["rank"].record(time.monotonic() - t0)
+            pages += 1
+            if pages >= max_pages:
+                reason = "page quota"
+                break
+            if strong >= PIPELINE_MIN_EVIDENCE:
+                reason = "enough evidence"
+                break
+    finally:
+        # searches and downloads nobody needs any more are cancelled, not waited for
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    depth = {"fetch": fetch_q.qsize(), "rank": rank_q.qsize()}
+
+    report = {name: st.as_dict() for name, st in stats.items()}
+    report["wall_s"] = round(time.monotonic() - t_start, 3)
+    report["stop_reason"] = reason
+    report["queue_depth"] = depth
+    log(
+        f"[pipeline] {pages} page(s), {len(chunks_out)} chunk(s) in {report['wall_s']}s ({reason}); "
+        + " | ".join(f"{n}: {report[n]['items']} items, busy {report[n]['busy_s']}s, "
+                     f"max q {report[n]['max_queue_depth']}" for n in stats)
+    )
+    return chunks_out, report
@@ -0,0 +1,404 @@
+# app/ratelimit.py
+"""
+Rate limiting and retries for provider calls (OpenAI, SerpAPI, Tavily).
+
+- Gate: concurrency cap whose waiters are served by priority, then arrival. Works as
+  `with gate:` in threads and `async with gate:` in coroutines, with one budget shared
+  across threads and event loops.
+- Token buckets per provider (requests) and per provider+model (requests, LLM tokens).
+  Buckets run on "debt": a call reserves what it needs and sleeps until the bucket has
+  refilled, so callers queue at the quota ceiling instead of failing and retrying.
+  With RATE_LIMIT_STORE the bucket state lives in a SQLite file shared by every process
+  on the machine (concurrency caps stay per process).
+- acall(): run a request under a limiter with jittered exponential retries on
+  429/5xx/connection errors. A 429 pauses every caller of that limiter, not just the
+  one that got it: per model for OpenAI (quotas are per model, so a 429 on one model
+  leaves the others running), per provider for the search engines.
+- priority(): calls made inside `with priority(BATCH):` queue behind interactive ones.
+  Priority only orders the waiters of a Gate, so it works within one process; with
+  RATE_LIMIT_STORE, batch jobs in other processes still draw from the shared buckets
+  on equal terms with interactive callers.
+
+Env:
+  RATE_LIMIT_STORE=              path of a shared SQLite store ("" = per process)
+  RATE_RETRIES=5                 attempts per call
+  RATE_BACKOFF_MAX=30            seconds, cap of the jittered backoff
+  OPENAI_CONCURRENCY=16
+  OPENAI_RPM=500                 per model; OPENAI_RPM_<MODEL> overrides (e.g. OPENAI_RPM_GPT_4O_MINI)
+  OPENAI_TPM=200000              per model; OPENAI_TPM_<MODEL> overrides
+  CHAT_OUTPUT_TOKENS=600         completion tokens assumed when reserving a chat call
+  SERPAPI_CONCURRENCY=4, SERPAPI_RPS=5, TAVILY_CONCURRENCY=4, TAVILY_RPS=5
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional, Tuple
+
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from . import replay
+from .utils import getenv_int, log
+
+INTERACTIVE, BATCH = 0, 1
+_priority: contextvars.ContextVar = contextvars.ContextVar("rate_priority", default=INTERACTIVE)
+
+RATE_RETRIES = max(1, getenv_int("RATE_RETRIES", 5))
+RATE_BACKOFF_MAX = float(os.getenv("RATE_BACKOFF_MAX", "30"))
+
+
+@contextmanager
+def priority(level: int):
+    """Run the block's provider calls at `level` (INTERACTIVE or BATCH)."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class Gate:
+    """Concurrency cap; waiters are served by priority (INTERACTIVE first), then in arrival order."""
+
+    def __init__(self, concurrency: int):
+        self.concurrency = max(1, concurrency)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters = []  # heap of (priority, seq, threading.Event | (loop, future))
+        self._seq = itertools.count()
+
+    def _take_or_queue(self, waiter):
+        """None if a slot was taken, else the queued heap entry."""
+        with self._lock:
+            if self._active < self.concurrency and not self._waiters:
+                self._active += 1
+                return None
+            entry = (_priority.get(), next(self._seq), waiter)
+            heapq.heappush(self._waiters, entry)
+            return entry
+
+    def _release(self):
+        with self._lock:
+            while self._waiters:
+                # hand the slot straight to the next waiter (_active is unchanged)
+                _, _, waiter = heapq.heappop(self._waiters)
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                loop, fut = waiter
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(_grant, fut, self)
+                    return
+            self._active -= 1
+
+    def __enter__(self):
+        ev = threading.Event()
+        if self._take_or_queue(ev) is not None:
+            ev.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self._release()
+        return False
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        entry = self._take_or_queue((loop, fut))
+        if entry is not None:
+            try:
+                await fut
+            except asyncio.CancelledError:
+                with self._lock:
+                    queued = entry in self._waiters
+                    if queued:
+                        self._waiters.remove(entry)
+                        heapq.heapify(self._waiters)
+                # the slot was handed over just as we were cancelled (a cancelled future
+                # is released by _grant instead)
+                if not queued and fut.done() and not fut.cancelled():
+                    self._release()
+                raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self._release()
+        return False
+
+
+def _grant(fut: asyncio.Future, gate: Gate):
+    if fut.cancelled():
+        gate._release()  # waiter gave up after the slot was handed over
+    elif not fut.done():
+        fut.set_result(True)
+
+
+# ---- bucket stores ----
+
+class LocalStore:
+    """Bucket state for this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state: Dict[str, Tuple[float, float, float]] = {}  # key -> (tokens, updated, blocked_until)
+
+    def reserve(self, key: str, amount: float, rate: float, capacity: float) -> float:
+        with self._lock:
+            now = time.time()
+            state = self._state.get(key)
+            tokens, wait, new = _take(state, now, amount, rate, capacity)
+            self._state[key] = new
+            return wait
+
+    def block(self, key: str, seconds: float):
+        with self._lock:
+            tokens, updated, blocked = self._state.get(key, (None, time.time(), 0.0))
+            self._state[key] = (tokens, updated, max(blocked, time.time() + seconds))
+
+
+class SQLiteStore:
+    """Bucket state in a SQLite file, so every process on the machine draws from one budget."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL, updated REAL, blocked_until REAL)"
+            )
+            self._local.conn = c
+        return c
+
+    def _update(self, key: str, fn):
+        c = self._conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            row = c.execute("SELECT tokens, updated, blocked_until FROM buckets WHERE key=?", (key,)).fetchone()
+            result, new = fn(row)
+            c.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)", (key, *new))
+            c.execute("COMMIT")
+            return result
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+
+    def reserve(self, key: str, amount: float, rate: float, capacity: float) -> float:
+        def fn(row):
+            _, wait, new = _take(row, time.time(), amount, rate, capacity)
+            return wait, new
+        return self._update(key, fn)
+
+    def block(self, key: str, seconds: float):
+        def fn(row):
+            tokens, updated, blocked = row or (None, time.time(), 0.0)
+            return None, (tokens, updated, max(blocked or 0.0, time.time() + seconds))
+        self._update(key, fn)
+
+
+def _take(state, now: float, amount: float, rate: float, capacity: float):
+    """Refill, take `amount` (possibly into debt) -> (tokens, seconds to wait, new state)."""
+    tokens, updated, blocked = state or (None, now, 0.0)
+    blocked = blocked or 0.0
+    wait = max(0.0, blocked - now)
+    if rate <= 0:
+        return tokens, wait, (tokens, now, blocked)
+    tokens = capacity if tokens is None else min(capacity, tokens + (now - updated) * rate)
+    tokens -= amount
+    if tokens < 0:
+        wait = max(wait, -tokens / rate)
+    return tokens, wait, (tokens, now, blocked)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                path = os.getenv("RATE_LIMIT_STORE", "")
+                _store = SQLiteStore(path) if path else LocalStore()
+    return _store
+
+
+# ---- limiters ----
+
+class Limiter:
+    """
+    Gate (concurrency, shared per provider) + request bucket + optional token bucket.
+    aslot(tokens) waits for a concurrency slot, then for both buckets.
+    """
+
+    def __init__(self, key: str, gate: Gate, rps: float = 0.0, tps: float = 0.0):
+        self.key = key
+        self.gate = gate
+        self.rps, self.tps = rps, tps
+
+    def _reserve(self, tokens: float) -> float:
+        s = store()
+        # one second of burst; a request larger than that just runs the bucket into debt
+        wait = s.reserve(self.key + ":req", 1, self.rps, max(1.0, self.rps))
+        if self.tps and tokens:
+            wait = max(wait, s.reserve(self.key + ":tok", tokens, self.tps, self.tps))
+        return wait
+
+    def block(self, seconds: float):
+        """Pause every caller of this limiter, i.e. this provider+model (all processes with a shared store)."""
+        store().block(self.key + ":req", seconds)
+
+    @asynccontextmanager
+    async def aslot(self, tokens: float = 0):
+        async with self.gate:
+            wait = self._reserve(tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield
+
+
+def _env_key(s: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", s).upper().strip("_")
+
+
+def _model_env(name: str, model: str, default: float) -> float:
+    v = os.getenv(f"{name}_{_env_key(model)}") if model else None
+    return float(v if v is not None else os.getenv(name, str(default)))
+
+
+_PROVIDERS = {
+    # provider -> (concurrency env, default, per-second requests env, default)
+    "serpapi": ("SERPAPI_CONCURRENCY", 4, "SERPAPI_RPS", 5),
+    "tavily": ("TAVILY_CONCURRENCY", 4, "TAVILY_RPS", 5),
+    "openai": ("OPENAI_CONCURRENCY", 16, None, 0),
+}
+
+_gates: Dict[str, Gate] = {}
+_limiters: Dict[Tuple[str, str], Limiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(provider: str, model: str = "") -> Limiter:
+    """Shared limiter for provider (and model: OpenAI budgets are per model)."""
+    with _limiters_lock:
+        lim = _limiters.get((provider, model))
+        if lim is None:
+            conc_env, conc_default, rps_env, rps_default = _PROVIDERS[provider]
+            gate = _gates.get(provider)
+            if gate is None:
+                gate = _gates[provider] = Gate(getenv_int(conc_env, conc_default))
+            if provider == "openai":
+                rps = _model_env("OPENAI_RPM", model, 500) / 60.0
+                tps = _model_env("OPENAI_TPM", model, 200000) / 60.0
+            else:
+                rps, tps = float(os.getenv(rps_env, str(rps_default))), 0.0
+            key = f"{provider}:{model}" if model else provider
+            lim = _limiters[(provider, model)] = Limiter(key, gate, rps=rps, tps=tps)
+        return lim
+
+
+# ---- retries ----
+
+_RETRY_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+def _status(exc: BaseException) -> Optional[int]:
+    code = getattr(exc, "status_code", None)
+    if code is None:
+        code = getattr(getattr(exc, "response", None), "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds from a Retry-After / retry-after-ms header on the error's response, if any."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms:
+            return float(ms) / 1000.0
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def retryable(exc: BaseException) -> bool:
+    code = _status(exc)
+    if code is not None:
+        return code in _RETRY_STATUS
+    # network-level failures (no response at all)
+    names = {c.__name__ for c in type(exc).__mro__}
+    return bool(names & {"ConnectionError", "Timeout", "TransportError", "TimeoutException",
+                         "APIConnectionError", "APITimeoutError"})
+
+
+_backoff = wait_random_exponential(multiplier=0.5, max=RATE_BACKOFF_MAX)
+
+
+def _wait(state) -> float:
+    if replay.replaying():
+        return 0.0  # recorded failures are replayed in order; nothing to wait for
+    exc = state.outcome.exception()
+    return max(retry_after(exc) or 0.0, _backoff(state))
+
+
+def _on_error(lim: Limiter, exc: BaseException):
+    if _status(exc) == 429:
+        # everyone backs off, not just this caller: no retry storm against the quota
+        lim.block(retry_after(exc) or 1.0)
+
+
+def _before_sleep(what: str):
+    def log_retry(state):
+        exc = state.outcome.exception()
+        log(f"[retry] {what} attempt {state.attempt_number} failed ({type(exc).__name__}: {exc}); "
+            f"retrying in {state.next_action.sleep:.1f}s")
+    return log_retry
+
+
+def _retrying(cls, what: str):
+    return cls(
+        stop=stop_after_attempt(RATE_RETRIES),
+        wait=_wait,
+        retry=retry_if_exception(retryable),
+        before_sleep=_before_sleep(what),
+        reraise=True,
+    )
+
+
+@asynccontextmanager
+async def _no_aslot(tokens: float = 0):
+    yield
+
+
+async def acall(lim: Limiter, fn: Callable, tokens: float = 0, what: str = ""):
+    """await fn() under lim (slot + buckets), retried with jittered backoff on transient errors."""
+    aslot = _no_aslot if replay.replaying() else lim.aslot  # replayed calls cost no quota
+    async for attempt in _retrying(AsyncRetrying, what or lim.key):
+        with attempt:
+            async with aslot(tokens):
+                try:
+                    return await fn()
+                except Exception as e:
+                    _on_error(lim, e)
+                    raise
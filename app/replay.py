@@ -0,0 +1,230 @@
+# app/replay.py
+"""
+Record / replay of every outbound HTTP call (search engines, page downloads, OpenAI).
+
+The hook is an httpx transport under every client httpclient builds (the shared async
+client and the OpenAI SDK's). It sees each request after redirects are split into hops
+and before any decoding.
+
+  RECORD=runs/               calls go out as usual and every response (status, headers,
+                             raw body) is appended to runs/run-<time>-<pid>.jsonl.gz
+                             (or to RECORD itself when it names a file)
+  REPLAY=runs/run-....jsonl.gz  no network: each request is answered from the archive
+
+Requests are matched on method, URL and body with credentials (api_key, token, ...)
+removed, so archives hold no keys and replay needs none. Repeated identical requests
+are answered in recorded order (the last answer repeats once they run out). A request
+missing from the archive fails like a connection error (PIPELINE=1 stops early
+depending on timing, so a replay can reach pages the recording didn't). While replaying, rate limits
+and retry backoff are skipped, so a run goes at CPU speed.
+
+Caches short-circuit calls, so record with an empty cache (and replay with one too, e.g.
+a fresh CACHE_PATH) to re-execute every step.
+
+Env:
+  RECORD=path                 directory or .jsonl.gz file
+  REPLAY=path                 archive written by RECORD
+  RECORD_MAX_BYTES=33554432   bodies are truncated beyond this (above every download cap)
+"""
+import atexit
+import base64
+import gzip
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import httpx
+
+from .utils import getenv_int, getenv_str, log, sha1
+
+RECORD_MAX_BYTES = getenv_int("RECORD_MAX_BYTES", 32 << 20)
+SECRET_FIELDS = {"api_key", "apikey", "key", "token", "access_token", "auth"}
+
+
+class ReplayMiss(Exception):
+    """A request that isn't in the replay archive (handled like a network failure)."""
+
+
+# ---- request identity ----
+
+def _redact_url(url: str) -> str:
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in SECRET_FIELDS]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(sorted(query)), ""))
+
+
+def _redact_body(body: Optional[bytes]) -> bytes:
+    if not body:
+        return b""
+    try:
+        data = json.loads(body)
+    except Exception:
+        return body
+    if isinstance(data, dict):
+        data = {k: v for k, v in data.items() if k.lower() not in SECRET_FIELDS}
+    return json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")
+
+
+def request_key(method: str, url: str, body: Optional[bytes]) -> Tuple[str, str]:
+    """-> (match key, redacted URL)."""
+    url = _redact_url(url)
+    return sha1(f"{method.upper()} {url}\n") + sha1(_redact_body(body).decode("utf-8", "replace")), url
+
+
+# ---- archive ----
+
+class Session:
+    """One archive being written (mode "record") or served (mode "replay"); thread-safe."""
+
+    def __init__(self, mode: str, path: str):
+        self.mode = mode
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, deque] = {}
+        self._last: Dict[str, Dict] = {}
+        self._out = None
+        self.calls = 0
+        self.misses = 0
+        if mode == "replay":
+            self._load()
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._out = gzip.open(path, "at", encoding="utf-8", compresslevel=6)
+            atexit.register(self.close)
+        log(f"[replay] {mode}: {path}")
+
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        rec = json.loads(line)
+                        self._entries.setdefault(rec["key"], deque()).append(rec)
+            except (EOFError, ValueError):  # recording process died mid-write: keep what's complete
+                log(f"[replay] {self.path} is truncated; using the first {sum(map(len, self._entries.values()))} calls")
+
+    def record(self, method: str, url: str, body: Optional[bytes], status: int, reason: str,
+               headers: List[Tuple[str, str]], content: bytes):
+        key, safe_url = request_key(method, url, body)
+        rec = {
+            "key": key,
+            "t": round(time.time(), 3),
+            "method": method.upper(),
+            "url": safe_url,
+            "status": status,
+            "reason": reason,
+            "headers": headers,
+        }
+        try:
+            rec["text"] = content.decode("utf-8")
+        except UnicodeDecodeError:
+            rec["b64"] = base64.b64encode(content).decode("ascii")
+        line = json.dumps(rec, ensure_ascii=False) + "\n"
+        with self._lock:
+            self.calls += 1
+            if self._out is not None:
+                self._out.write(line)
+
+    def take(self, method: str, url: str, body: Optional[bytes]) -> Dict:
+        key, safe_url = request_key(method, url, body)
+        with self._lock:
+            self.calls += 1
+            queue = self._entries.get(key)
+            if queue:
+                rec = self._last[key] = queue.popleft()
+                return rec
+            rec = self._last.get(key)
+            if rec is None:
+                self.misses += 1
+        if rec is None:
+            log(f"[replay] not in archive: {method.upper()} {safe_url}")
+            raise ReplayMiss(f"not in replay archive: {method.upper()} {safe_url}")
+        return rec
+
+    def close(self):
+        with self._lock:
+            if self._out is not None:
+                self._out.close()
+                self._out = None
+
+
+def _content(rec: Dict) -> bytes:
+    return rec["text"].encode("utf-8") if "text" in rec else base64.b64decode(rec.get("b64", ""))
+
+
+_session: Optional[Session] = None
+_session_lock = threading.Lock()
+_configured = False
+
+
+def active() -> Optional[Session]:
+    """The process's record/replay session from RECORD / REPLAY (None when neither is set)."""
+    global _session, _configured
+    if not _configured:
+        with _session_lock:
+            if not _configured:
+                replay, record = getenv_str("REPLAY"), getenv_str("RECORD")
+                if replay:
+                    _session = Session("replay", replay)
+                elif record:
+                    if record.endswith(os.sep) or os.path.isdir(record) or not record.endswith(".gz"):
+                        name = f"run-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl.gz"
+                        record = os.path.join(record, name)
+                    _session = Session("record", record)
+                _configured = True
+    return _session
+
+
+def replaying() -> bool:
+    s = active()
+    return s is not None and s.mode == "replay"
+
+
+def api_key(env: str) -> str:
+    """Provider key from env; a placeholder while replaying (archives are keyless)."""
+    return getenv_str(env) or ("replay" if replaying() else "")
+
+
+# ---- httpx hooks ----
+
+def _httpx_response(rec: Dict, request: httpx.Request) -> httpx.Response:
+    return httpx.Response(rec["status"], headers=rec["headers"], content=_content(rec), request=request)
+
+
+def _httpx_take(request: httpx.Request) -> Dict:
+    try:
+        return active().take(request.method, str(request.url), request.content)
+    except ReplayMiss as e:
+        raise httpx.ConnectError(str(e), request=request) from None
+
+
+class AsyncTransport(httpx.AsyncBaseTransport):
+    def __init__(self, inner: httpx.AsyncBaseTransport):
+        self.inner = inner
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        s = active()
+        if s.mode == "replay":
+            return _httpx_response(_httpx_take(request), request)
+        await request.aread()
+        resp = await self.inner.handle_async_request(request)
+        buf = bytearray()
+        try:
+            async for data in resp.aiter_raw():
+                buf += data
+                if len(buf) >= RECORD_MAX_BYTES:
+                    break
+        finally:
+            await resp.aclose()
+        content = bytes(buf[:RECORD_MAX_BYTES])
+        headers = list(resp.headers.multi_items())
+        s.record(request.method, str(request.url), request.content, resp.status_code,
+                 resp.reason_phrase, headers, content)
+        return httpx.Response(resp.status_code, headers=headers, content=content, request=request)
+
+    async def aclose(self):
+        await self.inner.aclose()
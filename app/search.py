@@ -1,51 +1,78 @@
-import requests, os
-from typing import List, Dict
-from .utils import getenv_str, log, sha1, load_cache, save_cache, dedupe_by_domain
+import asyncio
+from typing import List, Dict, Optional, Tuple
+from .utils import getenv_str, getenv_int, log, sha1, load_cache, save_cache, dedupe_by, dedupe_by_domain
+from .ratelimit import acall, limiter
+from . import background, httpclient, replay, singleflight, trace
 
-SERP_API = "https://serpapi.com/search.json"
-TAVILY_API = "https://api.tavily.com/search"
+# Endpoints are overridable for proxies and the offline benchmark stubs (bench/)
+SERP_API = getenv_str("SERPAPI_URL", "https://serpapi.com/search.json")
+TAVILY_API = getenv_str("TAVILY_URL", "https://api.tavily.com/search")
 
-def _search_serpapi(query: str, k: int) -> List[Dict]:
-    api_key = getenv_str("SERPAPI_KEY")
+SEARCH_WORKERS = getenv_int("SEARCH_WORKERS", 12)  # max query x engine calls in flight
+
+def _serpapi_request(query: str, k: int) -> Optional[Tuple[str, str, Dict]]:
+    api_key = replay.api_key("SERPAPI_KEY")
     if not api_key:
-        return []
+        return None
     params = {"engine": "google", "q": query, "num": k, "api_key": api_key}
-    log(f"[search:serpapi] {query}")
-    r = requests.get(SERP_API, params=params, timeout=30)
-    r.raise_for_status()
-    data = r.json()
+    return "GET", SERP_API, {"params": params}
+
+def _serpapi_parse(data: Dict, k: int) -> List[Dict]:
     organic = data.get("organic_results", [])[:k]
     return [{"title": it.get("title"),
              "url": it.get("link"),
              "snippet": it.get("snippet")} for it in organic if it.get("link")]
 
-def _search_tavily(query: str, k: int) -> List[Dict]:
-    api_key = getenv_str("TAVILY_API_KEY")
+def _tavily_request(query: str, k: int) -> Optional[Tuple[str, str, Dict]]:
+    api_key = replay.api_key("TAVILY_API_KEY")
     if not api_key:
-        return []
-    log(f"[search:tavily] {query}")
-    r = requests.post(TAVILY_API, json={"api_key": api_key, "query": query, "max_results": k}, timeout=30)
-    r.raise_for_status()
-    data = r.json()
+        return None
+    return "POST", TAVILY_API, {"json": {"api_key": api_key, "query": query, "max_results": k}}
+
+def _tavily_parse(data: Dict, k: int) -> List[Dict]:
     results = data.get("results", [])[:k]
     return [{"title": it.get("title"),
              "url": it.get("url"),
              "snippet": it.get("content")} for it in results if it.get("url")]
 
-def search_web(query: str, k: int = 6) -> List[Dict]:
+# Engines in merge order (results from earlier engines win URL ties): (build request, parse JSON).
+# The request builder returns None when the engine has no API key.
+_ENGINES = {
+    "serpapi": (_serpapi_request, _serpapi_parse),
+    "tavily": (_tavily_request, _tavily_parse),
+}
+
+def _engines() -> List[str]:
     engines = getenv_str("SEARCH_ENGINES", "serpapi").split(",")
-    engines = [e.strip().lower() for e in engines if e.strip()]
-    cache_key = f"search_{sha1('|'.join(engines)+query)}_{k}"
-    cached = load_cache(cache_key)
-    if cached:
-        return cached["items"]
-
-    items: List[Dict] = []
-    if "serpapi" in engines:
-        items += _search_serpapi(query, k)
-    if "tavily" in engines:
-        items += _search_tavily(query, k)
+    return [e.strip().lower() for e in engines if e.strip()]
+
+def _cache_key(engines: List[str], query: str, k: int) -> str:
+    return f"search_{sha1('|'.join(engines)+query)}_{k}"
+
+# concurrent runs asking one engine the same query (any thread or loop) share a single request
+_inflight = singleflight.Group("search")
+
+async def _run_engine_async(name: str, query: str, k: int) -> List[Dict]:
+    return await _inflight.do((name, query, k), lambda: _engine_async(name, query, k))
 
+async def _engine_async(name: str, query: str, k: int) -> List[Dict]:
+    build, parse = _ENGINES[name]
+    req = build(query, k)
+    if req is None:
+        return []
+    method, url, kwargs = req
+    log(f"[search:{name}] {query}")
+
+    async def once():
+        r = await httpclient.arequest(method, url, timeout=httpclient.async_timeout(30), **kwargs)
+        r.raise_for_status()
+        trace.add("bytes", len(r.content))
+        return r.json()
+    # SERPAPI_/TAVILY_CONCURRENCY and _RPS, retries and Retry-After: see ratelimit.py
+    with trace.span(f"search.{name}", query=query):
+        return parse(await acall(limiter(name), once, what=f"search:{name}"), k)
+
+def _merge(items: List[Dict]) -> List[Dict]:
     # merge unique by URL, then dedupe by domain for diversity
     seen = set()
     merged = []
@@ -54,7 +81,62 @@ def search_web(query: str, k: int = 6) -> List[Dict]:
         if u and u not in seen:
             seen.add(u)
             merged.append(it)
+    return dedupe_by_domain(merged, key="url")
+
+def search_web(query: str, k: int = 6) -> List[Dict]:
+    """Blocking search_many_async for one query (runs on the background loop, see background.py)."""
+    return background.run(lambda: search_many_async([query], k))
+
+def _plan_search(queries: List[str], k: int):
+    """-> (engines, queries, per-query cached results, uncached (query index, engine) jobs)"""
+    engines = _engines()
+    queries = list(dict.fromkeys(q for q in queries if q))
+    per_query: Dict[int, List[Dict]] = {}
+    jobs = []
+    for qi, q in enumerate(queries):
+        cached = load_cache(_cache_key(engines, q, k))
+        if cached:
+            per_query[qi] = cached["items"]
+            continue
+        jobs += [(qi, name) for name in _ENGINES if name in engines]
+    return engines, queries, per_query, jobs
+
+def _collect_search(engines, queries, per_query, jobs, raw, k: int) -> List[Dict]:
+    """Merge + cache per query (None in raw = that engine failed), then dedupe in query order."""
+    for qi in sorted({qi for qi, _ in jobs}):
+        parts = [raw[(qi, name)] for name in _ENGINES if name in engines]
+        merged = _merge([it for p in parts if p for it in p])
+        if all(p is not None for p in parts):
+            save_cache(_cache_key(engines, queries[qi], k), {"items": merged})
+        per_query[qi] = merged
+
+    out: List[Dict] = []
+    for qi in range(len(queries)):
+        out.extend(per_query.get(qi, []))
+    return dedupe_by(out, key="url")
+
+async def search_many_async(queries: List[str], k: int = 6) -> List[Dict]:
+    """
+    Search every query on the SEARCH_ENGINES: each uncached (query, engine) pair runs
+    concurrently (at most SEARCH_WORKERS at once), bounded per engine by the shared limiters
+    (ratelimit.py). Per-query results are merged by URL and cached; the combined list is
+    deduped by URL in query order, so output does not depend on which call finishes first.
+    A failing engine is logged and skipped (and that query is not cached).
+    """
+    engines, queries, per_query, jobs = _plan_search(queries, k)
+    slots = asyncio.Semaphore(max(1, SEARCH_WORKERS))
+
+    async def one(qi: int, name: str) -> List[Dict]:
+        async with slots:
+            return await _run_engine_async(name, queries[qi], k)
 
-    merged = dedupe_by_domain(merged, key="url")
-    save_cache(cache_key, {"items": merged})
-    return merged
+    outs = await asyncio.gather(*(one(qi, name) for qi, name in jobs), return_exceptions=True)
+    raw: Dict[tuple, Optional[List[Dict]]] = {}
+    for (qi, name), out in zip(jobs, outs):
+        if isinstance(out, BaseException):
+            if isinstance(out, asyncio.CancelledError):
+                raise out
+            log(f"[search-error:{name}] {queries[qi]} :: {out}")
+            out = None
+        raw[(qi, name)] = out
+    return _collect_search(engines, queries, per_query, jobs, raw, k)
@@ -0,0 +1,279 @@
+# app/singleflight.py
+"""
+In-flight request coalescing ("single flight"): concurrent callers asking for the same
+key share one operation instead of each starting their own.
+
+Overlapping research runs (Streamlit sessions, MCP calls, batch.py) often search the same
+query, download the same popular pages and embed the same texts at the same moment, all
+before the first result reaches the cache. The cache serves finished work; this covers
+the window while it is still in flight. Used by fetch (pages), search (engine queries)
+and llm (embeddings), on both the threaded and the async paths.
+
+- One table per process, shared by threads and event loops: a coroutine can wait on a
+  download started by a worker thread and vice versa.
+- The first caller leads: run() executes fn inline; do() runs it as a task on the
+  caller's loop (in the caller's context, so its trace spans and rate-limit priority
+  apply). Later callers get the leader's result or exception.
+- A waiting coroutine that is cancelled only stops waiting; an async leader's task is
+  cancelled once nobody is left waiting on it. Callers still waiting then (e.g. on other
+  loops) start over instead of failing.
+- Optionally across processes (groups created with processes=True, i.e. page fetches):
+  with SINGLEFLIGHT_DIR set the leader also holds an exclusive lock file for the key,
+  so a process that loses the race waits for the winner and then finds its result in
+  the shared cache store. POSIX only (fcntl); lock files are empty and left in place.
+
+Env:
+  SINGLEFLIGHT_DIR=          directory for lock files ("" = coalesce within a process only)
+  SINGLEFLIGHT_WAIT=120      seconds to wait for another process before going ahead anyway
+"""
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional
+
+from . import trace
+from .utils import getenv_int, getenv_str, log, sha1
+
+try:
+    import fcntl
+except ImportError:  # Windows: per-process coalescing only
+    fcntl = None
+
+SINGLEFLIGHT_WAIT = getenv_int("SINGLEFLIGHT_WAIT", 120)
+LOCK_POLL = 0.05
+
+
+class Abandoned(Exception):
+    """The leader's task was cancelled before finishing (waiters start over)."""
+
+
+class Flight:
+    """One in-flight operation; its result is published through a thread-safe future."""
+
+    def __init__(self, group: "Group", keys: Iterable[Hashable]):
+        self.group = group
+        self.keys = list(keys)
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.waiters = 0  # guarded by group._lock
+        self.cancel: Optional[Callable[[], None]] = None  # set for async leaders
+
+    def result(self) -> Any:
+        """Block until the flight settles (threads)."""
+        with self.group._lock:
+            self.waiters += 1
+        try:
+            return self.future.result()
+        finally:
+            with self.group._lock:
+                self.waiters -= 1
+
+    async def wait(self) -> Any:
+        """Await the flight from any event loop."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        def settled(cf):
+            try:
+                loop.call_soon_threadsafe(_copy, cf, fut)
+            except RuntimeError:  # this waiter's loop is gone
+                pass
+
+        with self.group._lock:
+            self.waiters += 1
+        self.future.add_done_callback(settled)
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            with self.group._lock:
+                last = self.waiters == 1 and not self.future.done()
+                if last:
+                    # last one out: nobody wants the result any more
+                    self.group._forget(self)
+            if last and self.cancel is not None:
+                self.cancel()
+            raise
+        finally:
+            with self.group._lock:
+                self.waiters -= 1
+
+
+def _copy(cf: concurrent.futures.Future, fut: asyncio.Future):
+    if fut.done():
+        return
+    exc = cf.exception()
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(cf.result())
+
+
+class Group:
+    """
+    Flights by key; `name` labels the trace counter coalesced.<name>. processes=True adds
+    the SINGLEFLIGHT_DIR lock file around each leader (for work whose result lands in the
+    shared cache store, so the waiting process finds it there).
+    """
+
+    def __init__(self, name: str, processes: bool = False):
+        self.name = name
+        self.processes = processes
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, Flight] = {}
+
+    def _forget(self, flight: Flight):
+        """Drop flight's keys from the table (caller holds _lock)."""
+        for key in flight.keys:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def partition(self, items: Iterable[Any], key: Callable[[Any], Hashable],
+                  batches: Callable[[list], Iterable[list]] = lambda xs: [xs] if xs else []):
+        """
+        Atomically join the flights already producing some items and claim the rest, as
+        new flights per batch -> (joined flights, [(batch, flight)]). The caller must
+        start() or settle() every claimed flight.
+        """
+        items = list(items)
+        joined, mine, claims = [], [], []
+        with self._lock:
+            for it in items:
+                f = self._flights.get(key(it))
+                if f is None:
+                    mine.append(it)
+                elif f not in joined:
+                    joined.append(f)
+            for batch in batches(mine):
+                f = Flight(self, [key(it) for it in batch])
+                for k in f.keys:
+                    self._flights[k] = f
+                claims.append((batch, f))
+        if len(mine) < len(items):
+            trace.add(f"coalesced.{self.name}", len(items) - len(mine))
+        return joined, claims
+
+    def settle(self, flight: Flight, result: Any = None, exc: Optional[BaseException] = None):
+        with self._lock:
+            self._forget(flight)
+        if exc is not None:
+            flight.future.set_exception(exc)
+        else:
+            flight.future.set_result(result)
+
+    def _claim_or_join(self, key: Hashable):
+        """-> (flight, True if the caller leads it)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Flight(self, [key])
+            return flight, True
+
+    # ---- threads ----
+
+    def run(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """fn(), unless the same key is already in flight: then share that result."""
+        while True:
+            flight, lead = self._claim_or_join(key)
+            if lead:
+                try:
+                    with self._process_lock(key):
+                        value = fn()
+                except BaseException as e:
+                    self.settle(flight, exc=e)
+                    raise
+                self.settle(flight, value)
+                return value
+            trace.add(f"coalesced.{self.name}")
+            try:
+                return flight.result()
+            except Abandoned:
+                continue
+
+    # ---- coroutines ----
+
+    def start(self, flight: Flight, fn: Callable[[], Awaitable[Any]]) -> Flight:
+        """Run fn() on this loop as a claimed flight."""
+        loop = asyncio.get_running_loop()
+        task = loop.create_task(self._alead(flight.keys[0], fn))
+        flight.cancel = lambda: loop.call_soon_threadsafe(task.cancel)
+
+        def done(t: asyncio.Task):
+            if t.cancelled():
+                self.settle(flight, exc=Abandoned(self.name))
+            elif t.exception() is not None:
+                self.settle(flight, exc=t.exception())
+            else:
+                self.settle(flight, t.result())
+
+        task.add_done_callback(done)
+        return flight
+
+    async def _alead(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        async with self._aprocess_lock(key):
+            return await fn()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """await fn(), unless the same key is already in flight: then share that result."""
+        while True:
+            flight, lead = self._claim_or_join(key)
+            if lead:
+                self.start(flight, fn)
+            else:
+                trace.add(f"coalesced.{self.name}")
+            try:
+                return await flight.wait()
+            except Abandoned:
+                continue
+
+    # ---- across processes ----
+
+    def _lock_path(self, key: Hashable) -> Optional[str]:
+        root = getenv_str("SINGLEFLIGHT_DIR")
+        if not (self.processes and root and fcntl is not None):
+            return None
+        os.makedirs(root, exist_ok=True)
+        return os.path.join(root, f"{self.name}-{sha1(repr(key))}.lock")
+
+    def _try_lock(self, path: str, fd: int, t0: float) -> bool:
+        """True once fd holds the lock, or once SINGLEFLIGHT_WAIT has passed (go ahead unlocked)."""
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.monotonic() - t0 < SINGLEFLIGHT_WAIT:
+                return False
+            log(f"[singleflight] still locked after {SINGLEFLIGHT_WAIT}s, going ahead: {path}")
+            return True
+
+    @contextmanager
+    def _process_lock(self, key: Hashable):
+        path = self._lock_path(key)
+        if path is None:
+            yield
+            return
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            t0 = time.monotonic()
+            while not self._try_lock(path, fd, t0):
+                time.sleep(LOCK_POLL)
+            yield
+        finally:
+            os.close(fd)  # releases the lock
+
+    @asynccontextmanager
+    async def _aprocess_lock(self, key: Hashable):
+        path = self._lock_path(key)
+        if path is None:
+            yield
+            return
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            t0 = time.monotonic()
+            while not self._try_lock(path, fd, t0):
+                await asyncio.sleep(LOCK_POLL)
+            yield
+        finally:
+            os.close(fd)
@@ -1,5 +1,20 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from .utils import domain
+from .tokens import count_tokens
+from .dedupe import NearDupIndex
+
+SNIPPET_JOINER = "\n…\n"  # between chunks of one source
+SOURCE_JOINER = "\n\n"    # between sources
+
+def source_header(src: Dict) -> str:
+    """A source's first line in the synthesis prompt: id, URL and up to 3 mirrors."""
+    mirrors = [u for u in src.get("urls", []) if u != src["url"]]
+    also = f" (also at: {', '.join(mirrors[:3])})" if mirrors else ""
+    return f"[{src['id']}] {src['url']}{also}\n"
+
+def format_sources(sources: List[Dict], max_snippet_chars: Optional[int] = None) -> str:
+    """The SOURCES block of the synthesis prompt."""
+    return SOURCE_JOINER.join(source_header(s) + s.get("snippet", "")[:max_snippet_chars] for s in sources)
 
 def build_source_snippets(raw_chunks: List[Dict], max_sources: int = 8) -> List[Dict]:
     """Convert chunks -> compact list with IDs and merged snippets per domain for diversity."""
@@ -22,3 +37,90 @@ def build_source_snippets(raw_chunks: List[Dict], max_sources: int = 8) -> List[
         if len(out) >= max_sources:
             break
     return out
+
+def _merge_adjacent(chunks: List[Dict]) -> List[Dict]:
+    """
+    Merge overlapping/touching chunks of one URL (needs start/end offsets; others pass through).
+    Chunks separated by a gap stay apart: the gap's text isn't known here.
+    """
+    with_span = sorted((c for c in chunks if "start" in c), key=lambda c: c["start"])
+    out = [dict(c) for c in chunks if "start" not in c]
+    cur = None
+    for c in with_span:
+        if cur is not None and c["start"] <= cur["end"]:
+            if c["end"] > cur["end"]:
+                cur["chunk"] += c["chunk"][cur["end"] - c["start"]:]
+                cur["end"] = c["end"]
+            cur["score"] = max(cur["score"], c["score"])
+            continue
+        if cur is not None:
+            out.append(cur)
+        cur = dict(c)
+    if cur is not None:
+        out.append(cur)
+    return out
+
+def pack_context(
+    raw_chunks: List[Dict],
+    budget_tokens: int = 3000,
+    model: str = "gpt-4o-mini",
+    dup_threshold: float = 0.8,
+) -> Tuple[List[Dict], int]:
+    """
+    Choose chunks for the synthesis prompt within `budget_tokens` (counted with tiktoken).
+    Adjacent chunks of the same URL are merged, near-duplicates (estimated word 5-gram
+    Jaccard >= dup_threshold) dropped, then chunks are taken greedily by score per token.
+    Chunks from one URL share a source ID; a chunk's other "urls" (mirrors) are kept on
+    the source. Source headers and joiners count against the budget too.
+    Returns (sources, tokens of format_sources(sources)).
+    """
+    by_url: Dict[str, List[Dict]] = {}
+    for ch in raw_chunks:
+        by_url.setdefault(ch["url"], []).append(ch)
+    cands = [c for chunks in by_url.values() for c in _merge_adjacent(chunks)]
+
+    for c in cands:
+        c["tokens"] = count_tokens(c["chunk"], model)
+    cands.sort(key=lambda c: (-(max(c["score"], 0.0) + 1e-6) / max(1, c["tokens"]), -c["score"]))
+
+    joiner = count_tokens(SNIPPET_JOINER, model)
+    separator = count_tokens(SOURCE_JOINER, model)
+    picked_groups = set()
+    dups = NearDupIndex(threshold=dup_threshold)
+    out: List[Dict] = []
+    ids: Dict[str, Dict] = {}
+    used = 0
+    for c in cands:
+        mirrors = [u for u in c.get("urls", []) if u != c["url"]]
+        src = ids.get(c["url"])
+        if src is None:
+            new = {"id": f"S{len(out) + 1}", "url": c["url"], "title": c["title"], "snippet": c["chunk"]}
+            if mirrors:
+                new["urls"] = list(dict.fromkeys([c["url"]] + mirrors))
+            cost = (separator if out else 0) + count_tokens(source_header(new), model) + c["tokens"]
+        else:
+            new = dict(src)
+            if mirrors:
+                new["urls"] = list(dict.fromkeys([c["url"]] + src.get("urls", [])[1:] + mirrors))
+            new["snippet"] = src["snippet"] + SNIPPET_JOINER + c["chunk"]
+            header_delta = count_tokens(source_header(new), model) - count_tokens(source_header(src), model)
+            cost = header_delta + joiner + c["tokens"]
+        if used + cost > budget_tokens:
+            continue
+        gid = dups.add(c["chunk"])
+        if gid in picked_groups:
+            continue
+        picked_groups.add(gid)
+        if src is None:
+            out.append(new)
+            ids[c["url"]] = new
+        else:
+            src.update(new)
+        used += cost
+
+    # the parts were counted separately; the joined block can tokenize a little differently
+    used = count_tokens(format_sources(out), model) if out else 0
+    while used > budget_tokens:
+        out.pop()
+        used = count_tokens(format_sources(out), model) if out else 0
+    return out, used
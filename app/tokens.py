@@ -0,0 +1,50 @@
+# app/tokens.py
+"""Token counting via tiktoken (falls back to ~4 chars/token if the encoding can't be loaded)."""
+import threading
+from typing import List
+
+_encodings = {}
+_lock = threading.Lock()
+
+
+def encoding(model: str = "gpt-4o-mini"):
+    """tiktoken encoding for model (cached), or None when tiktoken/its data is unavailable."""
+    with _lock:
+        if model in _encodings:
+            return _encodings[model]
+        enc = None
+        try:
+            import tiktoken
+            try:
+                enc = tiktoken.encoding_for_model(model)
+            except KeyError:
+                enc = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            enc = None
+        _encodings[model] = enc
+        return enc
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    enc = encoding(model)
+    if enc is None:
+        return (len(text) + 3) // 4
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def token_offsets(text: str, model: str = "gpt-4o-mini") -> List[int]:
+    """Character offset where each token of text starts (approximate without tiktoken)."""
+    enc = encoding(model)
+    if enc is None:
+        return list(range(0, len(text), 4))
+    toks = enc.encode(text, disallowed_special=())
+    try:
+        _, offsets = enc.decode_with_offsets(toks)
+        return offsets
+    except Exception:
+        # multi-byte characters split across tokens: rebuild offsets from decoded lengths
+        out, pos = [], 0
+        for t in toks:
+            out.append(pos)
+            pos += len(enc.decode_single_token_bytes(t).decode("utf-8", errors="ignore"))
+        return out
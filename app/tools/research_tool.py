@@ -1,37 +1,52 @@
-from app.agent import answer
+from app.agent import answer, answer_async
 
-def research_tool_handler(params: dict) -> dict:
+def _answer_args(params: dict):
+    """Tool params -> answer() keyword arguments (None when the question is missing)."""
+    question = params.get("question")
+    if not question:
+        return None
+    trace = params.get("trace")
+    return {
+        "question": question,
+        "max_iters": int(params.get("max_iters", 2)),
+        "topk": int(params.get("topk", 6)),
+        "model": params.get("model", "gpt-4o-mini"),
+        "safe_mode": bool(params.get("safe_mode", False)),
+        "cache": params.get("cache"),
+        "trace": None if trace is None else bool(trace),
+    }
+
+def research_tool_handler(params: dict, progress=None) -> dict:
     """
     MCP tool handler for the research assistant.
-    Expects params: {"question": str, "max_iters": int, "topk": int, "model": str, "safe_mode": bool}
+    Expects params: {"question": str, "max_iters": int, "topk": int, "model": str, "safe_mode": bool,
+                     "cache": "on" | "warm" | "off", "trace": bool}
+    progress(stage, **data) is forwarded to answer() for incremental progress events.
     """
-    question = params.get("question")
-    if not question:
+    args = _answer_args(params)
+    if args is None:
         return {"error": "Missing 'question' parameter"}
+    return {"result": answer(progress=progress, **args)}
 
-    max_iters = int(params.get("max_iters", 2))
-    topk = int(params.get("topk", 6))
-    model = params.get("model", "gpt-4o-mini")
-    safe_mode = bool(params.get("safe_mode", False))
-
-    result = answer(
-        question=question,
-        max_iters=max_iters,
-        topk=topk,
-        model=model,
-        safe_mode=safe_mode
-    )
-    return {"result": result}
+async def research_tool_handler_async(params: dict, progress=None) -> dict:
+    """research_tool_handler on the caller's event loop (cancelling the await stops the run)."""
+    args = _answer_args(params)
+    if args is None:
+        return {"error": "Missing 'question' parameter"}
+    return {"result": await answer_async(progress=progress, **args)}
 
 MCP_TOOL = {
     "name": "agentic_research",
     "description": "Run the Agentic Research Assistant for complex open-ended questions.",
     "handler": research_tool_handler,
+    "async_handler": research_tool_handler_async,
     "parameters": [
         {"name": "question", "type": "string", "required": True, "description": "Research question"},
         {"name": "max_iters", "type": "integer", "required": False, "description": "Max search iterations"},
         {"name": "topk", "type": "integer", "required": False, "description": "Top results per query"},
         {"name": "model", "type": "string", "required": False, "description": "LLM model"},
         {"name": "safe_mode", "type": "boolean", "required": False, "description": "Skip page fetching if True"},
+        {"name": "cache", "type": "string", "required": False, "description": "Answer cache: on, warm or off"},
+        {"name": "trace", "type": "boolean", "required": False, "description": "Include per-stage timings, tokens and cost"},
     ]
 }
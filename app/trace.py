@@ -0,0 +1,269 @@
+# app/trace.py
+"""
+Structured tracing for agent.answer: nested spans per stage and per external call.
+
+A trace is started by answer(trace=True), TRACE=1 or TRACE_FILE; outside one, span(),
+add() and skip() are no-ops. The current span lives in a contextvar, so it follows
+coroutines and asyncio.to_thread; worker threads pick it up via contextvars.copy_context().
+
+Each span records its wall time plus counters added while it is current, rolled up into
+the trace totals:
+  bytes               response bytes downloaded
+  tokens_in/out       from the OpenAI `usage` of each response
+  cost_usd            tokens x PRICES (USD per 1M tokens; TRACE_PRICE_<MODEL>=in,out overrides)
+  cache.<ns>.hits / .misses
+  skipped.<reason>    pages dropped, and why
+
+Env:
+  TRACE=0                  1 = trace every answer and return it under result["trace"]
+  TRACE_FILE=path.jsonl    append each finished trace, one record per span
+  TRACE_FORMAT=json|otel   record shape for TRACE_FILE (otel = OTLP/JSON span fields)
+"""
+import contextvars
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from .utils import log
+
+# USD per 1M tokens (input, output)
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("trace_span", default=None)
+_file_lock = threading.Lock()
+
+
+def enabled(flag: Optional[bool] = None) -> bool:
+    if flag is not None:
+        return flag or bool(os.getenv("TRACE_FILE"))
+    return os.getenv("TRACE", "0") == "1" or bool(os.getenv("TRACE_FILE"))
+
+
+def _price(model: str):
+    v = os.getenv("TRACE_PRICE_" + re.sub(r"[^A-Za-z0-9]+", "_", model).upper().strip("_"))
+    if v:
+        parts = [float(x) for x in v.split(",")]
+        return parts[0], (parts[1] if len(parts) > 1 else 0.0)
+    # dated snapshots (gpt-4o-mini-2024-07-18) price like their base model
+    for name in sorted(PRICES, key=len, reverse=True):
+        if model.startswith(name):
+            return PRICES[name]
+    return None
+
+
+class Span:
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attrs: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.counters: Dict[str, float] = {}
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self.wall_s: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def add(self, counter: str, n: float = 1):
+        self.trace.add(self, counter, n)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self):
+        self.wall_s = time.perf_counter() - self._t0
+
+    def as_dict(self) -> Dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "wall_s": round(self.wall_s or 0.0, 4),
+            "attrs": self.attrs,
+            "counters": {k: _round(v) for k, v in self.counters.items()},
+            **({"error": self.error} if self.error else {}),
+        }
+
+    def as_otel(self) -> Dict:
+        """OTLP/JSON span (as in ResourceSpans.scopeSpans[].spans[])."""
+        attrs = {**self.attrs, **self.counters}
+        return {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(self.start * 1e9)),
+            "endTimeUnixNano": str(int((self.start + (self.wall_s or 0.0)) * 1e9)),
+            "attributes": [{"key": k, "value": _otel_value(v)} for k, v in attrs.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+
+
+def _round(v: float) -> float:
+    return round(v, 6) if isinstance(v, float) else v
+
+
+def _otel_value(v: Any) -> Dict:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    if isinstance(v, (list, tuple)):
+        return {"arrayValue": {"values": [_otel_value(x) for x in v]}}
+    return {"stringValue": str(v)}
+
+
+class Trace:
+    """All spans of one traced call; counters are thread-safe."""
+
+    def __init__(self, name: str, **attrs):
+        self.trace_id = secrets.token_hex(16)
+        self.totals: Dict[str, float] = {}
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+        self.root = self.open(name, None, attrs)
+
+    def open(self, name: str, parent: Optional[Span], attrs: Dict[str, Any]) -> Span:
+        s = Span(self, name, parent.span_id if parent else None, attrs)
+        with self._lock:
+            self.spans.append(s)
+        return s
+
+    def add(self, s: Span, counter: str, n: float):
+        with self._lock:
+            s.counters[counter] = s.counters.get(counter, 0) + n
+            self.totals[counter] = self.totals.get(counter, 0) + n
+
+    def summary(self) -> Dict:
+        """-> {"trace_id", "wall_s", "totals", "stages": {name: {"count", "wall_s"}}, "spans"}"""
+        with self._lock:
+            spans = [s.as_dict() for s in self.spans]
+            totals = {k: _round(v) for k, v in self.totals.items()}
+        stages: Dict[str, Dict] = {}
+        for s in spans[1:]:
+            st = stages.setdefault(s["name"], {"count": 0, "wall_s": 0.0})
+            st["count"] += 1
+            st["wall_s"] = round(st["wall_s"] + s["wall_s"], 4)
+        return {
+            "trace_id": self.trace_id,
+            "wall_s": spans[0]["wall_s"],
+            "totals": totals,
+            "stages": stages,
+            "spans": spans,
+        }
+
+    def headline(self) -> str:
+        """One log line: wall time, top-level stages, tokens, cost, bytes."""
+        with self._lock:
+            top = [s for s in self.spans if s.parent_id == self.root.span_id]
+            totals = dict(self.totals)
+        stages: Dict[str, float] = {}
+        for s in top:
+            stages[s.name] = stages.get(s.name, 0.0) + (s.wall_s or 0.0)
+        parts = [f"{self.root.wall_s or 0.0:.2f}s"]
+        if stages:
+            parts.append(", ".join(f"{n} {t:.2f}s" for n, t in stages.items()))
+        parts.append(f"tokens {int(totals.get('tokens_in', 0))} in / {int(totals.get('tokens_out', 0))} out")
+        if totals.get("cost_usd"):
+            parts.append(f"${totals['cost_usd']:.4f}")
+        parts.append(f"{totals.get('bytes', 0) / 1e6:.2f} MB")
+        if totals.get("http.connections") or totals.get("http.reused"):
+            parts.append(f"{int(totals.get('http.connections', 0))} new / {int(totals.get('http.reused', 0))} reused connections")
+        return " | ".join(parts)
+
+    def records(self, fmt: str = "json") -> Iterator[Dict]:
+        with self._lock:
+            spans = list(self.spans)
+        for s in spans:
+            yield s.as_otel() if fmt == "otel" else s.as_dict()
+
+    def export(self, path: str, fmt: str = "json"):
+        """Append one JSON line per span."""
+        lines = [json.dumps(r, ensure_ascii=False, default=str) for r in self.records(fmt)]
+        with _file_lock, open(path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+@contextmanager
+def start(name: str, **attrs) -> Iterator[Trace]:
+    """Root span of a new trace; exported to TRACE_FILE (if set) when it ends."""
+    tr = Trace(name, **attrs)
+    token = _current.set(tr.root)
+    try:
+        yield tr
+    except BaseException as e:
+        tr.root.error = type(e).__name__
+        raise
+    finally:
+        tr.root.finish()
+        _current.reset(token)
+        path = os.getenv("TRACE_FILE")
+        if path:
+            try:
+                tr.export(path, os.getenv("TRACE_FORMAT", "json").lower())
+            except OSError as e:
+                log(f"[trace] could not write {path}: {e}")
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """Child of the current span (yields None when no trace is active)."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    s = parent.trace.open(name, parent, attrs)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = type(e).__name__
+        raise
+    finally:
+        s.finish()
+        _current.reset(token)
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+def add(counter: str, n: float = 1):
+    s = _current.get()
+    if s is not None:
+        s.add(counter, n)
+
+
+def skip(reason: str, n: int = 1):
+    add(f"skipped.{reason}", n)
+
+
+def usage(model: str, resp):
+    """Record tokens (and cost, for priced models) from an OpenAI response's usage."""
+    s = _current.get()
+    u = getattr(resp, "usage", None)
+    if s is None or u is None:
+        return
+    tin = getattr(u, "prompt_tokens", 0) or 0
+    tout = getattr(u, "completion_tokens", 0) or 0
+    s.add("tokens_in", tin)
+    if tout:
+        s.add("tokens_out", tout)
+    price = _price(model)
+    if price:
+        s.add("cost_usd", (tin * price[0] + tout * price[1]) / 1e6)
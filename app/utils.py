@@ -1,10 +1,8 @@
 import os
 import time
 import hashlib
-import json
 from typing import Any, Dict, Iterable, List, Optional
 
-from tenacity import retry, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -22,23 +20,21 @@ CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", ".cache")
 os.makedirs(CACHE_DIR, exist_ok=True)
 
 def cache_path(key: str) -> str:
+    """Legacy one-file-per-key location (see `python -m app.cache migrate`)."""
     return os.path.join(CACHE_DIR, f"{key}.json")
 
 def load_cache(key: str) -> Optional[Dict[str, Any]]:
-    path = cache_path(key)
-    if os.path.exists(path):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            return None
-    return None
+    from .cache import get_cache
+    try:
+        return get_cache().get(key)
+    except Exception as e:
+        log(f"Cache load error: {e}")
+        return None
 
 def save_cache(key: str, data: Dict[str, Any]):
-    path = cache_path(key)
+    from .cache import get_cache
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        get_cache().set(key, data)
     except Exception as e:
         log(f"Cache save error: {e}")
 
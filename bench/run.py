@@ -0,0 +1,386 @@
+# bench/run.py
+"""
+Offline, reproducible benchmarks for the research agent (no API keys, no network).
+
+  python -m bench.run                                # scenarios + micro-benchmarks
+  python -m bench.run scenarios --only fetch --questions 6
+  python -m bench.run micro --json before.json
+  python -m bench.run all --json after.json --baseline before.json   # exit 1 on regressions
+
+Scenarios run answer_async over fixed questions against bench/stubs.py: safe vs fetch vs
+pipeline mode, embedding re-rank off/on, cold cache vs warm (same questions answered once
+before timing). Micro-benchmarks time chunk_text, rank_chunks, _cos, build_source_snippets,
+extraction (extract_page through the worker pool) and fetch_and_extract (download +
+extraction from a stub site).
+
+Each scenario / micro-benchmark runs in a fresh interpreter with its own empty cache, so
+module-level settings, in-process caches and peak RSS are its own. Reported: latency
+percentiles, throughput, peak RSS of the agent and of its extraction workers, and for
+scenarios the trace totals (bytes, tokens, cache hits/misses, skipped pages), new vs
+reused HTTP connections and the mean time per stage.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .stubs import QUESTIONS, Stubs, load_corpus, make_corpus
+
+try:
+    import resource
+except ImportError:  # Windows: no peak RSS
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    "safe": {"SAFE_MODE": "1", "PIPELINE": "0"},
+    "fetch": {"SAFE_MODE": "0", "PIPELINE": "0"},
+    "pipeline": {"SAFE_MODE": "0", "PIPELINE": "1"},
+}
+RERANK = {
+    "plain": {"RERANK_SERP": "0", "RERANK_CHUNKS": "0"},
+    "rerank": {"RERANK_SERP": "1", "RERANK_CHUNKS": "1"},
+}
+CACHES = ("cold", "warm")
+BASE_ENV = {
+    "ANSWER_CACHE": "off",  # would turn every warm run into a lookup
+    "BM25_PERSIST": "0",
+    "TRACE": "0",
+    "TRACE_FILE": "",
+}
+
+
+def scenarios() -> Dict[str, Dict[str, str]]:
+    out = {}
+    for mode, menv in MODES.items():
+        for rr, renv in RERANK.items():
+            if mode == "pipeline" and rr == "rerank":
+                continue  # the pipeline ranks with BM25 only; SERP re-ranking doesn't apply
+            for cache in CACHES:
+                out[f"{mode}/{rr}/{cache}"] = {**menv, **renv, "BENCH_CACHE": cache}
+    return out
+
+
+MICRO = ("chunk_text", "rank_chunks", "cos", "build_source_snippets", "extract", "fetch_and_extract")
+
+
+# ---- measurement helpers (child side) ----
+
+def _peak_rss_mb() -> Tuple[float, float]:
+    """(this process, largest child process) peak RSS in MB."""
+    if resource is None:
+        return 0.0, 0.0
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, KB elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return round(own / 2**20, 1), round(kids / 2**20, 1)
+
+
+def _percentiles(values: List[float], unit: float) -> Dict[str, float]:
+    a = np.asarray(values, dtype=np.float64) * unit
+    return {
+        "p50": round(float(np.percentile(a, 50)), 3),
+        "p90": round(float(np.percentile(a, 90)), 3),
+        "p99": round(float(np.percentile(a, 99)), 3),
+        "mean": round(float(a.mean()), 3),
+        "max": round(float(a.max()), 3),
+    }
+
+
+def _corpus(cfg: Dict) -> List[Dict]:
+    return load_corpus(cfg["corpus"]) if cfg.get("corpus") else make_corpus(cfg["pages"])
+
+
+def _child_scenario(cfg: Dict) -> Dict:
+    from app import httpclient, llm
+    from app.agent import answer_async
+
+    questions = cfg["questions"]
+    latencies: List[float] = []
+    totals: Dict[str, float] = {}
+    stages: Dict[str, float] = {}
+    citations = 0
+
+    async def run(record: bool):
+        sem = asyncio.Semaphore(cfg["concurrency"])
+
+        async def one(q: str):
+            nonlocal citations
+            async with sem:
+                t0 = time.perf_counter()
+                r = await answer_async(q, trace=record)
+                if not record:
+                    return
+                latencies.append(time.perf_counter() - t0)
+                citations += len(r.get("citations") or [])
+                tr = r["trace"]
+                for k, v in tr["totals"].items():
+                    totals[k] = totals.get(k, 0) + v
+                for k, v in tr["stages"].items():
+                    stages[k] = stages.get(k, 0.0) + v["wall_s"]
+        try:
+            await asyncio.gather(*(one(q) for q in questions))
+        finally:
+            await httpclient.aclose()
+            await llm.aclose()
+
+    if os.environ.get("BENCH_CACHE") == "warm":
+        asyncio.run(run(record=False))
+    before = httpclient.stats()
+    t0 = time.perf_counter()
+    asyncio.run(run(record=True))
+    wall = time.perf_counter() - t0
+    after = httpclient.stats()
+    n = len(questions)
+    rss, workers = _peak_rss_mb()
+    return {
+        "questions": n,
+        "latency_ms": _percentiles(latencies, 1e3),
+        "throughput_qps": round(n / wall, 3),
+        "rss_mb": rss,
+        "workers_rss_mb": workers,
+        "citations_per_answer": round(citations / n, 2),
+        "http": {k: after[k] - before[k] for k in ("requests", "connections", "reused")},
+        "totals": {k: (round(v, 6) if isinstance(v, float) else v) for k, v in sorted(totals.items())},
+        "stage_ms": {k: round(v / n * 1e3, 1) for k, v in sorted(stages.items(), key=lambda kv: -kv[1])},
+    }
+
+
+def _micro_setup(name: str, cfg: Dict) -> Tuple[Callable[[int], None], int, Optional[Callable[[int], int]]]:
+    """-> (op(i), iterations, bytes processed by op(i) or None)."""
+    from app.chunk import _cos, chunk_text, rank_chunks
+    from app.extract import extract_text
+    from app.fetch import extract_page, fetch_and_extract
+    from app.synth import build_source_snippets
+
+    pages = _corpus(cfg)
+    scale = cfg["scale"]
+    texts = [extract_text(f"https://bench/{i}", p["html"])["text"] for i, p in enumerate(pages)]
+
+    if name == "chunk_text":
+        return (lambda i: chunk_text(texts[i % len(texts)])), 200 * scale, lambda i: len(texts[i % len(texts)])
+    if name == "rank_chunks":
+        chunks = [c for t in texts[:8] for c in chunk_text(t)][:120]
+        return (lambda i: rank_chunks(chunks, QUESTIONS[i % len(QUESTIONS)], topn=6)), 200 * scale, None
+    if name == "cos":
+        rng = np.random.default_rng(0)
+        a = rng.standard_normal((64, 1536)).astype(np.float32)
+        b = rng.standard_normal((64, 1536)).astype(np.float32)
+        return (lambda i: _cos(a[i % 64], b[(i * 7) % 64])), 20000 * scale, None
+    if name == "build_source_snippets":
+        raw = [{"chunk": texts[i % len(texts)][:900], "url": f"https://site{i % 12}.example/{i}", "title": f"t{i}"}
+               for i in range(48)]
+        return (lambda i: build_source_snippets(raw)), 5000 * scale, None
+    if name == "extract":
+        return (lambda i: extract_page(f"https://bench/{i}", pages[i % len(pages)]["html"])), 60 * scale, \
+            lambda i: len(pages[i % len(pages)]["html"])
+    if name == "fetch_and_extract":
+        sites = cfg["sites"]
+        # a fresh query string per call: every fetch misses the page cache
+        url = lambda i: f"{sites[i % len(sites)]}/doc/{i % len(pages)}?run={cfg['run_id']}&i={i}"
+        return (lambda i: fetch_and_extract(url(i))), 40 * scale, lambda i: len(pages[i % len(pages)]["html"])
+    raise SystemExit(f"unknown micro-benchmark: {name}")
+
+
+def _child_micro(name: str, cfg: Dict) -> Dict:
+    op, n, nbytes = _micro_setup(name, cfg)
+    for i in range(max(1, n // 20)):  # warm-up: imports, pools, allocator
+        op(i)
+    lat = []
+    processed = 0
+    t_start = time.perf_counter()
+    for i in range(n):
+        t0 = time.perf_counter()
+        op(i)
+        lat.append(time.perf_counter() - t0)
+        if nbytes:
+            processed += nbytes(i)
+    wall = time.perf_counter() - t_start
+    rss, workers = _peak_rss_mb()
+    out = {
+        "iterations": n,
+        "latency_us": _percentiles(lat, 1e6),
+        "ops_per_s": round(n / wall, 1),
+        "rss_mb": rss,
+        "workers_rss_mb": workers,
+    }
+    if nbytes:
+        out["mb_per_s"] = round(processed / wall / 1e6, 2)
+    return out
+
+
+# ---- orchestration (parent side) ----
+
+def _run_child(kind: str, name: str, env: Dict[str, str], cfg: Dict, verbose: bool) -> Dict:
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp:
+        out = os.path.join(tmp, "result.json")
+        child_env = {
+            **os.environ, **BASE_ENV, **env,
+            "CACHE_PATH": os.path.join(tmp, "cache.sqlite3"),
+            "BENCH_CONFIG": json.dumps(cfg),
+            "PYTHONPATH": ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""),
+        }
+        quiet = None if verbose else subprocess.DEVNULL  # the app logs every step to stdout
+        proc = subprocess.run(
+            [sys.executable, "-m", "bench.run", "_child", kind, name, "--out", out],
+            cwd=ROOT, env=child_env, stdout=quiet,
+        )
+        if proc.returncode != 0 or not os.path.exists(out):
+            return {"error": f"exit code {proc.returncode}"}
+        with open(out) as f:
+            return json.load(f)
+
+
+def _print_scenario(name: str, r: Dict):
+    if "error" in r:
+        print(f"  {name:<26} FAILED ({r['error']})")
+        return
+    lat, t, http = r["latency_ms"], r["totals"], r.get("http", {})
+    top = ", ".join(f"{k} {v:.0f}" for k, v in list(r["stage_ms"].items())[:4])
+    print(
+        f"  {name:<26} p50 {lat['p50']:>8.1f} ms  p90 {lat['p90']:>8.1f}  p99 {lat['p99']:>8.1f}"
+        f"  {r['throughput_qps']:>6.2f} q/s  rss {r['rss_mb']:>6.1f} MB (+{r['workers_rss_mb']:.0f})"
+        f"  {t.get('bytes', 0) / 1e6:>6.2f} MB  tok {int(t.get('tokens_in', 0))}/{int(t.get('tokens_out', 0))}"
+        f"  conn {http.get('connections', 0)} new/{http.get('reused', 0)} reused"
+        f"  | {top}"
+    )
+
+
+def _print_micro(name: str, r: Dict):
+    if "error" in r:
+        print(f"  {name:<26} FAILED ({r['error']})")
+        return
+    lat = r["latency_us"]
+    rate = f"  {r['mb_per_s']:>7.2f} MB/s" if "mb_per_s" in r else ""
+    print(
+        f"  {name:<26} p50 {lat['p50']:>10.1f} us  p90 {lat['p90']:>10.1f}  p99 {lat['p99']:>10.1f}"
+        f"  {r['ops_per_s']:>10.1f} op/s{rate}  rss {r['rss_mb']:>6.1f} MB"
+    )
+
+
+def compare(current: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Regressions: p50 latency or peak RSS worse than baseline by more than `tolerance`."""
+    found = []
+    for section, lat_key in (("scenarios", "latency_ms"), ("micro", "latency_us")):
+        for name, r in current.get(section, {}).items():
+            old = baseline.get(section, {}).get(name)
+            if not old or "error" in old or "error" in r:
+                continue
+            for label, new_v, old_v in (
+                ("p50", r[lat_key]["p50"], old[lat_key]["p50"]),
+                ("rss_mb", r["rss_mb"], old["rss_mb"]),
+            ):
+                if old_v and new_v > old_v * (1 + tolerance):
+                    found.append(f"{section}/{name}: {label} {old_v} -> {new_v} (+{(new_v / old_v - 1) * 100:.0f}%)")
+    return found
+
+
+def main(argv: Optional[List[str]] = None):
+    p = argparse.ArgumentParser(prog="python -m bench.run", description="Offline benchmarks for the research agent")
+    p.add_argument("what", nargs="?", default="all", choices=("all", "scenarios", "micro"))
+    p.add_argument("--only", default="", help="run entries whose name contains this substring")
+    p.add_argument("--questions", type=int, default=4, help="questions per scenario")
+    p.add_argument("--concurrency", type=int, default=1, help="questions answered at once per scenario")
+    p.add_argument("--scale", type=int, default=1, help="multiplier for micro-benchmark iterations")
+    p.add_argument("--pages", type=int, default=48, help="size of the generated corpus")
+    p.add_argument("--corpus", help="directory of recorded *.html pages to serve instead")
+    p.add_argument("--sites", type=int, default=8, help="distinct hosts the corpus is spread over")
+    p.add_argument("--page-latency-ms", type=float, default=80)
+    p.add_argument("--bandwidth-kbps", type=float, default=0, help="per-response page bandwidth (0 = unthrottled)")
+    p.add_argument("--search-latency-ms", type=float, default=150)
+    p.add_argument("--llm-latency-ms", type=float, default=300)
+    p.add_argument("--json", help="write results to this file")
+    p.add_argument("--baseline", help="earlier --json output to compare against")
+    p.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown vs baseline (0.15 = 15%%)")
+    p.add_argument("--verbose", action="store_true", help="show the agent's log output")
+    args = p.parse_args(argv)
+
+    pages = load_corpus(args.corpus) if args.corpus else make_corpus(args.pages)
+    stubs = Stubs(
+        pages,
+        sites=args.sites,
+        page_latency=args.page_latency_ms / 1e3,
+        bandwidth=args.bandwidth_kbps * 1000 / 8,
+        search_latency=args.search_latency_ms / 1e3,
+        llm_latency=args.llm_latency_ms / 1e3,
+    ).start()
+    cfg = {
+        "questions": (QUESTIONS * (args.questions // len(QUESTIONS) + 1))[:args.questions],
+        "concurrency": max(1, args.concurrency),
+        "scale": max(1, args.scale),
+        "pages": args.pages,
+        "corpus": os.path.abspath(args.corpus) if args.corpus else None,
+        "sites": stubs.sites,
+        "run_id": int(time.time()),
+    }
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "args": {k: v for k, v in vars(args).items() if k not in ("json", "baseline", "verbose")},
+        },
+        "scenarios": {},
+        "micro": {},
+    }
+    try:
+        if args.what in ("all", "scenarios"):
+            print(f"Scenarios ({len(cfg['questions'])} questions, concurrency {cfg['concurrency']}):")
+            for name, env in scenarios().items():
+                if args.only and args.only not in name:
+                    continue
+                r = _run_child("scenario", name, {**stubs.env(), **env}, cfg, args.verbose)
+                results["scenarios"][name] = r
+                _print_scenario(name, r)
+        if args.what in ("all", "micro"):
+            print("Micro-benchmarks:")
+            for name in MICRO:
+                if args.only and args.only not in name:
+                    continue
+                r = _run_child("micro", name, stubs.env(), cfg, args.verbose)
+                results["micro"][name] = r
+                _print_micro(name, r)
+    finally:
+        stubs.stop()
+    results["meta"]["stub_requests"] = dict(stubs.counts)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} of {args.baseline}")
+
+
+def _child(argv: List[str]):
+    p = argparse.ArgumentParser()
+    p.add_argument("kind", choices=("scenario", "micro"))
+    p.add_argument("name")
+    p.add_argument("--out", required=True)
+    args = p.parse_args(argv)
+    cfg = json.loads(os.environ["BENCH_CONFIG"])
+    r = _child_scenario(cfg) if args.kind == "scenario" else _child_micro(args.name, cfg)
+    with open(args.out, "w") as f:
+        json.dump(r, f)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["_child"]:
+        _child(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,299 @@
+# bench/stubs.py
+"""
+Local stand-ins for everything answer() talks to, so benchmarks need no keys or network:
+
+- a page corpus (generated deterministically, or *.html files from a directory) served by
+  several "sites" (one port each, so per-domain dedupe and per-host limits behave as on
+  the web) with configurable latency and bandwidth;
+- a search API answering SerpAPI (GET /search.json) and Tavily (POST /search) requests by
+  ranking the corpus against the query;
+- an OpenAI-compatible API (/v1/chat/completions, /v1/embeddings) with deterministic
+  replies: queries from the question, an answer citing the given sources, a fixed
+  critique, and hashed bag-of-words embeddings.
+"""
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+TOPICS = {
+    "climate": "carbon emissions warming temperature methane policy renewable solar wind grid ocean ice",
+    "health": "vaccine trial patients dose immune clinical hospital risk mortality cohort placebo",
+    "economy": "inflation rates central bank unemployment wages growth recession bonds credit demand",
+    "ai": "model training inference dataset benchmark transformer compute alignment tokens gpu latency",
+    "energy": "battery lithium storage nuclear reactor hydrogen pipeline capacity turbine efficiency",
+    "space": "orbit launch satellite rocket lunar mission telescope payload booster spacecraft mars",
+}
+COMMON = ("the of and to in a is that for on with as by at from this it are was be or an which "
+          "study report data analysis according researchers found results evidence recent").split()
+QUESTIONS = [
+    "What is driving recent changes in carbon emissions and climate policy?",
+    "How effective are vaccine trials at reducing hospital mortality?",
+    "What do central banks do about inflation and unemployment?",
+    "How much compute does transformer model training need?",
+    "Is battery storage or nuclear better for grid capacity?",
+    "What are the goals of upcoming lunar and mars missions?",
+    "How do renewable solar and wind affect grid reliability?",
+    "What evidence links wages growth to recession risk?",
+]
+_WORD = re.compile(r"[a-z]+")
+_TAG = re.compile(r"<[^>]+>")
+_SCRIPT = re.compile(r"<(script|style)[^>]*>.*?</\1>", re.S | re.I)
+
+
+def _sentence(rng: random.Random, words: List[str]) -> str:
+    n = rng.randint(8, 22)
+    s = " ".join(rng.choice(words) if rng.random() < 0.45 else rng.choice(COMMON) for _ in range(n))
+    return s[0].upper() + s[1:] + "."
+
+
+def make_corpus(n_pages: int = 48, seed: int = 7) -> List[Dict]:
+    """Deterministic pages shaped like news/blog articles (nav, scripts, article, footer)."""
+    rng = random.Random(seed)
+    names = list(TOPICS)
+    pages = []
+    for i in range(n_pages):
+        topic = names[i % len(names)]
+        words = TOPICS[topic].split()
+        title = f"{topic.title()} report {i}: " + " ".join(rng.sample(words, 3))
+        paras = [
+            "<p>" + " ".join(_sentence(rng, words) for _ in range(rng.randint(3, 7))) + "</p>"
+            for _ in range(rng.randint(6, 60))
+        ]
+        nav = "".join(f'<li><a href="/section/{j}">Section {j}</a></li>' for j in range(30))
+        html = (
+            f"<!doctype html><html><head><meta charset=\"utf-8\"><title>{title}</title>"
+            f"<style>{'body{margin:0} .x{color:#333} ' * 40}</style>"
+            f"<script>var cfg = {json.dumps({'id': i, 'tags': words})}; {'function f(){return 1} ' * 60}</script>"
+            f"</head><body><nav><ul>{nav}</ul></nav><header><h2>Site {i % 8}</h2></header>"
+            f"<main><article><h1>{title}</h1>{''.join(paras)}</article>"
+            f"<aside>Related: {' | '.join(rng.sample(words, 4))}</aside></main>"
+            f"<footer>Copyright. All rights reserved. Privacy policy. Terms of use. Contact us.</footer>"
+            f"</body></html>"
+        )
+        pages.append({"title": title, "html": html.encode("utf-8")})
+    return _index(pages)
+
+
+def load_corpus(path: str) -> List[Dict]:
+    """Recorded pages: every *.html file under path (sorted, so runs are comparable)."""
+    pages = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith((".html", ".htm")):
+            with open(os.path.join(path, name), "rb") as f:
+                html = f.read()
+            m = re.search(rb"<title[^>]*>(.*?)</title>", html, re.S | re.I)
+            title = m.group(1).decode("utf-8", "ignore").strip() if m else name
+            pages.append({"title": title, "html": html})
+    if not pages:
+        raise SystemExit(f"no .html files in {path}")
+    return _index(pages)
+
+
+def _index(pages: List[Dict]) -> List[Dict]:
+    for p in pages:
+        text = _TAG.sub(" ", _SCRIPT.sub(" ", p["html"].decode("utf-8", "ignore")))
+        p["terms"] = {}
+        for w in _WORD.findall(text.lower()):
+            p["terms"][w] = p["terms"].get(w, 0) + 1
+        p["snippet"] = " ".join(text.split())[:200]
+    return pages
+
+
+def search(pages: List[Dict], query: str, k: int) -> List[int]:
+    """Corpus indices ranked by query term frequency (ties by a stable hash)."""
+    terms = set(_WORD.findall(query.lower())) - set(COMMON)
+
+    def score(i: int):
+        p = pages[i]
+        s = sum(math.log1p(p["terms"].get(t, 0)) for t in terms)
+        return -s, hashlib.md5(f"{query}|{i}".encode()).hexdigest()
+    return sorted(range(len(pages)), key=score)[:k]
+
+
+# ---- deterministic LLM ----
+
+def _embedding(text: str, dim: int = 256) -> List[float]:
+    vec = [0.0] * dim
+    for w in _WORD.findall(text.lower()):
+        h = int(hashlib.md5(w.encode()).hexdigest()[:8], 16)
+        vec[h % dim] += 1.0 if h & (1 << 20) else -1.0
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [round(v / norm, 5) for v in vec]
+
+
+def _chat_reply(system: str, user: str) -> Dict:
+    if "search queries" in system:
+        q = user.split("\n", 2)[1] if "\n" in user else user
+        base = " ".join(w for w in _WORD.findall(q.lower()) if w not in COMMON)[:120]
+        return {"queries": [base, f"{base} evidence", f"{base} criticism", f"{base} recent data"]}
+    if "syntheses" in system:
+        sources = re.findall(r"^\[(S\d+)\] (\S+)", user, re.M)[:4]
+        paras = [f"Finding {n} is supported by the sources [{sid}]." for n, (sid, _) in enumerate(sources, 1)]
+        return {
+            "answer": "\n\n".join(paras) or "No sources were provided.",
+            "citations": [{"id": sid, "url": url, "title": sid} for sid, url in sources],
+        }
+    cites = len(set(re.findall(r"\[S\d+\]", user)))
+    return {"confidence": 0.8 if cites >= 2 else 0.6, "gaps": [] if cites >= 2 else ["recent data"]}
+
+
+# ---- servers ----
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    stubs: "Stubs" = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code: int, body: bytes, ctype: str = "application/json",
+              latency: float = 0.0, bandwidth: float = 0.0):
+        if latency:
+            time.sleep(latency)
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        step = max(1024, int(bandwidth * 0.02))  # ~50 writes per second at the set rate
+        for i in range(0, len(body), step):
+            self.wfile.write(body[i:i + step])
+            self.wfile.flush()
+            time.sleep(len(body[i:i + step]) / bandwidth)
+
+    def _json(self, obj, latency: float = 0.0):
+        self._send(200, json.dumps(obj).encode("utf-8"), latency=latency)
+
+    def _body(self) -> Dict:
+        n = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(n) or b"{}")
+
+
+class _SiteHandler(_Handler):
+    def do_GET(self):
+        s = self.stubs
+        m = re.match(r"/doc/(\d+)", urlparse(self.path).path)
+        if not m or int(m.group(1)) >= len(s.pages):
+            return self._send(404, b"not found", "text/plain")
+        s.count("pages")
+        self._send(200, s.pages[int(m.group(1))]["html"], "text/html; charset=utf-8",
+                   latency=s.page_latency, bandwidth=s.bandwidth)
+
+
+class _ApiHandler(_Handler):
+    def do_GET(self):
+        u = urlparse(self.path)
+        if u.path != "/search.json":
+            return self._send(404, b"{}")
+        qs = parse_qs(u.query)
+        items = self.stubs.results(qs.get("q", [""])[0], int(qs.get("num", ["6"])[0]))
+        self._json({"organic_results": [
+            {"title": it["title"], "link": it["url"], "snippet": it["snippet"]} for it in items
+        ]}, latency=self.stubs.search_latency)
+
+    def do_POST(self):
+        s = self.stubs
+        req = self._body()
+        if self.path == "/search":
+            items = s.results(req.get("query", ""), int(req.get("max_results", 6)))
+            return self._json({"results": [
+                {"title": it["title"], "url": it["url"], "content": it["snippet"]} for it in items
+            ]}, latency=s.search_latency)
+        if self.path.endswith("/embeddings"):
+            s.count("embeddings")
+            inp = req["input"] if isinstance(req["input"], list) else [req["input"]]
+            tokens = sum(len(t) for t in inp) // 4
+            return self._json({
+                "object": "list", "model": req["model"],
+                "data": [{"object": "embedding", "index": i, "embedding": _embedding(t)} for i, t in enumerate(inp)],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }, latency=s.llm_latency / 4)
+        if self.path.endswith("/chat/completions"):
+            s.count("chat")
+            msgs = req["messages"]
+            content = json.dumps(_chat_reply(msgs[0]["content"], msgs[-1]["content"]))
+            tin = sum(len(m["content"]) for m in msgs) // 4
+            tout = len(content) // 4
+            return self._json({
+                "id": "bench", "object": "chat.completion", "created": 0, "model": req["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": tin, "completion_tokens": tout, "total_tokens": tin + tout},
+            }, latency=s.llm_latency)
+        self._send(404, b"{}")
+
+
+class Stubs:
+    """Search + OpenAI API on one port, the corpus spread over `sites` ports."""
+
+    def __init__(self, pages: List[Dict], sites: int = 8, page_latency: float = 0.08,
+                 bandwidth: float = 0.0, search_latency: float = 0.15, llm_latency: float = 0.3):
+        self.pages = pages
+        self.page_latency = page_latency
+        self.bandwidth = bandwidth  # bytes/second per response (0 = unthrottled)
+        self.search_latency = search_latency
+        self.llm_latency = llm_latency
+        self.counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._servers: List[ThreadingHTTPServer] = []
+        self._n_sites = max(1, sites)
+        self.api: Optional[str] = None
+        self.sites: List[str] = []
+
+    def count(self, what: str):
+        with self._lock:
+            self.counts[what] = self.counts.get(what, 0) + 1
+
+    def url(self, i: int) -> str:
+        return f"{self.sites[i % len(self.sites)]}/doc/{i}"
+
+    def results(self, query: str, k: int) -> List[Dict]:
+        self.count("search")
+        return [{"title": self.pages[i]["title"], "url": self.url(i), "snippet": self.pages[i]["snippet"]}
+                for i in search(self.pages, query, k)]
+
+    def _serve(self, handler) -> str:
+        cls = type(handler.__name__, (handler,), {"stubs": self})
+        srv = ThreadingHTTPServer(("127.0.0.1", 0), cls)
+        srv.daemon_threads = True
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        self._servers.append(srv)
+        return f"http://127.0.0.1:{srv.server_port}"
+
+    def start(self) -> "Stubs":
+        self.api = self._serve(_ApiHandler)
+        self.sites = [self._serve(_SiteHandler) for _ in range(self._n_sites)]
+        return self
+
+    def stop(self):
+        for srv in self._servers:
+            srv.shutdown()
+            srv.server_close()
+        self._servers.clear()
+
+    def env(self) -> Dict[str, str]:
+        """Environment pointing the app at the stubs, with provider limits out of the way."""
+        return {
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_BASE_URL": f"{self.api}/v1",
+            "SERPAPI_KEY": "bench",
+            "SERPAPI_URL": f"{self.api}/search.json",
+            "TAVILY_API_KEY": "bench",
+            "TAVILY_URL": f"{self.api}/search",
+            "SEARCH_ENGINES": "serpapi",
+            "OPENAI_RPM": "1000000",
+            "OPENAI_TPM": "1000000000",
+            "SERPAPI_RPS": "1000",
+            "TAVILY_RPS": "1000",
+            "RATE_LIMIT_STORE": "",
+        }
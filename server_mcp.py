@@ -1,41 +1,209 @@
 #!/usr/bin/env python3
-import sys, json
+"""
+Minimal stdio MCP-style server (one JSON object per line in each direction).
+
+Tool calls run concurrently (at most MCP_MAX_CONCURRENCY at once; more wait for a slot),
+so list_tools and other calls are answered while research is running. A tool's
+"async_handler" runs as a task on the server's loop; tools with only a sync "handler"
+run in worker threads.
+
+Messages may carry an "id"; every response for a call echoes it (call_tool without one
+gets a generated id, returned in the "accepted" message). While a call runs the server
+emits {"type": "progress", "id", "stage", ...} events. {"type": "cancel", "id": ...}
+aborts a call (an async handler at once, a sync one at its next progress checkpoint);
+calls also time out after MCP_CALL_TIMEOUT seconds (or the message's "timeout").
+
+Log output goes to stderr so stdout carries protocol messages only.
+
+Env:
+  MCP_MAX_CONCURRENCY=4
+  MCP_CALL_TIMEOUT=900
+"""
+import asyncio
+import inspect
+import json
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
 from app.tools.research_tool import MCP_TOOL
+from app import httpclient, llm
+from app.ratelimit import BATCH, priority
+from app.utils import getenv_int, log
 
 TOOLS = {MCP_TOOL["name"]: MCP_TOOL}
 
+MCP_MAX_CONCURRENCY = max(1, getenv_int("MCP_MAX_CONCURRENCY", 4))
+MCP_CALL_TIMEOUT = getenv_int("MCP_CALL_TIMEOUT", 900)
+
+_out = sys.stdout
+
+
+class CallCancelled(Exception):
+    pass
+
+
 def send(obj):
-    sys.stdout.write(json.dumps(obj) + "\n")
-    sys.stdout.flush()
-
-def handle(msg):
-    mtype = msg.get("type")
-    if mtype == "initialize":
-        return {"type": "initialized", "tools": [
-            {"name": t["name"], "description": t["description"], "parameters": t["parameters"]}
-            for t in TOOLS.values()
-        ]}
-    if mtype == "list_tools":
-        return {"type": "tools", "tools": [
-            {"name": t["name"], "description": t["description"], "parameters": t["parameters"]}
-            for t in TOOLS.values()
-        ]}
-    if mtype == "call_tool":
+    _out.write(json.dumps(obj) + "\n")
+    _out.flush()
+
+
+def _tool_list():
+    return [
+        {"name": t["name"], "description": t["description"], "parameters": t["parameters"]}
+        for t in TOOLS.values()
+    ]
+
+
+def _with_id(obj: Dict, msg_id: Optional[str]) -> Dict:
+    if msg_id is not None:
+        obj["id"] = msg_id
+    return obj
+
+
+def parse_timeout(value) -> float:
+    """A call's "timeout" (seconds) -> float; MCP_CALL_TIMEOUT when absent. Raises ValueError."""
+    if value is None:
+        return float(MCP_CALL_TIMEOUT)
+    if isinstance(value, bool):
+        raise ValueError(f"invalid timeout: {value!r}")
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid timeout: {value!r}") from None
+    if not 0 < timeout < float("inf"):
+        raise ValueError(f"invalid timeout: {value!r}")
+    return timeout
+
+
+class Server:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(MCP_MAX_CONCURRENCY)
+        self.pool = ThreadPoolExecutor(max_workers=MCP_MAX_CONCURRENCY, thread_name_prefix="tool")
+        self.calls: Dict[str, asyncio.Task] = {}
+        self.cancelled: Dict[str, threading.Event] = {}
+
+    def emit(self, obj: Dict):
+        """Thread-safe send (tool threads report progress through here)."""
+        self.loop.call_soon_threadsafe(send, obj)
+
+    def handle(self, msg: Dict):
+        mtype = msg.get("type")
+        msg_id = msg.get("id")
+        if mtype == "initialize":
+            return send(_with_id({"type": "initialized", "tools": _tool_list()}, msg_id))
+        if mtype == "list_tools":
+            return send(_with_id({"type": "tools", "tools": _tool_list()}, msg_id))
+        if mtype == "call_tool":
+            return self.start_call(msg)
+        if mtype == "cancel":
+            return self.cancel(msg_id)
+        send(_with_id({"type": "error", "error": "Unknown message type"}, msg_id))
+
+    def start_call(self, msg: Dict):
+        call_id = str(msg.get("id") or uuid.uuid4().hex[:12])
+        if call_id in self.calls:
+            return send({"type": "error", "id": call_id, "error": "Duplicate request id"})
         name = msg.get("tool")
-        params = msg.get("params", {})
         tool = TOOLS.get(name)
         if not tool:
-            return {"type": "error", "error": f"Unknown tool: {name}"}
+            return send({"type": "error", "id": call_id, "error": f"Unknown tool: {name}"})
         try:
-            out = tool["handler"](params)
-            return {"type": "tool_result", "tool": name, "result": out}
-        except Exception as e:
-            return {"type": "error", "error": f"{type(e).__name__}: {e}"}
-    return {"type": "error", "error": "Unknown message type"}
+            timeout = parse_timeout(msg.get("timeout"))
+        except ValueError as e:
+            return send({"type": "error", "id": call_id, "error": str(e)})
+        params = msg.get("params", {})
+        if not isinstance(params, dict):
+            return send({"type": "error", "id": call_id, "error": "params must be a JSON object"})
+        send({"type": "accepted", "id": call_id, "tool": name})
+        self.cancelled[call_id] = threading.Event()
+        task = self.loop.create_task(self.run_call(call_id, tool, params, timeout))
+        self.calls[call_id] = task
+        task.add_done_callback(lambda _: (self.calls.pop(call_id, None), self.cancelled.pop(call_id, None)))
 
-def main():
+    def cancel(self, call_id):
+        task = self.calls.get(str(call_id)) if call_id is not None else None
+        if task is None:
+            return send(_with_id({"type": "error", "error": "No such call"}, call_id))
+        self.cancelled[str(call_id)].set()
+        task.cancel()
+
+    async def run_call(self, call_id: str, tool: Dict, params: Dict, timeout: float):
+        name = tool["name"]
+        stop = self.cancelled[call_id]
+        handler = tool.get("async_handler") or tool["handler"]
+        is_async = inspect.iscoroutinefunction(handler)
+        kwargs = {}
+
+        def progress(stage: str, **data):
+            if stop.is_set():
+                raise CallCancelled(call_id)
+            msg = {"type": "progress", "id": call_id, "tool": name, "stage": stage, **data}
+            if is_async:
+                send(msg)  # already on the loop: keeps progress ahead of the result
+            else:
+                self.emit(msg)
+
+        if "progress" in inspect.signature(handler).parameters:
+            kwargs["progress"] = progress
+
+        # MCP jobs queue behind interactive (UI/CLI) calls for provider quota
+        async def run_async():
+            with priority(BATCH):
+                return await handler(params, **kwargs)
+
+        def run():
+            if stop.is_set():  # cancelled or timed out while waiting for a slot
+                raise CallCancelled(call_id)
+            with priority(BATCH):
+                return handler(params, **kwargs)
+
+        fut = None
+        try:
+            async with self.slots:
+                # an async handler runs on this loop and is cancelled outright; a sync one runs
+                # in a worker thread and stops at its next progress checkpoint
+                fut = asyncio.ensure_future(run_async()) if is_async else self.loop.run_in_executor(self.pool, run)
+                try:
+                    out = await asyncio.wait_for(asyncio.shield(fut), timeout)
+                    send({"type": "tool_result", "id": call_id, "tool": name, "result": out})
+                except asyncio.TimeoutError:
+                    self._stop(stop, fut, is_async)
+                    send({"type": "error", "id": call_id, "error": f"Timed out after {timeout:g}s"})
+                except asyncio.CancelledError:
+                    self._stop(stop, fut, is_async)
+                    send({"type": "cancelled", "id": call_id})
+                except Exception as e:
+                    send({"type": "error", "id": call_id, "error": f"{type(e).__name__}: {e}"})
+                # keep the slot until the work has actually stopped
+                await asyncio.gather(fut, return_exceptions=True)
+        except asyncio.CancelledError:
+            if fut is None:  # cancelled while queued for a slot
+                send({"type": "cancelled", "id": call_id})
+
+    @staticmethod
+    def _stop(stop: threading.Event, fut: asyncio.Future, is_async: bool):
+        stop.set()
+        if is_async:
+            fut.cancel()
+
+    async def drain(self):
+        while self.calls:
+            await asyncio.gather(*list(self.calls.values()), return_exceptions=True)
+        self.pool.shutdown(wait=False)
+
+
+async def serve():
+    server = Server()
+    stdin = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stdin")
     send({"type": "ready"})
-    for line in sys.stdin:
+    while True:
+        line = await server.loop.run_in_executor(stdin, sys.stdin.readline)
+        if not line:
+            break
         line = line.strip()
         if not line:
             continue
@@ -44,8 +212,25 @@ def main():
         except Exception as e:
             send({"type": "error", "error": f"invalid json: {e}"})
             continue
-        resp = handle(msg)
-        send(resp)
+        if not isinstance(msg, dict):
+            send({"type": "error", "error": "message must be a JSON object"})
+            continue
+        try:
+            server.handle(msg)
+        except Exception as e:  # one bad message must not stop the server
+            log(f"[mcp] error handling {msg.get('type')!r}: {type(e).__name__}: {e}")
+            send(_with_id({"type": "error", "error": f"{type(e).__name__}: {e}"}, msg.get("id")))
+    # EOF: let in-flight calls finish so piped requests still get their results
+    await server.drain()
+    await httpclient.aclose()
+    await llm.aclose()
+    stdin.shutdown(wait=False)
+
+
+def main():
+    sys.stdout = sys.stderr  # app logging prints; keep it off the protocol channel
+    asyncio.run(serve())
+
 
 if __name__ == "__main__":
     main()
@@ -31,6 +31,12 @@ if submit and question.strip():
         )
 
     st.subheader("Final Answer")
+    if result.get("cached"):
+        hit = result["cached"]
+        st.info(
+            f"Cached answer ({hit.get('age_s', 0) // 60} min old) for a similar question: "
+            f"\"{hit.get('question', '')}\". Set ANSWER_CACHE=off to always research afresh."
+        )
     st.write(result.get("answer",""))
 
     st.subheader("References")
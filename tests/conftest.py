@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# Import app/ and the top-level modules (server_mcp, bench) from the repo root, and keep
+# every test away from the real .cache and the network.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmp = tempfile.mkdtemp(prefix="research-agent-tests-")
+os.environ["CACHE_PATH"] = os.path.join(_tmp, "cache.sqlite3")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+for var in ("RECORD", "REPLAY", "TRACE", "TRACE_FILE", "RATE_LIMIT_STORE", "SINGLEFLIGHT_DIR", "BM25_PERSIST"):
+    os.environ.pop(var, None)
@@ -0,0 +1,54 @@
+import pytest
+
+from bench.stubs import QUESTIONS, Stubs, make_corpus
+
+
+@pytest.fixture(scope="module")
+def stubs():
+    # one server for the module: the background loop's OpenAI client keeps its base URL
+    from app import search
+
+    s = Stubs(make_corpus(24), sites=4, page_latency=0, search_latency=0, llm_latency=0).start()
+    with pytest.MonkeyPatch.context() as mp:
+        for k, v in s.env().items():
+            mp.setenv(k, v)
+        mp.setenv("ANSWER_CACHE", "off")
+        mp.setattr(search, "SERP_API", s.env()["SERPAPI_URL"])
+        yield s
+    s.stop()
+
+
+def test_answer_reuses_clients_across_calls(stubs):
+    from app import agent, background, httpclient, llm
+
+    first = agent.answer(QUESTIONS[0], max_iters=1)
+    loop = background.loop()
+    client = llm._aclients.get(loop)
+    http = httpclient._async_clients.get(loop)
+    second = agent.answer(QUESTIONS[1], max_iters=1)
+
+    assert first["citations"] and second["citations"]
+    assert client is not None and llm._aclients.get(loop) is client
+    assert http is not None and httpclient._async_clients.get(loop) is http
+    assert background.loop() is loop
+
+
+def test_answer_keeps_caller_context(stubs):
+    from app import agent, trace
+
+    with trace.start("outer") as tr:
+        agent.answer(QUESTIONS[2], max_iters=1)
+    assert tr.summary()["stages"]
+
+
+def test_connection_reuse_is_counted(stubs):
+    from app import agent, httpclient
+
+    before = httpclient.stats()
+    r = agent.answer(QUESTIONS[3], max_iters=1, trace=True)
+    after = httpclient.stats()
+
+    assert after["requests"] > before["requests"]
+    assert after["reused"] > before["reused"]
+    assert after["connections"] + after["reused"] <= after["requests"]
+    assert r["trace"]["totals"].get("http.reused")
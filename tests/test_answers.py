@@ -0,0 +1,37 @@
+from app import answers
+
+
+def test_answer_cache_is_opt_in(monkeypatch):
+    monkeypatch.delenv("ANSWER_CACHE", raising=False)
+    assert answers.cache_mode() == "off"
+    assert answers.cache_mode("bogus") == "off"
+
+
+def test_answer_cache_mode_from_env_or_argument(monkeypatch):
+    monkeypatch.setenv("ANSWER_CACHE", "Warm ")
+    assert answers.cache_mode() == "warm"
+    assert answers.cache_mode("on") == "on"
+
+
+def test_hits_need_the_same_run_settings(monkeypatch):
+    import asyncio
+
+    import numpy as np
+
+    async def embed(texts):
+        return np.ones((len(texts), 4), dtype=np.float32)
+
+    monkeypatch.setattr(answers, "aembed_texts", embed)
+    monkeypatch.setattr(answers, "_index", answers.AnswerIndex())
+    result = {"answer": "a", "citations": [{"id": "S1"}], "confidence": 0.9, "gaps": []}
+    prof = answers.profile("m", safe_mode=False, max_iters=2, topk=6)
+    answers.store("Is the settings test cached?", prof, np.ones(4, dtype=np.float32), result, [])
+
+    def lookup(question, p):
+        return asyncio.run(answers.lookup(question, p))[0]
+
+    assert lookup("is the settings test cached", prof)["similarity"] == 1.0  # exact repeat
+    assert lookup("Is the settings test cached, again?", prof)["result"] == result  # similar question
+    for other in (answers.profile("m", True, 2, 6), answers.profile("m", False, 1, 6), answers.profile("m", False, 2, 3)):
+        assert lookup("Is the settings test cached?", other) is None
+        assert lookup("Is the settings test cached, again?", other) is None
@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+from app.cache import LRU, Cache, FileBackend, SQLiteBackend, namespace, ttl_for
+
+
+@pytest.fixture(params=["sqlite", "files"])
+def backend(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteBackend(str(tmp_path / "cache.sqlite3"))
+    return FileBackend(str(tmp_path / "store"))
+
+
+def test_namespace_and_ttl(monkeypatch):
+    assert namespace("search_abc") == "search"
+    assert namespace("nokey") == ""
+    monkeypatch.setenv("CACHE_TTL_SEARCH", "10")
+    assert ttl_for("search") == 10.0
+    assert ttl_for("") == 0.0
+
+
+def test_round_trip_and_expiry(backend, monkeypatch):
+    monkeypatch.setenv("CACHE_TTL_SEARCH", "60")
+    cache = Cache(backend)
+    cache.set("search_fresh", {"items": [1, 2]})
+    cache.set("search_old", {"items": []}, created=time.time() - 3600)
+    assert cache.get("search_fresh") == {"items": [1, 2]}
+    assert cache.get("search_old") is None
+    # the persistent layer expires it too, not just the in-process LRU
+    assert Cache(backend).get("search_old") is None
+    assert cache.stats()["namespaces"]["search"]["hits"] == 1
+
+
+def test_zero_ttl_never_expires(backend, monkeypatch):
+    monkeypatch.setenv("CACHE_TTL_PAGE", "0")
+    cache = Cache(backend)
+    cache.set("page_x", {"text": "t"}, created=1.0)
+    assert Cache(backend).get("page_x") == {"text": "t"}
+
+
+def test_namespace_cap_evicts_least_recently_used(backend, monkeypatch):
+    cache = Cache(backend)
+    for i in range(10):
+        cache.set(f"page_{i}", {"text": f"{i}" * 200})
+        time.sleep(0.01)  # distinct access times
+    cache.set("search_keep", {"items": []})
+    blob_size = backend.usage()["page"][1] // 10
+    monkeypatch.setenv("CACHE_MAX_BYTES_PAGE", str(blob_size * 5))
+    assert cache.evict() > 0
+    entries, used = backend.usage()["page"]
+    assert used <= blob_size * 5 and entries < 10
+    assert cache.get("page_9") is not None  # newest kept
+    assert cache.get("page_0") is None      # oldest gone
+    assert cache.get("search_keep") is not None  # other namespaces untouched
+
+
+def test_total_cap(backend):
+    cache = Cache(backend, max_bytes=1)
+    for i in range(5):
+        cache.set(f"search_{i}", {"items": [i]})
+    cache.evict()
+    assert sum(n for n, _ in backend.usage().values()) <= 1
+
+
+def test_lfu_keeps_hot_entries(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "c.sqlite3"), eviction="lfu")
+    for i in range(4):
+        backend.set(f"page_{i}", b"x" * 100, "page", 0)
+    for _ in range(3):
+        backend.get("page_0")
+    backend.evict(0, {"page": 250})
+    assert backend.get("page_0") is not None
+    assert backend.usage()["page"][1] <= 250
+
+
+def test_lru_bounds_items_and_bytes():
+    lru = LRU(max_items=3, max_bytes=10)
+    for k in "abc":
+        lru.put(k, k, size=3)
+    lru.get("a")
+    lru.put("d", "d", size=3)  # over 10 bytes: evicts least recently used ("b")
+    assert lru.get("b") is None and lru.get("a") == "a"
+    lru.put("e", "e", size=1)
+    assert len(lru) <= 3
+
+
+def test_sqlite_reads_batch_access_time_writes(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.cache.TOUCH_INTERVAL", 3600)
+    backend = SQLiteBackend(str(tmp_path / "c.sqlite3"))
+    backend.set("page_a", b"x", "page", 0)
+
+    def row():
+        return backend._conn().execute("SELECT accessed, hits FROM entries WHERE key='page_a'").fetchone()
+
+    before = row()
+    time.sleep(0.01)
+    for _ in range(3):
+        assert backend.get("page_a") is not None
+    assert row() == before  # hits only touch memory
+    backend.flush()
+    accessed, hits = row()
+    assert accessed > before[0] and hits == 3
+    backend.flush()  # nothing pending: no change
+    assert row() == (accessed, 3)
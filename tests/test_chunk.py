@@ -0,0 +1,47 @@
+from app.chunk import chunk_spans, chunk_with_spans, normalize
+
+TEXT = " ".join(
+    f"Sentence number {i} talks about solar panels, grid storage and policy." for i in range(60)
+)
+PARAS = "First paragraph line one.\nstill one.\n\n\nSecond   paragraph.\n\nThird\xa0one."
+
+
+def test_spans_slice_back_to_chunks():
+    chunks, spans = chunk_with_spans(TEXT, chunk_size=300, overlap=50)
+    buf = normalize(TEXT, keep_paragraphs=True)
+    assert len(chunks) == len(spans) > 1
+    assert all(buf[s:e] == c for c, (s, e) in zip(chunks, spans))
+
+
+def test_spans_cover_text_in_order_with_overlap():
+    spans = chunk_spans(normalize(TEXT), chunk_size=300, overlap=50)
+    assert spans[0][0] == 0 and spans[-1][1] == len(normalize(TEXT))
+    for (s1, e1), (s2, e2) in zip(spans, spans[1:]):
+        assert s1 < s2 <= e1 < e2  # advancing, overlapping, no gaps
+
+
+def test_chunks_end_on_sentence_boundaries():
+    buf = normalize(TEXT)
+    spans = chunk_spans(buf, chunk_size=300, overlap=150)
+    for s, e in spans[:-1]:
+        assert buf[e - 1] == "."
+    # the overlap starts on a sentence when one begins inside it
+    assert all(buf[s] == "S" for s, _ in spans)
+
+
+def test_paragraphs_are_kept_for_spans():
+    buf = normalize(PARAS, keep_paragraphs=True)
+    assert buf == "First paragraph line one. still one.\n\nSecond paragraph.\n\nThird one."
+    chunks, spans = chunk_with_spans(PARAS, chunk_size=30, overlap=0)
+    assert all(buf[s:e] == c for c, (s, e) in zip(chunks, spans))
+
+
+def test_token_budgeted_spans():
+    chunks, spans = chunk_with_spans(TEXT, max_tokens=64)
+    buf = normalize(TEXT, keep_paragraphs=True)
+    assert len(spans) > 1 and spans[-1][1] == len(buf)
+    assert all(buf[s:e] == c for c, (s, e) in zip(chunks, spans))
+
+
+def test_empty_text():
+    assert chunk_with_spans("   ") == ([], [])
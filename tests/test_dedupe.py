@@ -0,0 +1,43 @@
+from app.dedupe import NearDupIndex
+
+BASE = " ".join(
+    f"Solar capacity additions in region {i} reached a record as panel prices fell and utilities signed contracts."
+    for i in range(8)
+)
+EDITED = BASE + " Syndicated by Example News."  # a mirror with a trailer: still a near duplicate
+OTHER = ("Central banks raised interest rates again to fight inflation while unemployment "
+         "stayed low and wage growth slowed in most advanced economies this quarter")
+
+
+def test_exact_and_near_duplicates_share_a_group():
+    idx = NearDupIndex()
+    g = idx.add(BASE, "https://a.example")
+    assert idx.add(BASE, "https://b.example") == g
+    assert idx.add(EDITED, "https://c.example") == g
+    assert idx.add(OTHER, "https://d.example") != g
+    assert idx.urls(g) == ["https://a.example", "https://b.example", "https://c.example"]
+
+
+def test_collapse_keeps_best_item_with_every_url():
+    items = [
+        {"chunk": BASE, "url": "https://a.example", "score": 3.0},
+        {"chunk": OTHER, "url": "https://d.example", "score": 2.0},
+        {"chunk": EDITED, "url": "https://c.example", "score": 1.0},
+    ]
+    out = NearDupIndex().collapse(items)
+    assert [it["url"] for it in out] == ["https://a.example", "https://d.example"]
+    assert out[0]["urls"] == ["https://a.example", "https://c.example"]
+    assert out[1]["urls"] == ["https://d.example"]
+    assert "urls" not in items[0]  # inputs are not modified
+
+
+def test_collapse_lists_urls_seen_before():
+    idx = NearDupIndex()
+    idx.add(BASE, "https://mirror.example")
+    out = idx.collapse([{"chunk": EDITED, "url": "https://c.example"}])
+    assert out[0]["urls"] == ["https://c.example", "https://mirror.example"]
+
+
+def test_collapse_without_urls_and_empty_text():
+    out = NearDupIndex().collapse([{"chunk": ""}, {"chunk": ""}, {"chunk": BASE}])
+    assert len(out) == 2 and out[0]["urls"] == []
@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+import textwrap
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from app import extract
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+posix_only = pytest.mark.skipif(extract.resource is None, reason="needs resource.RLIMIT_CPU")
+
+
+def test_timeout_is_not_an_exception():
+    assert not issubclass(extract.ExtractionTimeout, Exception)
+
+
+def test_extract_text_inline():
+    html = "<html><head><title>Hello</title></head><body><article><p>" + "Plain words here. " * 40 + "</p></article></body></html>"
+    out = extract.extract_text("https://a.example/x", html)
+    assert out["title"] == "Hello"
+    assert "Plain words here." in out["text"]
+
+
+def _worker(body: str, **env):
+    code = textwrap.dedent(f"""
+        import time
+        from app import extract
+        extract._worker_init()
+        extract._task["seconds"], extract._task["overruns"] = 1, 0
+        extract._cpu_budget(1)
+        t0 = time.process_time()
+        {body}
+    """)
+    return subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, timeout=60,
+        env={**os.environ, "EXTRACT_CPU_GRACE": "1", **env},
+    )
+
+
+@posix_only
+def test_cpu_limit_gets_past_except_exception():
+    out = _worker(textwrap.dedent("""
+        try:
+            try:
+                while True:
+                    pass
+            except Exception:  # what trafilatura's fallbacks do
+                print("swallowed")
+        except extract.ExtractionTimeout:
+            print("timeout")
+    """).replace("\n", "\n        "))
+    assert out.stdout.strip() == "timeout", out.stderr
+
+
+@posix_only
+def test_worker_exits_when_the_timeout_is_swallowed():
+    out = _worker(textwrap.dedent("""
+        while True:
+            try:
+                while True:
+                    pass
+            except BaseException:
+                pass
+    """).replace("\n", "\n        "))
+    assert out.returncode == 70
+
+
+def test_retire_kills_a_stuck_worker():
+    pool = ProcessPoolExecutor(max_workers=1)
+    stuck = pool.submit(time.sleep, 60)
+    time.sleep(0.5)
+    procs = list(pool._processes.values())
+    extract._retire(pool, stuck, wait_s=1)
+    deadline = time.time() + 20
+    while time.time() < deadline and any(p.is_alive() for p in procs):
+        time.sleep(0.1)
+    assert not any(p.is_alive() for p in procs)
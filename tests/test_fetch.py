@@ -0,0 +1,77 @@
+from app.fetch import _sniff_charset, _transcoder
+
+STALE_META = b'<html><head><meta charset="iso-8859-1"><title>x</title>'
+
+
+def test_header_charset_wins_over_meta():
+    assert _sniff_charset("text/html; charset=utf-8", STALE_META) == "utf-8"
+    assert _sniff_charset("text/html; charset=windows-1252", b'<meta charset="utf-8">') == "cp1252"
+
+
+def test_meta_then_default():
+    assert _sniff_charset("text/html", STALE_META) == "iso8859-1"
+    assert _sniff_charset("text/html", b"<html>") == "utf-8"
+    assert _sniff_charset("text/html; charset=bogus", STALE_META) == "iso8859-1"
+    assert _sniff_charset("text/html", b'<meta charset="utf-16">') == "utf-8"
+
+
+def test_bom_wins():
+    assert _sniff_charset("text/html; charset=iso-8859-1", b"\xef\xbb\xbf<html>") == "utf-8-sig"
+
+
+def test_stale_meta_does_not_garble_utf8():
+    body = STALE_META + "<p>naïve café – ok</p>".encode("utf-8")
+    out = _transcoder("html", "text/html; charset=utf-8", body[:64])(body, True)
+    assert "naïve café – ok" in out.decode("utf-8")
+
+
+def _read(body: bytes, content_type: str) -> str:
+    from app.fetch import _BodyReader
+
+    reader = _BodyReader("https://example.com/", 200, {"Content-Type": content_type})
+    for i in range(0, len(body), 100):
+        reader.feed(body[i:i + 100])
+    b = reader.finish()
+    try:
+        return b.text()
+    finally:
+        b.close()
+
+
+PAGE = "<html><head><title>Título</title></head><body><p>naïve café</p></body></html>" * 20
+
+
+def test_utf16_page_with_bom_decodes():
+    for codec in ("utf-16-le", "utf-16-be", "utf-32-le"):
+        bom = {"utf-16-le": b"\xff\xfe", "utf-16-be": b"\xfe\xff", "utf-32-le": b"\xff\xfe\x00\x00"}[codec]
+        assert _read(bom + PAGE.encode(codec), "text/html") == PAGE
+
+
+def test_utf16_declared_in_header_decodes():
+    assert _read(PAGE.encode("utf-16-le"), "text/html; charset=utf-16le") == PAGE
+
+
+def test_nul_bytes_without_a_wide_charset_are_rejected():
+    import pytest
+
+    with pytest.raises(ValueError, match="Non-HTML"):
+        _read(b"<html>\x00\x00\x00binary" * 50, "text/html")
+
+
+def test_fetch_many_keeps_the_best_ranked_pages(monkeypatch):
+    import asyncio
+
+    from app import fetch
+
+    delays = {"u0": 0.2, "u1": 0.01, "u2": 0.01, "u3": 0.01, "u4": 0.3}
+
+    async def fake(url):
+        await asyncio.sleep(delays[url])
+        return {"text": url}
+
+    monkeypatch.setattr(fetch, "fetch_and_extract_async", fake)
+    got = asyncio.run(fetch.fetch_many_async(list(delays), limit=2, workers=5, deadline=5))
+    assert [u for u, _ in got] == ["u0", "u1"]  # u0 is slow but outranks u2/u3
+
+    got = asyncio.run(fetch.fetch_many_async(list(delays), limit=2, workers=5, deadline=0.1))
+    assert [u for u, _ in got] == ["u1", "u2"]  # the deadline keeps whatever had finished
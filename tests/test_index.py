@@ -0,0 +1,105 @@
+import os
+import threading
+
+from app import index
+from app.index import BM25Index, tokenize
+
+PAGES = {
+    "https://a.example/solar": ("Solar", ["Solar panels convert sunlight into electricity.", "Panel prices fell sharply."]),
+    "https://b.example/wind": ("Wind", ["Wind turbines generate electricity from moving air."]),
+    "https://c.example/coal": ("Coal", ["Coal plants emit carbon dioxide when burning fuel."]),
+}
+
+
+def _index(**kw) -> BM25Index:
+    idx = BM25Index(**kw)
+    for url, (title, chunks) in PAGES.items():
+        idx.add_page(url, title, chunks)
+    return idx
+
+
+def test_tokenize_stems_and_drops_stopwords():
+    assert tokenize("The emissions of panels") == ["emission", "panel"]
+
+
+def test_query_ranks_matching_chunks():
+    hits = _index().query("solar electricity")
+    assert hits[0]["url"] == "https://a.example/solar"
+    assert {h["url"] for h in hits} == {"https://a.example/solar", "https://b.example/wind"}
+    assert all(h["score"] > 0 for h in hits)
+
+
+def test_query_filters_and_caps_per_page():
+    idx = _index()
+    hits = idx.query("panel electricity", urls={"https://a.example/solar"}, per_url=1)
+    assert len(hits) == 1 and hits[0]["url"] == "https://a.example/solar"
+
+
+def test_unchanged_page_is_not_reindexed_and_changed_page_replaces():
+    idx = _index()
+    ids = idx.add_page("https://c.example/coal", "Coal", PAGES["https://c.example/coal"][1])
+    assert len(idx) == 4 and idx.version == 3
+    idx.add_page("https://c.example/coal", "Coal", ["Coal use declined this decade."])
+    assert len(idx) == 4 and ids[0] not in idx.docs
+    assert not idx.query("carbon dioxide")
+
+
+def test_max_docs_drops_oldest_pages():
+    idx = _index(max_docs=2)
+    assert list(idx.pages) == ["https://b.example/wind", "https://c.example/coal"]
+    assert len(idx) == 2
+
+
+def test_save_load_round_trip_keeps_spans(tmp_path):
+    idx = BM25Index()
+    idx.add_page("https://s.example", "S", ["alpha beta", "gamma delta"], spans=[(0, 10), (11, 22)])
+    path = str(tmp_path / "bm25.jz")
+    idx.save(path)
+    loaded = BM25Index.load(path)
+    assert loaded.query("gamma") == idx.query("gamma")
+    assert loaded.query("gamma")[0]["start"] == 11
+    assert [p for p in os.listdir(tmp_path) if p.endswith(".tmp")] == []
+
+
+def test_save_merges_pages_saved_by_another_writer(tmp_path):
+    path = str(tmp_path / "bm25.jz")
+    first, second = BM25Index(), BM25Index()
+    first.add_page("https://one.example", "One", ["first writer page"])
+    second.add_page("https://two.example", "Two", ["second writer page"])
+    first.save(path)
+    second.save(path)
+    assert set(BM25Index.load(path).pages) == {"https://one.example", "https://two.example"}
+
+
+def test_concurrent_saves_leave_a_readable_file(tmp_path):
+    path = str(tmp_path / "bm25.jz")
+    idx = _index()
+    threads = [threading.Thread(target=idx.save, args=(path,)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(BM25Index.load(path)) == len(idx)
+
+
+def test_flush_only_writes_changes_and_is_throttled(tmp_path, monkeypatch):
+    path = str(tmp_path / "bm25.jz")
+    monkeypatch.setenv("BM25_PERSIST", "1")
+    monkeypatch.setenv("BM25_FLUSH_INTERVAL", "3600")
+    monkeypatch.setattr(index, "INDEX_PATH", path)
+    monkeypatch.setattr(index, "_shared", None)
+    monkeypatch.setattr(index, "_flushed_at", 0.0)
+    idx = index.shared_index()
+    index.flush_shared_index()
+    assert not os.path.exists(path)  # nothing changed yet
+
+    idx.add_page("https://x.example", "X", ["some text"])
+    index.flush_shared_index()
+    assert os.path.exists(path)
+    saved = os.stat(path).st_mtime_ns
+
+    idx.add_page("https://y.example", "Y", ["more text"])
+    index.flush_shared_index()
+    assert os.stat(path).st_mtime_ns == saved  # within the interval
+    index.flush_shared_index(force=True)
+    assert "https://y.example" in BM25Index.load(path).pages
@@ -0,0 +1,113 @@
+import asyncio
+import io
+import json
+import time
+
+import pytest
+
+import server_mcp
+
+
+def test_parse_timeout():
+    assert server_mcp.parse_timeout(None) == server_mcp.MCP_CALL_TIMEOUT
+    assert server_mcp.parse_timeout("2.5") == 2.5
+    assert server_mcp.parse_timeout(30) == 30.0
+    for bad in ("abc", 0, -1, True, [], {}, "inf", "nan"):
+        with pytest.raises(ValueError):
+            server_mcp.parse_timeout(bad)
+
+
+def _handle_all(monkeypatch, *msgs):
+    sent = []
+    monkeypatch.setattr(server_mcp, "send", sent.append)
+
+    async def run():
+        server = server_mcp.Server()
+        for msg in msgs:
+            server.handle(msg)
+        return server
+
+    server = asyncio.run(run())
+    return server, sent
+
+
+def test_bad_timeout_is_rejected_before_accepting(monkeypatch):
+    server, sent = _handle_all(monkeypatch, {
+        "type": "call_tool", "id": "1", "tool": "agentic_research", "timeout": "abc", "params": {},
+    })
+    assert sent == [{"type": "error", "id": "1", "error": "invalid timeout: 'abc'"}]
+    assert not server.calls and not server.cancelled
+
+
+def test_call_validation(monkeypatch):
+    _, sent = _handle_all(
+        monkeypatch,
+        {"type": "call_tool", "id": "a", "tool": "nope"},
+        {"type": "call_tool", "id": "b", "tool": "agentic_research", "params": []},
+        {"type": "cancel", "id": "missing"},
+        {"type": "bogus", "id": "c"},
+        {"type": "list_tools", "id": "d"},
+    )
+    assert [(m["type"], m.get("id")) for m in sent] == [
+        ("error", "a"), ("error", "b"), ("error", "missing"), ("error", "c"), ("tools", "d"),
+    ]
+    assert sent[4]["tools"][0]["name"] == "agentic_research"
+
+
+def test_serve_survives_a_failing_message(monkeypatch):
+    sent = []
+    monkeypatch.setattr(server_mcp, "send", sent.append)
+    lines = ["not json", "[1]", json.dumps({"type": "list_tools", "id": "boom"}), json.dumps({"type": "list_tools", "id": "ok"})]
+    monkeypatch.setattr(server_mcp.sys, "stdin", io.StringIO("\n".join(lines) + "\n"))
+    real = server_mcp.Server.handle
+
+    def handle(self, msg):
+        if msg.get("id") == "boom":
+            raise RuntimeError("kaput")
+        return real(self, msg)
+
+    monkeypatch.setattr(server_mcp.Server, "handle", handle)
+    asyncio.run(server_mcp.serve())
+    assert [(m["type"], m.get("id")) for m in sent] == [
+        ("ready", None), ("error", None), ("error", None), ("error", "boom"), ("tools", "ok"),
+    ]
+    assert "kaput" in sent[3]["error"]
+
+
+def test_cancel_mid_stage_stops_provider_calls(monkeypatch):
+    from app import httpclient, llm, search
+    from bench.stubs import Stubs, make_corpus
+
+    stubs = Stubs(make_corpus(24), sites=4, page_latency=0, search_latency=0.5, llm_latency=0).start()
+    try:
+        for k, v in stubs.env().items():
+            monkeypatch.setenv(k, v)
+        monkeypatch.setenv("ANSWER_CACHE", "off")
+        monkeypatch.setattr(search, "SERP_API", stubs.env()["SERPAPI_URL"])
+        sent = []
+        monkeypatch.setattr(server_mcp, "send", sent.append)
+
+        async def run():
+            server = server_mcp.Server()
+            server.handle({"type": "call_tool", "id": "c", "tool": "agentic_research",
+                           "params": {"question": "Which boosters do lunar rocket missions use?", "max_iters": 1}})
+            while not any(m.get("stage") == "queries_planned" for m in sent):
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)  # searches are in flight
+            server.handle({"type": "cancel", "id": "c"})
+            t0 = time.monotonic()
+            await server.drain()
+            stopped_in = time.monotonic() - t0
+            await httpclient.aclose()
+            await llm.aclose()
+            return server, dict(stubs.counts), stopped_in
+
+        server, at_cancel, stopped_in = asyncio.run(run())
+        time.sleep(0.8)  # the searches would have answered by now
+        assert sent[-1] == {"type": "cancelled", "id": "c"}
+        assert stopped_in < 0.3  # the slot is free without waiting for the search to return
+        assert server.slots._value == server_mcp.MCP_MAX_CONCURRENCY
+        assert at_cancel.get("search") and not at_cancel.get("pages")
+        assert stubs.counts == at_cancel
+    finally:
+        stubs.stop()
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import time
+
+from app import fetch, pipeline
+from app.index import BM25Index
+
+TEXT = "solar panels electricity " * 20
+
+
+def _page(url):
+    return {"url": url, "title": url, "text": TEXT}
+
+
+async def _apage(url):
+    return _page(url)
+
+
+def test_pipeline_shares_downloads_already_in_flight(monkeypatch):
+    url = "https://shared.example/page"
+    calls = []
+
+    async def slow_fetch(u):
+        calls.append(u)
+        await asyncio.sleep(0.3)
+        return _page(u)
+
+    async def search(queries, k):
+        return [{"url": url}]
+
+    monkeypatch.setattr(fetch, "_fetch_and_extract_async", slow_fetch)
+    monkeypatch.setattr(pipeline, "search_many_async", search)
+    other = threading.Thread(target=fetch.fetch_and_extract, args=(url,))
+    other.start()  # another session starts the download first
+    time.sleep(0.05)
+    chunks, report = pipeline.run_pipeline("solar", ["q"], index=BM25Index())
+    other.join()
+    assert calls == [url]
+    assert chunks and report["fetch"]["items"] == 1
+
+
+def test_early_stop_cancels_outstanding_searches(monkeypatch):
+    cancelled = []
+
+    async def search(queries, k):
+        q = queries[0]
+        if q == "slow":
+            try:
+                await asyncio.sleep(2)
+            except asyncio.CancelledError:
+                cancelled.append(q)
+                raise
+        return [{"url": f"https://{q}{i}.example/"} for i in range(3)]
+
+    monkeypatch.setattr(pipeline, "search_many_async", search)
+    monkeypatch.setattr(pipeline, "fetch_and_extract_async", _apage)
+    t0 = time.monotonic()
+    chunks, report = pipeline.run_pipeline("solar", ["fast", "slow"], max_pages=1, index=BM25Index())
+    assert report["stop_reason"] == "page quota" and chunks
+    assert time.monotonic() - t0 < 1.0
+    assert cancelled == ["slow"]
+
+
+def test_pipeline_runs_on_the_callers_loop(monkeypatch):
+    async def search(queries, k):
+        return [{"url": f"https://{queries[0]}{i}.example/"} for i in range(2)]
+
+    monkeypatch.setattr(pipeline, "search_many_async", search)
+    monkeypatch.setattr(pipeline, "fetch_and_extract_async", _apage)
+    chunks, report = asyncio.run(pipeline.run_pipeline_async("solar", ["a", "b"], index=BM25Index()))
+    assert report["stop_reason"] == "exhausted"
+    assert report["search"]["items"] == 2 and report["fetch"]["items"] == 4 and report["rank"]["items"] == 4
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app import ratelimit
+from app.ratelimit import BATCH, Gate, Limiter, LocalStore, _take, priority
+
+
+def test_bucket_starts_full_and_refills():
+    tokens, wait, state = _take(None, 100.0, 1, rate=2.0, capacity=2.0)
+    assert (tokens, wait) == (1.0, 0.0)
+    tokens, wait, state = _take(state, 100.0, 1, rate=2.0, capacity=2.0)
+    assert (tokens, wait) == (0.0, 0.0)
+    # half a second later one token has come back
+    tokens, wait, state = _take(state, 100.5, 1, rate=2.0, capacity=2.0)
+    assert (tokens, wait) == (0.0, 0.0)
+
+
+def test_bucket_runs_into_debt_instead_of_failing():
+    state = None
+    waits = []
+    for _ in range(4):
+        _, wait, state = _take(state, 10.0, 1, rate=1.0, capacity=1.0)
+        waits.append(wait)
+    assert waits == [0.0, 1.0, 2.0, 3.0]
+
+
+def test_refill_is_capped_at_capacity():
+    _, _, state = _take(None, 0.0, 5, rate=1.0, capacity=5.0)
+    tokens, _, _ = _take(state, 1000.0, 0, rate=1.0, capacity=5.0)
+    assert tokens == 5.0
+
+
+def test_block_delays_only_that_key():
+    s = LocalStore()
+    s.block("openai:a:req", 5)
+    assert s.reserve("openai:a:req", 1, 10, 10) == pytest.approx(5, abs=0.1)
+    assert s.reserve("openai:b:req", 1, 10, 10) == 0.0
+
+
+def test_429_blocks_the_model_not_the_provider(monkeypatch):
+    s = LocalStore()
+    monkeypatch.setattr(ratelimit, "_store", s)
+    gate = Gate(4)
+    a = Limiter("openai:a", gate, rps=100)
+    b = Limiter("openai:b", gate, rps=100)
+
+    class TooMany(Exception):
+        status_code = 429
+
+    ratelimit._on_error(a, TooMany())
+    assert a._reserve(0) > 0.5
+    assert b._reserve(0) == 0.0
+
+
+def test_gate_serves_interactive_before_batch():
+    gate = Gate(1)
+    order = []
+    gate.__enter__()  # hold the only slot
+
+    def worker(name, level):
+        with priority(level):
+            with gate:
+                order.append(name)
+
+    batch = threading.Thread(target=worker, args=("batch", BATCH))
+    batch.start()
+    time.sleep(0.05)
+    interactive = threading.Thread(target=worker, args=("interactive", ratelimit.INTERACTIVE))
+    interactive.start()
+    time.sleep(0.05)
+    gate.__exit__(None, None, None)
+    batch.join(2)
+    interactive.join(2)
+    assert order == ["interactive", "batch"]
+
+
+def test_cancelled_async_waiter_gives_its_turn_away():
+    async def main():
+        gate = Gate(1)
+        await gate.__aenter__()
+        waiter = asyncio.create_task(gate.__aenter__())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await gate.__aexit__(None, None, None)
+        await asyncio.wait_for(gate.__aenter__(), 1)
+
+    asyncio.run(main())
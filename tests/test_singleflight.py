@@ -0,0 +1,207 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.singleflight import Group
+from bench.stubs import Stubs, make_corpus
+
+
+def test_threads_share_one_call():
+    group, calls = Group("t"), []
+    started = threading.Event()
+
+    def work():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return "value"
+
+    with ThreadPoolExecutor(4) as pool:
+        leader = pool.submit(group.run, "k", work)
+        started.wait(1)
+        followers = [pool.submit(group.run, "k", work) for _ in range(3)]
+        results = [f.result() for f in [leader] + followers]
+    assert results == ["value"] * 4 and len(calls) == 1
+    assert group.run("k", lambda: "again") == "again"  # finished flights are forgotten
+
+
+def test_threads_share_the_exception():
+    group = Group("t")
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("boom")
+
+    with ThreadPoolExecutor(2) as pool:
+        a = pool.submit(group.run, "k", fail)
+        started.wait(1)
+        b = pool.submit(group.run, "k", lambda: "not called")
+        for f in (a, b):
+            with pytest.raises(ValueError):
+                f.result()
+
+
+def test_coroutines_share_one_call():
+    group, calls = Group("a"), []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    async def main():
+        return await asyncio.gather(*(group.do("k", work) for _ in range(5)))
+
+    assert asyncio.run(main()) == [1] * 5 and len(calls) == 1
+
+
+def test_cancelled_waiter_does_not_cancel_others():
+    group = Group("a")
+
+    async def work():
+        await asyncio.sleep(0.1)
+        return "done"
+
+    async def main():
+        first = asyncio.create_task(group.do("k", work))
+        second = asyncio.create_task(group.do("k", work))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "done"
+
+
+def test_last_waiter_leaving_cancels_the_leader():
+    group = Group("a")
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def main():
+        tasks = [asyncio.create_task(group.do("k", work)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        assert not group._flights
+        return await group.do("k", lambda: asyncio.sleep(0, "fresh"))
+
+    assert asyncio.run(main()) == "fresh"
+    assert cancelled == [1]
+
+
+def _on_other_loop(group, work, body):
+    """Run group.do("k", work) as a task on a fresh loop in a thread; body(task) decides its fate."""
+    started = threading.Event()
+
+    async def main():
+        task = asyncio.create_task(group.do("k", work))
+        started.set()
+        await body(task)
+
+    t = threading.Thread(target=asyncio.run, args=(main(),), name="leader")
+    t.start()
+    started.wait(1)
+    return t
+
+
+def test_waiter_on_another_loop_keeps_the_flight_alive():
+    group, runs = Group("a"), []
+
+    async def work():
+        runs.append(threading.current_thread().name)
+        await asyncio.sleep(0.2)
+        return "ok"
+
+    async def cancel_then_linger(task):
+        await asyncio.sleep(0.05)
+        task.cancel()  # another loop is still waiting, so the flight keeps running
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0.3)
+
+    t = _on_other_loop(group, work, cancel_then_linger)
+    time.sleep(0.02)
+    assert asyncio.run(group.do("k", work)) == "ok"
+    t.join()
+    assert runs == ["leader"]
+
+
+def test_waiter_restarts_when_the_leaders_loop_goes_away():
+    group, runs = Group("a"), []
+
+    async def work():
+        runs.append(threading.current_thread().name)
+        await asyncio.sleep(0.2)
+        return "ok"
+
+    async def exit_early(task):
+        await asyncio.sleep(0.05)  # asyncio.run then cancels the unfinished leader
+
+    t = _on_other_loop(group, work, exit_early)
+    time.sleep(0.02)
+    assert asyncio.run(group.do("k", work)) == "ok"
+    t.join()
+    assert runs == ["leader", "MainThread"]
+
+
+def test_partition_joins_in_flight_items_and_claims_the_rest():
+    group = Group("p")
+    joined, claims = group.partition(["a", "b"], key=str)
+    assert joined == [] and [b for b, _ in claims] == [["a", "b"]]
+    joined2, claims2 = group.partition(["b", "c"], key=str, batches=lambda xs: [[x] for x in xs])
+    assert joined2 == [claims[0][1]] and [b for b, _ in claims2] == [["c"]]
+    group.settle(claims[0][1], {"a": 1, "b": 2})
+    group.settle(claims2[0][1], {"c": 3})
+    assert joined2[0].result() == {"a": 1, "b": 2}
+    assert not group._flights
+
+
+def test_process_lock_serializes_leaders(tmp_path, monkeypatch):
+    # two groups stand in for two processes: each has its own flight table
+    monkeypatch.setenv("SINGLEFLIGHT_DIR", str(tmp_path))
+    a, b = Group("fetch", processes=True), Group("fetch", processes=True)
+    active, overlap = [0], []
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            active[0] += 1
+            overlap.append(active[0])
+        time.sleep(0.1)
+        with lock:
+            active[0] -= 1
+        return True
+
+    with ThreadPoolExecutor(2) as pool:
+        futs = [pool.submit(a.run, "url", work), pool.submit(b.run, "url", work)]
+        assert all(f.result() for f in futs)
+    assert max(overlap) == 1
+    assert list(tmp_path.iterdir())
+
+
+def test_concurrent_fetches_of_one_page_download_it_once():
+    from app.fetch import fetch_and_extract
+
+    stubs = Stubs(make_corpus(4), sites=1, page_latency=0.3).start()
+    try:
+        url = stubs.url(2)
+        with ThreadPoolExecutor(4) as pool:
+            pages = list(pool.map(lambda _: fetch_and_extract(url), range(4)))
+    finally:
+        stubs.stop()
+    assert stubs.counts["pages"] == 1
+    assert all(p["text"] and p["text"] == pages[0]["text"] for p in pages)
@@ -0,0 +1,59 @@
+from app.synth import _merge_adjacent, pack_context
+
+TEXT = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _chunk(start, end, score=1.0, url="https://a.example/x"):
+    return {"chunk": TEXT[start:end], "start": start, "end": end, "score": score, "url": url, "title": "t"}
+
+
+def test_merge_overlapping():
+    out = _merge_adjacent([_chunk(5, 15, 0.2), _chunk(0, 10, 0.5)])
+    assert [(c["start"], c["end"], c["chunk"], c["score"]) for c in out] == [(0, 15, TEXT[0:15], 0.5)]
+
+
+def test_merge_exactly_adjacent():
+    out = _merge_adjacent([_chunk(0, 10), _chunk(10, 20)])
+    assert [c["chunk"] for c in out] == [TEXT[0:20]]
+
+
+def test_gap_is_not_merged():
+    out = _merge_adjacent([_chunk(0, 10), _chunk(11, 20)])
+    assert [c["chunk"] for c in out] == [TEXT[0:10], TEXT[11:20]]
+
+
+def test_contained_chunk_and_chunks_without_spans():
+    plain = {"chunk": "no offsets", "score": 0.1, "url": "u", "title": "t"}
+    out = _merge_adjacent([_chunk(0, 20, 0.4), _chunk(3, 8, 0.9), plain])
+    assert {c["chunk"] for c in out} == {TEXT[0:20], "no offsets"}
+    assert max(c["score"] for c in out) == 0.9
+
+
+def test_pack_context_keeps_budget_and_groups_by_url():
+    chunks = [
+        _chunk(0, 10, 0.9),
+        _chunk(20, 30, 0.8),
+        {"chunk": "other source text", "score": 0.5, "url": "https://b.example/y", "title": "b"},
+    ]
+    sources, used = pack_context(chunks, budget_tokens=200)
+    assert used <= 200
+    assert [s["url"] for s in sources] == ["https://a.example/x", "https://b.example/y"]
+    assert TEXT[0:10] in sources[0]["snippet"] and TEXT[20:30] in sources[0]["snippet"]
+
+
+def test_pack_context_counts_headers_and_joiners():
+    from app.synth import format_sources
+    from app.tokens import count_tokens
+
+    words = "solar wind grid storage battery policy emissions ".split()
+    chunks = []
+    for u in range(6):
+        for i in range(4):
+            text = " ".join(words[(u + i + j) % len(words)] + str(u * 10 + i) for j in range(30))
+            chunks.append({"chunk": text, "score": 1.0 + u + i / 10, "url": f"https://site{u}.example/a/long/path/{u}",
+                           "urls": [f"https://mirror{u}.example/copy/{u}"], "title": "t"})
+    for budget in (120, 250, 400, 1000):
+        sources, used = pack_context(chunks, budget_tokens=budget)
+        block = format_sources(sources)
+        assert used == count_tokens(block) <= budget
+        assert sources and all("[%s] " % s["id"] in block for s in sources)